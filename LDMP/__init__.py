@@ -16,19 +16,30 @@ import os
 import requests
 import site
 
-from PyQt4 import QtGui, QtCore, uic
+try:
+    from PyQt4 import QtGui, QtCore, uic
 
-from qgis.core import QgsMessageLog
-from qgis.utils import iface
+    from qgis.core import QgsMessageLog
+    from qgis.utils import iface
+except ImportError:
+    # Running outside of QGIS (for example the reporting command line tool), 
+    # where only the Qt-free modules can be used
+    QgsMessageLog = None
 
 site.addsitedir(os.path.abspath(os.path.dirname(__file__) + '/ext-libs'))
 
-debug = QtCore.QSettings().value('LDMP/debug', True)
+if QgsMessageLog:
+    debug = QtCore.QSettings().value('LDMP/debug', True)
 
+    def log(message, level=QgsMessageLog.INFO):
+        if debug:
+            QgsMessageLog.logMessage(message, tag="LDMP", level=level)
+else:
+    import logging
+    logger = logging.getLogger('LDMP')
 
-def log(message, level=QgsMessageLog.INFO):
-    if debug:
-        QgsMessageLog.logMessage(message, tag="LDMP", level=level)
+    def log(message, level=None):
+        logger.info(message)
 
 # noinspection PyPep8Naming
 
@@ -0,0 +1,201 @@
+# -*- coding: utf-8 -*-
+"""
+/***************************************************************************
+ LDMP - A QGIS plugin
+ This plugin supports monitoring and reporting of land degradation to the UNCCD
+ and in support of the SDG Land Degradation Neutrality (LDN) target.
+                              -------------------
+        begin                : 2017-05-23
+        git sha              : $Format:%H$
+        copyright            : (C) 2017 by Conservation International
+        email                : GEF-LDMP@conservation.org
+ ***************************************************************************/
+"""
+
+import threading
+
+import numpy as np
+
+# Codes used in the SDG 15.3.1 degradation layer
+DEG_CODES = [-1, 0, 1, 9999]
+# Codes used for the final (aggregated) land cover classes
+LC_CODES = range(1, 8)
+# Land cover transition codes are coded as (base class * 10) + target class
+TRANS_CODES = [i * 10 + j for i in LC_CODES for j in LC_CODES]
+
+# Per-thread scratch buffers, reused across blocks
+_buffers = threading.local()
+
+
+def get_buffer(name, size, dtype):
+    """Returns a flat scratch array of size elements (reused across calls)
+
+    Buffers are shared by every caller in a thread, so each use needs its own 
+    name."""
+    buf = getattr(_buffers, name, None)
+    if buf is None or buf.size < size or buf.dtype != dtype:
+        buf = np.empty(size, dtype=dtype)
+        setattr(_buffers, name, buf)
+    return buf[:size]
+
+
+class Crosstab(object):
+    """Dense crosstab (or area table) over a fixed domain of codes
+
+    Each dimension is defined by the list of codes that can occur in it (for
+    example DEG_CODES and TRANS_CODES for the degradation by land cover
+    transition crosstab). Totals are kept in a dense array covering every
+    combination of codes, so adding a block is a single weighted bincount and
+    merging two crosstabs is an addition over the domain. Values that are not
+    in the domain of a dimension (nodata, masked pixels) are ignored.
+
+    With a single domain this is an area table; with N domains it is an N-way
+    crosstab.
+
+    Totals are kept in memory, unless an array of zeros to hold them is
+    passed as the values keyword argument - such as a memory-mapped array
+    (see ScratchSpace.array), for crosstabs too large to keep in memory."""
+
+    def __init__(self, *domains, **kwargs):
+        if len(domains) == 0:
+            raise TypeError("Crosstab() requires at least one domain")
+        self.domains = tuple(np.unique(np.asarray(d, dtype=np.int64)) for d in domains)
+        self.shape = tuple(d.size for d in self.domains)
+        values = kwargs.get('values', None)
+        if values is None:
+            self.values = np.zeros(self.shape)
+        else:
+            if values.shape != self.shape:
+                raise ValueError("values must have shape {}".format(self.shape))
+            self.values = values
+
+        # Lookup tables mapping a code (minus the minimum code in the domain)
+        # to its index along each dimension. Codes that are not in the domain
+        # map to -1.
+        self._offsets = []
+        self._luts = []
+        for d in self.domains:
+            lut = np.empty(d[-1] - d[0] + 1, dtype=np.intp)
+            lut.fill(-1)
+            lut[d - d[0]] = np.arange(d.size)
+            self._offsets.append(d[0])
+            self._luts.append(lut)
+
+    def _flat_index(self, cols, mask=None):
+        """Returns flat indices into self.values for each pixel
+
+        Pixels that are masked or have a code outside the domain are given 
+        the index self.values.size (one past the end). The returned array is 
+        a scratch buffer that is overwritten by the next call."""
+        if len(cols) != len(self.domains):
+            raise ValueError("expected {} arrays but got {}".format(len(self.domains), len(cols)))
+        n = cols[0].size
+        if not all(col.size == n for col in cols[1:]):
+            raise ValueError("all arguments must be same size")
+
+        valid = get_buffer('crosstab_valid', n, bool)
+        if mask is None:
+            valid.fill(True)
+        else:
+            np.copyto(valid, np.asarray(mask, dtype=bool).ravel())
+        ind = get_buffer('crosstab_ind', n, np.intp)
+        ind.fill(0)
+        codes = get_buffer('crosstab_codes', n, np.intp)
+        this_ind = get_buffer('crosstab_this_ind', n, np.intp)
+        in_range = get_buffer('crosstab_in_range', n, bool)
+        flag = get_buffer('crosstab_flag', n, bool)
+        for col, lut, offset, size in zip(cols, self._luts, self._offsets, self.shape):
+            np.subtract(col.ravel(), offset, out=codes, casting='unsafe')
+            np.greater_equal(codes, 0, out=in_range)
+            np.less(codes, lut.size, out=flag)
+            np.logical_and(in_range, flag, out=in_range)
+            # Out of range codes are looked up as 0, and then marked invalid
+            np.multiply(codes, in_range, out=codes)
+            np.take(lut, codes, out=this_ind)
+            np.logical_and(valid, in_range, out=valid)
+            np.greater_equal(this_ind, 0, out=flag)
+            np.logical_and(valid, flag, out=valid)
+            ind *= size
+            ind += this_ind
+        np.logical_not(valid, out=flag)
+        np.putmask(ind, flag, self.values.size)
+        return ind
+
+    def add(self, *cols, **kwargs):
+        """Add the pixels from one block to the crosstab
+
+        Pass one array per dimension (arrays of any shape, all the same size).
+        Optional keyword arguments are weights (an array the same size as the
+        columns, such as cell areas) to sum weights instead of counting pixels,
+        and mask (a boolean array) to only include some pixels."""
+        weights = kwargs.get('weights', None)
+        mask = kwargs.get('mask', None)
+        ind = self._flat_index(cols, mask)
+        if weights is not None:
+            weights = np.asarray(weights).ravel()
+        # Invalid pixels are counted in an extra bin past the end, which is
+        # dropped, rather than compressing the indices (and weights) first
+        counts = np.bincount(ind, weights=weights, minlength=self.values.size + 1)
+        self.values += counts[:self.values.size].reshape(self.shape)
+
+    def merge(self, other):
+        """Adds the totals from another crosstab over the same domain"""
+        if len(other.domains) != len(self.domains) or \
+                not all(np.array_equal(a, b) for a, b in zip(self.domains, other.domains)):
+            raise ValueError("cannot merge crosstabs with different domains")
+        self.values += other.values
+        return self
+
+    def merge_subset(self, other):
+        """Adds the totals from a crosstab over a subset of the codes of the
+        first dimension (and the same codes for the others)
+
+        This merges partial crosstabs that only cover the codes that occur in
+        one block (such as the zones in a window) without expanding them to
+        the full domain first."""
+        if len(other.domains) != len(self.domains) or \
+                not all(np.array_equal(a, b) for a, b in zip(self.domains[1:], other.domains[1:])):
+            raise ValueError("cannot merge crosstabs with different domains")
+        pos = np.searchsorted(self.domains[0], other.domains[0])
+        if np.any(pos >= self.shape[0]) or \
+                not np.array_equal(self.domains[0][np.minimum(pos, self.shape[0] - 1)], other.domains[0]):
+            raise ValueError("codes are not a subset of the first domain")
+        # The codes are unique, so each row is only added once
+        self.values[pos] += other.values
+        return self
+
+    def scale(self, factor):
+        """Multiplies all totals by factor (for example for unit conversion)"""
+        self.values *= factor
+        return self
+
+    def get(self, *codes):
+        """Returns the total for a combination of codes
+
+        Pass one code per dimension. A code of None sums across that
+        dimension. Codes that are not in the domain return 0."""
+        if len(codes) != len(self.domains):
+            raise ValueError("expected {} codes but got {}".format(len(self.domains), len(codes)))
+        ind = []
+        for code, d in zip(codes, self.domains):
+            if code is None:
+                ind.append(slice(None))
+            else:
+                pos = np.searchsorted(d, code)
+                if pos >= d.size or d[pos] != code:
+                    return 0
+                ind.append(pos)
+        return float(np.sum(self.values[tuple(ind)]))
+
+    def subset(self, code):
+        """Returns the crosstab for one code of the first dimension
+
+        For example, for a (zone, degradation, transition) crosstab returns
+        the (degradation, transition) crosstab for a single zone."""
+        if len(self.domains) < 2:
+            raise ValueError("cannot subset a crosstab with one dimension")
+        out = Crosstab(*self.domains[1:])
+        pos = np.searchsorted(self.domains[0], code)
+        if pos < self.domains[0].size and self.domains[0][pos] == code:
+            out.values += self.values[pos]
+        return out
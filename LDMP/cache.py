@@ -0,0 +1,206 @@
+# -*- coding: utf-8 -*-
+"""
+/***************************************************************************
+ LDMP - A QGIS plugin
+ This plugin supports monitoring and reporting of land degradation to the UNCCD
+ and in support of the SDG Land Degradation Neutrality (LDN) target.
+                              -------------------
+        begin                : 2017-05-23
+        git sha              : $Format:%H$
+        copyright            : (C) 2017 by Conservation International
+        email                : GEF-LDMP@conservation.org
+ ***************************************************************************/
+"""
+
+# Persistent cache for the outputs of the reporting stages. Nothing in this
+# module depends on QGIS or Qt.
+
+import os
+import sys
+import json
+import shutil
+import hashlib
+import tempfile
+
+import numpy as np
+
+from LDMP.accumulators import Crosstab
+
+# Included in every cache key - increment this whenever a change to the
+# reporting code changes its outputs, so that older cached results are not
+# reused
+CACHE_VERSION = 2
+
+
+
+def get_user_cache_dir():
+    """Returns the folder for cached results in the user's own data folders
+
+    The system temporary folder is cleaned out by the operating system, so 
+    isn't used for results meant to be reused across runs."""
+    if sys.platform == 'win32':
+        base = os.environ.get('LOCALAPPDATA') or os.path.expanduser('~')
+    elif sys.platform == 'darwin':
+        base = os.path.expanduser('~/Library/Caches')
+    else:
+        base = os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache')
+    return os.path.join(base, 'trends_earth_cache')
+
+
+# Used by the command line tools - within QGIS the cache is kept in the QGIS 
+# settings folder by default (see reporting.get_stage_cache)
+DEFAULT_CACHE_DIR = get_user_cache_dir()
+DEFAULT_MAX_SIZE = 2 * 1024 * 1024 * 1024
+
+
+def file_fingerprint(path):
+    """Returns a list identifying the contents of a file
+
+    Results downloaded from Earth Engine have a JSON sidecar describing the
+    job that produced them (and are verified against their ETag when
+    downloaded), so for those the sidecar is hashed, so that copying or
+    touching the file doesn't invalidate the cache. Other files are identified
+    by their path, size and modification time."""
+    st = os.stat(path)
+    json_file = os.path.splitext(path)[0] + '.json'
+    if os.path.exists(json_file):
+        with open(json_file, 'rb') as f:
+            return [st.st_size, hashlib.md5(f.read()).hexdigest()]
+    else:
+        return [os.path.abspath(path), st.st_size, st.st_mtime]
+
+
+def cache_key(*parts):
+    """Returns a cache key from a list of JSON serializable parts"""
+    return hashlib.md5(json.dumps([CACHE_VERSION] + list(parts),
+                                  sort_keys=True).encode('utf-8')).hexdigest()
+
+
+def touch(path):
+    """Marks a cached file as recently used"""
+    try:
+        os.utime(path, None)
+    except OSError:
+        pass
+
+
+def replace_file(src, dst):
+    """Renames src to dst, replacing dst if it exists
+
+    os.rename doesn't replace an existing file on Windows (and Python 2 has
+    no os.replace), so the old file is removed first. If another process 
+    writes dst between the two (such as two runs saving the same cache key, 
+    whose files have the same contents), its file is kept and src deleted."""
+    if os.path.exists(dst):
+        try:
+            os.remove(dst)
+        except OSError:
+            # Already removed (or in use) by another process
+            pass
+    try:
+        os.rename(src, dst)
+    except OSError:
+        if not os.path.exists(dst):
+            raise
+        os.remove(src)
+
+
+class StageCache(object):
+    """Disk cache for reporting stage outputs, with LRU eviction
+
+    Entries are files named by their key (see cache_key). Reading an entry
+    updates its modification time, and when the total size of the cache
+    directory (including any subfolders, such as the cached AOI masks) goes
+    over max_size the least recently used files are deleted."""
+
+    def __init__(self, cache_dir=DEFAULT_CACHE_DIR, max_size=DEFAULT_MAX_SIZE):
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+
+    def _path(self, key, suffix):
+        return os.path.join(self.cache_dir, '{}{}'.format(key, suffix))
+
+    def get_file(self, key, suffix):
+        """Returns the path to a cached file, or None if it is not cached"""
+        path = self._path(key, suffix)
+        if not os.path.exists(path):
+            return None
+        touch(path)
+        return path
+
+    def put_file(self, key, suffix, src_path):
+        """Copies a file into the cache"""
+        if not os.path.exists(self.cache_dir):
+            os.makedirs(self.cache_dir)
+        path = self._path(key, suffix)
+        # Copy to a temporary name and rename when done so a partially
+        # written file is never used
+        temp_file = path + '.{}.tmp'.format(os.getpid())
+        shutil.copyfile(src_path, temp_file)
+        replace_file(temp_file, path)
+        self.evict()
+        return path
+
+    def get_arrays(self, key, suffix='.npz'):
+        """Returns a cached dict of numpy arrays, or None if not cached"""
+        path = self.get_file(key, suffix)
+        if not path:
+            return None
+        with np.load(path) as data:
+            return dict((name, data[name]) for name in data.files)
+
+    def put_arrays(self, key, suffix, arrays):
+        """Saves a dict of numpy arrays to the cache"""
+        temp_file = os.path.join(tempfile.gettempdir(),
+                                 '{}.{}.npz'.format(key, os.getpid()))
+        np.savez_compressed(temp_file, **arrays)
+        try:
+            self.put_file(key, suffix, temp_file)
+        finally:
+            os.remove(temp_file)
+
+    def get_tables(self, key):
+        """Returns a cached list of Crosstabs, or None if it is not cached"""
+        data = self.get_arrays(key)
+        if data is None:
+            return None
+        tables = []
+        for n in range(int(data['n_tables'])):
+            n_domains = int(data['t{}_n_domains'.format(n)])
+            table = Crosstab(*[data['t{}_d{}'.format(n, i)] for i in range(n_domains)])
+            table.values[...] = data['t{}_values'.format(n)]
+            tables.append(table)
+        return tables
+
+    def put_tables(self, key, tables):
+        """Saves a list of Crosstabs to the cache"""
+        arrays = {'n_tables': len(tables)}
+        for n, table in enumerate(tables):
+            arrays['t{}_n_domains'.format(n)] = len(table.domains)
+            for i, domain in enumerate(table.domains):
+                arrays['t{}_d{}'.format(n, i)] = domain
+            arrays['t{}_values'.format(n)] = table.values
+        self.put_arrays(key, '.npz', arrays)
+
+    def evict(self):
+        """Deletes the least recently used files until under max_size"""
+        entries = []
+        for root, dirs, files in os.walk(self.cache_dir):
+            for f in files:
+                if f.endswith('.tmp'):
+                    continue
+                path = os.path.join(root, f)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((st.st_mtime, st.st_size, path))
+        total = sum(size for mtime, size, path in entries)
+        for mtime, size, path in sorted(entries):
+            if total <= self.max_size:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total -= size
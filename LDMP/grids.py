@@ -0,0 +1,934 @@
+# -*- coding: utf-8 -*-
+"""
+/***************************************************************************
+ LDMP - A QGIS plugin
+ This plugin supports monitoring and reporting of land degradation to the UNCCD
+ and in support of the SDG Land Degradation Neutrality (LDN) target.
+                              -------------------
+        begin                : 2017-05-23
+        git sha              : $Format:%H$
+        copyright            : (C) 2017 by Conservation International
+        email                : GEF-LDMP@conservation.org
+ ***************************************************************************/
+"""
+
+# Pixel grids, and reading bands from several rasters aligned on a common
+# grid, window by window and in parallel. Nothing in this module depends on
+# QGIS or Qt.
+
+import hashlib
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+from osgeo import gdal, gdal_array, osr
+
+from LDMP.tiles import get_windows, plan_windows, run_tiles, PREFETCH
+
+# Nodata value of bands read through a RasterStack - pixels that are nodata
+# in their source, or outside of it, are set to this
+NODATA = -9999
+
+# Tolerance (in pixels) when checking whether grids line up
+TOLERANCE = 1e-6
+
+# Default memory budget of the block cache in each process, in MB
+BLOCK_CACHE_MB = 64
+
+# Smallest chunk of a source band that is cached - rasters with small blocks
+# (such as single row strips) are cached several blocks at a time
+CACHE_CHUNK_PIXELS = 2**18
+
+
+# Compact class rasters (such as degradation layers written in compact mode)
+# are Byte, and flagged with this metadata item so that they are decoded to
+# their Int16 class codes when read through a RasterStack. Codes from 
+# -COMPACT_OFFSET up are stored offset by COMPACT_OFFSET, and the 9999 "No 
+# data" class and nodata have codes of their own.
+COMPACT_KEY = 'LDMP_COMPACT_CLASSES'
+COMPACT_OFFSET = 128
+COMPACT_NO_DATA_CLASS = 254
+COMPACT_NODATA = 255
+
+
+def is_compact(ds):
+    """Returns whether a dataset is a compact class raster"""
+    return ds.GetMetadataItem(COMPACT_KEY) == 'YES'
+
+
+def set_compact(ds):
+    """Flags a dataset (being written) as a compact class raster"""
+    ds.SetMetadataItem(COMPACT_KEY, 'YES')
+
+
+def compact_code(code):
+    """Returns the code a class is stored as in a compact class raster"""
+    if code == 9999:
+        return COMPACT_NO_DATA_CLASS
+    elif -COMPACT_OFFSET <= code < COMPACT_NO_DATA_CLASS - COMPACT_OFFSET:
+        return code + COMPACT_OFFSET
+    else:
+        return COMPACT_NODATA
+
+
+def get_compact_lut():
+    """Returns a lookup table from compact codes to Int16 class codes"""
+    lut = np.arange(256, dtype=np.int16) - COMPACT_OFFSET
+    lut[COMPACT_NO_DATA_CLASS] = 9999
+    lut[COMPACT_NODATA] = NODATA
+    return lut
+
+
+def encode_compact(data, flag):
+    """Returns an Int16 class array encoded as a compact (Byte) class array
+
+    Codes with no compact code (see compact_code) are stored as nodata. flag
+    is a preallocated bool array the same shape as data."""
+    out = np.empty(data.shape, dtype=np.uint8)
+    # Codes out of range wrap around here, and are fixed below
+    np.add(data, COMPACT_OFFSET, out=out, casting='unsafe')
+    np.less(data, -COMPACT_OFFSET, out=flag)
+    out[flag] = COMPACT_NODATA
+    np.greater_equal(data, COMPACT_NO_DATA_CLASS - COMPACT_OFFSET, out=flag)
+    out[flag] = COMPACT_NODATA
+    np.equal(data, 9999, out=flag)
+    out[flag] = COMPACT_NO_DATA_CLASS
+    return out
+
+
+def _is_integer(value):
+    return abs(value - round(value)) < TOLERANCE
+
+
+class GridSpec(object):
+    """A north up pixel grid: geotransform, size and CRS
+
+    Windows on a grid are (x, y, cols, rows) tuples of pixel offsets, as used
+    throughout the reporting stages."""
+
+    def __init__(self, gt, xsize, ysize, srs_wkt=''):
+        self.gt = tuple(gt)
+        self.xsize = int(xsize)
+        self.ysize = int(ysize)
+        self.srs_wkt = srs_wkt
+
+    @classmethod
+    def from_dataset(cls, ds):
+        return cls(ds.GetGeoTransform(), ds.RasterXSize, ds.RasterYSize,
+                   ds.GetProjectionRef())
+
+    @classmethod
+    def from_file(cls, path):
+        return cls.from_dataset(gdal.Open(path))
+
+    def __repr__(self):
+        return 'GridSpec({}, {}, {})'.format(self.gt, self.xsize, self.ysize)
+
+    def __eq__(self, other):
+        return (isinstance(other, GridSpec) and
+                self.xsize == other.xsize and self.ysize == other.ysize and
+                self.offset(other) == (0, 0) and self.same_crs(other))
+
+    def __ne__(self, other):
+        return not self == other
+
+    def key(self):
+        """Returns a JSON serializable description of the grid"""
+        return [list(self.gt), self.xsize, self.ysize, self.srs_wkt]
+
+    @property
+    def res(self):
+        """(pixel width, pixel height) - the height is negative"""
+        return self.gt[1], self.gt[5]
+
+    @property
+    def bounds(self):
+        """(left, bottom, right, top)"""
+        return (self.gt[0], self.gt[3] + self.ysize * self.gt[5],
+                self.gt[0] + self.xsize * self.gt[1], self.gt[3])
+
+    def same_crs(self, other):
+        if not self.srs_wkt or not other.srs_wkt:
+            return True
+        srs = osr.SpatialReference()
+        srs.ImportFromWkt(self.srs_wkt)
+        other_srs = osr.SpatialReference()
+        other_srs.ImportFromWkt(other.srs_wkt)
+        return bool(srs.IsSame(other_srs))
+
+    def snap(self, left, bottom, right, top):
+        """Returns a grid on the pixels of this one covering a bounding box
+
+        The box is expanded outwards to the nearest pixel edges, so the new
+        grid lines up exactly with this one (it can extend beyond it)."""
+        gt = self.gt
+        x0 = int(np.floor((left - gt[0]) / gt[1] + TOLERANCE))
+        x1 = int(np.ceil((right - gt[0]) / gt[1] - TOLERANCE))
+        y0 = int(np.floor((top - gt[3]) / gt[5] + TOLERANCE))
+        y1 = int(np.ceil((bottom - gt[3]) / gt[5] - TOLERANCE))
+        return self.subgrid((x0, y0, max(1, x1 - x0), max(1, y1 - y0)))
+
+    def subgrid(self, window):
+        """Returns the grid of a window of this grid"""
+        x, y, cols, rows = window
+        gt = self.gt
+        return GridSpec((gt[0] + x * gt[1], gt[1], gt[2],
+                         gt[3] + y * gt[5], gt[4], gt[5]),
+                        cols, rows, self.srs_wkt)
+
+    def window_for_bounds(self, left, bottom, right, top):
+        """Returns the window of this grid covering a bounding box (clipped
+        to the grid), or None if they don't overlap"""
+        sub = self.snap(left, bottom, right, top)
+        x, y = self.offset(sub)
+        x0, y0 = max(0, x), max(0, y)
+        x1, y1 = min(self.xsize, x + sub.xsize), min(self.ysize, y + sub.ysize)
+        if x1 <= x0 or y1 <= y0:
+            return None
+        return x0, y0, x1 - x0, y1 - y0
+
+    def intersection(self, other):
+        """Returns the part of this grid overlapping another, or None"""
+        left, bottom, right, top = other.bounds
+        window = self.window_for_bounds(left, bottom, right, top)
+        if window is None:
+            return None
+        return self.subgrid(window)
+
+    def offset(self, other):
+        """Returns the (x, y) position of the origin of another grid in pixels
+        of this one, if the grids have the same resolution and line up, or
+        otherwise None"""
+        gt, other_gt = self.gt, other.gt
+        if (abs(gt[1] - other_gt[1]) > TOLERANCE * abs(gt[1]) or
+                abs(gt[5] - other_gt[5]) > TOLERANCE * abs(gt[5])):
+            return None
+        x = (other_gt[0] - gt[0]) / gt[1]
+        y = (other_gt[3] - gt[3]) / gt[5]
+        if not _is_integer(x) or not _is_integer(y):
+            return None
+        return int(round(x)), int(round(y))
+
+    def index_maps(self, src, window):
+        """Returns nearest neighbour index maps from a window of this grid to
+        another (source) grid
+
+        Returns (cols, rows): for each column and row of the window, the
+        column or row of the source pixel containing its centre, or -1 where
+        the centre is outside the source grid."""
+        x, y, n_cols, n_rows = window
+        gt, src_gt = self.gt, src.gt
+        centres_x = gt[0] + (x + np.arange(n_cols) + 0.5) * gt[1]
+        centres_y = gt[3] + (y + np.arange(n_rows) + 0.5) * gt[5]
+        cols = np.floor((centres_x - src_gt[0]) / src_gt[1]).astype(np.int64)
+        rows = np.floor((centres_y - src_gt[3]) / src_gt[5]).astype(np.int64)
+        cols[(cols < 0) | (cols >= src.xsize)] = -1
+        rows[(rows < 0) | (rows >= src.ysize)] = -1
+        return cols, rows
+
+
+def read_aligned(band, src, dst, window, out, fill):
+    """Reads a window of a destination grid from a band on a source grid
+
+    If the grids have the same resolution and line up, the window is read
+    directly (at an integer pixel offset). Otherwise the nearest source pixel
+    is used for each destination pixel. Pixels outside the source are set to
+    fill. out is a 2D array the size of the window."""
+    x, y, cols, rows = window
+    offset = src.offset(dst)
+    if offset is not None:
+        sx, sy = x + offset[0], y + offset[1]
+        x0, y0 = max(0, sx), max(0, sy)
+        x1, y1 = min(src.xsize, sx + cols), min(src.ysize, sy + rows)
+        if (x0, y0, x1, y1) == (sx, sy, sx + cols, sy + rows):
+            band.ReadAsArray(sx, sy, cols, rows, buf_obj=out)
+            return out
+        out.fill(fill)
+        if x1 > x0 and y1 > y0:
+            out[y0 - sy:y1 - sy, x0 - sx:x1 - sx] = band.ReadAsArray(x0, y0, x1 - x0, y1 - y0)
+        return out
+
+    src_cols, src_rows = dst.index_maps(src, window)
+    col_valid = src_cols >= 0
+    row_valid = src_rows >= 0
+    out.fill(fill)
+    if not col_valid.any() or not row_valid.any():
+        return out
+    # Read the source window covering all of the pixels needed, then pick
+    # the nearest pixel for each destination pixel
+    c0, c1 = src_cols[col_valid].min(), src_cols[col_valid].max() + 1
+    r0, r1 = src_rows[row_valid].min(), src_rows[row_valid].max() + 1
+    data = band.ReadAsArray(int(c0), int(r0), int(c1 - c0), int(r1 - r0))
+    out[np.ix_(row_valid, col_valid)] = data[np.ix_(src_rows[row_valid] - r0,
+                                                    src_cols[col_valid] - c0)]
+    return out
+
+
+def source_window(src, dst, window):
+    """Returns the (x, y, cols, rows) window of a source grid that
+    read_aligned reads for a window of a destination grid, or None if the
+    window is entirely outside the source"""
+    x, y, cols, rows = window
+    offset = src.offset(dst)
+    if offset is not None:
+        sx, sy = x + offset[0], y + offset[1]
+        x0, y0 = max(0, sx), max(0, sy)
+        x1, y1 = min(src.xsize, sx + cols), min(src.ysize, sy + rows)
+    else:
+        src_cols, src_rows = dst.index_maps(src, window)
+        src_cols = src_cols[src_cols >= 0]
+        src_rows = src_rows[src_rows >= 0]
+        if not src_cols.size or not src_rows.size:
+            return None
+        x0, x1 = int(src_cols.min()), int(src_cols.max()) + 1
+        y0, y1 = int(src_rows.min()), int(src_rows.max()) + 1
+    if x1 <= x0 or y1 <= y0:
+        return None
+    return x0, y0, x1 - x0, y1 - y0
+
+
+def read_block_digests(path, band_n):
+    """Returns an md5 digest of the stored bytes of each block of a band of a
+    GeoTIFF
+
+    The blocks are hashed as they are stored (compressed), without decoding
+    them, so comparing digests is a cheap test of which blocks have changed.
+    Returns a (y blocks, x blocks, 16) uint8 array, or None if the raster
+    isn't a GeoTIFF that GDAL reports the block offsets of."""
+    ds = gdal.Open(path)
+    if ds is None or ds.GetDriver().ShortName != 'GTiff':
+        return None
+    band = ds.GetRasterBand(band_n)
+    x_block_size, y_block_size = band.GetBlockSize()
+    n_x = (ds.RasterXSize + x_block_size - 1) // x_block_size
+    n_y = (ds.RasterYSize + y_block_size - 1) // y_block_size
+    digests = np.zeros((n_y, n_x, 16), dtype=np.uint8)
+    f = gdal.VSIFOpenL(path, 'rb')
+    if f is None:
+        return None
+    try:
+        for by in range(n_y):
+            for bx in range(n_x):
+                offset = band.GetMetadataItem('BLOCK_OFFSET_{}_{}'.format(bx, by), 'TIFF')
+                size = band.GetMetadataItem('BLOCK_SIZE_{}_{}'.format(bx, by), 'TIFF')
+                if offset is None or size is None:
+                    return None
+                md5 = hashlib.md5()
+                # Blocks that were never written (sparse) have no bytes
+                if int(size) > 0:
+                    gdal.VSIFSeekL(f, int(offset), 0)
+                    md5.update(gdal.VSIFReadL(1, int(size), f))
+                digests[by, bx] = np.frombuffer(md5.digest(), dtype=np.uint8)
+    finally:
+        gdal.VSIFCloseL(f)
+    return digests
+
+
+def get_source_block_size(ds):
+    """Returns the block size of the data underlying the first band of ds
+
+    For VRTs and RasterStacks (such as the aligned reporting stacks) this is
+    the block size of the first source file, rather than the nominal block
+    size of the VRT."""
+    if isinstance(ds, RasterStack):
+        return ds.GetRasterBand(1).GetBlockSize()
+    if ds.GetDriver().ShortName == 'VRT':
+        for f in (ds.GetFileList() or [])[1:]:
+            src_ds = gdal.Open(f)
+            if src_ds is not None:
+                return get_source_block_size(src_ds)
+    return ds.GetRasterBand(1).GetBlockSize()
+
+
+def get_stage_windows(ds, work_bytes, n_workers=1, memory_mb=None):
+    """Plans the windows for a stage that reads every band of ds
+
+    Windows are aligned to the blocks of the underlying data, and sized so 
+    that all of the windows in memory at once (in each worker, read ahead or 
+    waiting to be written) fit in memory_mb."""
+    bytes_per_pixel = work_bytes
+    for n in range(ds.RasterCount):
+        bytes_per_pixel += gdal.GetDataTypeSize(ds.GetRasterBand(n + 1).DataType) // 8
+    x_block_size, y_block_size = get_source_block_size(ds)
+    return plan_windows(ds.RasterXSize, ds.RasterYSize, x_block_size,
+                        y_block_size, bytes_per_pixel, memory_mb,
+                        n_workers + 2 * PREFETCH)
+
+
+# Largest number of pixels sampled to estimate percentiles of bands that are 
+# not small integers
+PERCENTILE_SAMPLE = 2**20
+
+
+def get_percentiles(band, percentiles, exclude=9999):
+    """Returns percentiles of the values of a band, ignoring exclude
+
+    The band is read block by block into one reused buffer. Integer bands of 
+    up to 16 bits are counted into a histogram, so the percentiles are exact 
+    (interpolated as by np.percentile) without holding every value in 
+    memory; for other bands they are estimated from a sample of about 
+    PERCENTILE_SAMPLE pixels. Returns None if there are no values other than 
+    exclude."""
+    dtype = np.dtype(gdal_array.GDALTypeCodeToNumericTypeCode(band.DataType))
+    windows = get_windows(band.XSize, band.YSize, *band.GetBlockSize())
+    buf = np.empty(max(cols * rows for x, y, cols, rows in windows), dtype=dtype)
+    histogram = dtype.kind in 'iu' and dtype.itemsize <= 2
+    if histogram:
+        # Signed values are counted by their unsigned bit patterns, and the 
+        # counts rotated into order afterwards
+        unsigned = np.dtype('u{}'.format(dtype.itemsize))
+        n_values = 2**(8 * dtype.itemsize)
+        counts = np.zeros(n_values, dtype=np.int64)
+    else:
+        step = max(1, band.XSize * band.YSize // PERCENTILE_SAMPLE)
+        samples = []
+    for x, y, cols, rows in windows:
+        block = buf[:cols * rows].reshape(rows, cols)
+        band.ReadAsArray(x, y, cols, rows, buf_obj=block)
+        if histogram:
+            counts += np.bincount(block.view(unsigned).ravel(),
+                                  minlength=n_values)
+        else:
+            sample = block.ravel()[::step]
+            samples.append(sample[np.isfinite(sample) & (sample != exclude)])
+
+    if not histogram:
+        values = np.concatenate(samples)
+        if values.size == 0:
+            return None
+        return np.percentile(values, percentiles)
+
+    low = int(np.iinfo(dtype).min)
+    if low < 0:
+        counts = np.roll(counts, -low)
+    if low <= exclude < low + n_values:
+        counts[exclude - low] = 0
+    n = counts.sum()
+    if n == 0:
+        return None
+    cum = np.cumsum(counts)
+
+    def nth(k):
+        # The k-th smallest value (from 0)
+        return np.searchsorted(cum, k, side='right') + low
+
+    result = []
+    for p in np.atleast_1d(percentiles):
+        pos = p / 100. * (n - 1)
+        below = int(np.floor(pos))
+        value = nth(below)
+        if pos > below:
+            value = value + (pos - below) * (nth(below + 1) - value)
+        result.append(value)
+    return np.array(result, dtype=np.float64)
+
+
+class BlockCache(object):
+    """A least recently used cache of decoded chunks of source bands
+
+    There is one cache in each process (see get_block_cache), shared by every
+    RasterStack read in that process, so that blocks read by more than one
+    stage, region or window are only decoded once. Chunks are keyed by
+    (source, band, x, y), where source identifies the file and its
+    modification time, so rewritten files are never read from the cache. The
+    cache keeps to a memory budget of max_mb, dropping the least recently
+    used chunks first, and counts hits and misses to help size it."""
+
+    def __init__(self, max_mb=BLOCK_CACHE_MB):
+        self._lock = threading.Lock()
+        self._chunks = OrderedDict()
+        self.nbytes = 0
+        self.max_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.resize(max_mb)
+
+    def resize(self, max_mb):
+        """Sets the memory budget (0 disables the cache)"""
+        with self._lock:
+            self.max_bytes = int(max_mb * 1024 * 1024)
+            self._evict()
+
+    def __contains__(self, key):
+        return key in self._chunks
+
+    def get(self, key):
+        """Returns a chunk, or None if it isn't cached"""
+        with self._lock:
+            chunk = self._chunks.pop(key, None)
+            if chunk is None:
+                self.misses += 1
+                return None
+            # Move the chunk to the most recently used end
+            self._chunks[key] = chunk
+            self.hits += 1
+            return chunk
+
+    def put(self, key, chunk):
+        if chunk.nbytes > self.max_bytes:
+            return
+        # Chunks are shared by every reader, so must not be changed
+        chunk.flags.writeable = False
+        with self._lock:
+            old = self._chunks.pop(key, None)
+            if old is not None:
+                self.nbytes -= old.nbytes
+            self._chunks[key] = chunk
+            self.nbytes += chunk.nbytes
+            self._evict()
+
+    def _evict(self):
+        while self.nbytes > self.max_bytes and self._chunks:
+            key, chunk = self._chunks.popitem(last=False)
+            self.nbytes -= chunk.nbytes
+            self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._chunks.clear()
+            self.nbytes = 0
+
+    def take_counts(self):
+        """Returns (hits, misses, evictions) since the last call, and
+        resets them"""
+        with self._lock:
+            counts = (self.hits, self.misses, self.evictions)
+            self.hits = self.misses = self.evictions = 0
+        return counts
+
+    def add_counts(self, counts):
+        """Adds (hits, misses, evictions) counted in another process"""
+        with self._lock:
+            self.hits += counts[0]
+            self.misses += counts[1]
+            self.evictions += counts[2]
+
+    def stats(self):
+        """Returns a dict of the counters and memory use of the cache"""
+        return {'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'mb': self.nbytes / (1024. * 1024),
+                'max_mb': self.max_bytes / (1024. * 1024)}
+
+    def summary(self):
+        return ('{hits} hits, {misses} misses, {evictions} evictions '
+                '({mb:.0f} of {max_mb:.0f} MB used)').format(**self.stats())
+
+
+_block_cache = BlockCache()
+
+
+def get_block_cache():
+    """Returns the BlockCache for this process"""
+    return _block_cache
+
+
+def _get_source_version(path):
+    """Returns a key identifying the current version of a file, or None if
+    it isn't a file (so shouldn't be cached)"""
+    stat = gdal.VSIStatL(path)
+    if stat is None:
+        return None
+    return path, stat.mtime, stat.size
+
+
+class CachedBand(object):
+    """Reads windows of a GDAL band through the block cache
+
+    The band is read in chunks of whole blocks. When a chunk is read from
+    the file, the same chunk of the sibling bands (other bands of the same
+    dataset that will also be read) is cached too, while GDAL still has the
+    blocks decoded - for pixel interleaved files, such as the multi-band land
+    cover layer, this decodes each block once rather than once per band."""
+
+    def __init__(self, ds, band_n, version, siblings=()):
+        self.ds = ds
+        self.band = ds.GetRasterBand(band_n)
+        self.band_n = band_n
+        self.version = version
+        self.siblings = [n for n in siblings if n != band_n]
+        x_block_size, y_block_size = self.band.GetBlockSize()
+        x_block_size = min(x_block_size, ds.RasterXSize)
+        self.chunk_cols = x_block_size
+        self.chunk_rows = y_block_size * max(1, CACHE_CHUNK_PIXELS // (x_block_size * y_block_size))
+
+    def _read_chunk(self, cache, band_n, x, y):
+        cols = min(self.chunk_cols, self.ds.RasterXSize - x)
+        rows = min(self.chunk_rows, self.ds.RasterYSize - y)
+        chunk = self.ds.GetRasterBand(band_n).ReadAsArray(x, y, cols, rows)
+        cache.put((self.version, band_n, x, y), chunk)
+        return chunk
+
+    def _get_chunk(self, cache, x, y):
+        chunk = cache.get((self.version, self.band_n, x, y))
+        if chunk is None:
+            chunk = self._read_chunk(cache, self.band_n, x, y)
+            for band_n in self.siblings:
+                if (self.version, band_n, x, y) not in cache:
+                    self._read_chunk(cache, band_n, x, y)
+        return chunk
+
+    def ReadAsArray(self, x, y, cols, rows, buf_obj=None):
+        cache = get_block_cache()
+        if self.version is None or cache.max_bytes <= 0:
+            return self.band.ReadAsArray(x, y, cols, rows, buf_obj=buf_obj)
+        if buf_obj is None:
+            buf_obj = np.empty((rows, cols),
+                               dtype=gdal_array.GDALTypeCodeToNumericTypeCode(self.band.DataType))
+        x_start = x - x % self.chunk_cols
+        y_start = y - y % self.chunk_rows
+        for chunk_y in range(y_start, y + rows, self.chunk_rows):
+            for chunk_x in range(x_start, x + cols, self.chunk_cols):
+                chunk = self._get_chunk(cache, chunk_x, chunk_y)
+                # Copy the part of the chunk inside the window
+                x0, y0 = max(x, chunk_x), max(y, chunk_y)
+                x1 = min(x + cols, chunk_x + chunk.shape[1])
+                y1 = min(y + rows, chunk_y + chunk.shape[0])
+                buf_obj[y0 - y:y1 - y, x0 - x:x1 - x] = \
+                    chunk[y0 - chunk_y:y1 - chunk_y, x0 - chunk_x:x1 - chunk_x]
+        return buf_obj
+
+
+class StackBand(object):
+    """One band of a RasterStack, read like a GDAL band
+
+    Reads go through the block cache (see BlockCache), and compact class
+    rasters are decoded to their Int16 class codes (see is_compact)."""
+
+    def __init__(self, stack, n):
+        self.stack = stack
+        self.n = n
+        path, band_n, src_nodata = stack.sources[n]
+        self.path = path
+        self.band_n = band_n
+        self.src_nodata = src_nodata
+        self._ds = None
+        self._buf = None
+        self._raw = None
+
+    def _open(self):
+        if self._ds is None:
+            self._ds = self.stack._open_source(self.path)
+            self.src = GridSpec.from_dataset(self._ds)
+            self.src_band = self._ds.GetRasterBand(self.band_n)
+            self.reader = CachedBand(self._ds, self.band_n,
+                                     _get_source_version(self.path),
+                                     self.stack._get_bands_of(self.path))
+            if is_compact(self._ds):
+                # Read as Byte, and decoded to Int16 (nodata included)
+                self.decode = get_compact_lut()
+                self.src_nodata = None
+                self.dtype = np.int16
+            else:
+                self.decode = None
+                if self.src_nodata is None:
+                    self.src_nodata = self.src_band.GetNoDataValue()
+                self.dtype = gdal_array.GDALTypeCodeToNumericTypeCode(self.src_band.DataType)
+            self.fill = NODATA
+            if np.issubdtype(self.dtype, np.integer):
+                # If NODATA doesn't fit in the type of the band, use the
+                # closest value that does (as a VRT would)
+                info = np.iinfo(self.dtype)
+                self.fill = int(min(max(NODATA, info.min), info.max))
+        return self.src_band
+
+    @property
+    def DataType(self):
+        return self._open().DataType
+
+    @property
+    def XSize(self):
+        return self.stack.grid.xsize
+
+    @property
+    def YSize(self):
+        return self.stack.grid.ysize
+
+    def GetBlockSize(self):
+        return self._open().GetBlockSize()
+
+    def source_window(self, window):
+        """Returns the window of the source band read for a window of the
+        stack (see source_window), or None if none of it is read"""
+        self._open()
+        return source_window(self.src, self.stack.grid, window)
+
+    def GetNoDataValue(self):
+        self._open()
+        return self.fill
+
+    def buffer(self, rows, cols):
+        """Returns a (rows, cols) array in the type of the band, as a view of
+        a buffer that is reused by the next call"""
+        self._open()
+        n = rows * cols
+        if self._buf is None or self._buf.size < n:
+            self._buf = np.empty(n, dtype=self.dtype)
+        return self._buf[:n].reshape(rows, cols)
+
+    def ReadAsArray(self, x=0, y=0, cols=None, rows=None, buf_obj=None):
+        self._open()
+        if cols is None:
+            cols = self.XSize - x
+        if rows is None:
+            rows = self.YSize - y
+        if buf_obj is None:
+            buf_obj = np.empty((rows, cols), dtype=self.dtype)
+        if buf_obj.dtype != self.dtype:
+            out = np.empty((rows, cols), dtype=self.dtype)
+        else:
+            out = buf_obj
+        if self.decode is not None:
+            n = rows * cols
+            if self._raw is None or self._raw.size < n:
+                self._raw = np.empty(n, dtype=np.uint8)
+            raw = self._raw[:n].reshape(rows, cols)
+            read_aligned(self.reader, self.src, self.stack.grid,
+                         (x, y, cols, rows), raw, COMPACT_NODATA)
+            np.take(self.decode, raw, out=out)
+        else:
+            read_aligned(self.reader, self.src, self.stack.grid,
+                         (x, y, cols, rows), out, self.fill)
+        if self.src_nodata is not None and self.src_nodata != self.fill:
+            out[out == self.src_nodata] = self.fill
+        if out is not buf_obj:
+            np.copyto(buf_obj, out, casting='unsafe')
+        return buf_obj
+
+
+class RasterStack(object):
+    """Bands from one or more rasters, aligned on a common grid
+
+    sources is a list of (path, band) or (path, band, nodata) references,
+    where nodata overrides the nodata value of the source band. Each band is
+    read directly from its source raster onto grid (see read_aligned), with
+    no VRT in between. A RasterStack can be used in place of a GDAL dataset
+    by the reporting stages (it has the same GetGeoTransform, GetRasterBand,
+    ReadAsArray etc. methods), and can be pickled to send to worker
+    processes - datasets are only opened when first read, in each
+    process, and bands from the same file share one dataset.
+
+    Stages written against a RasterStack read it a window at a time with
+    iter_windows, or in parallel with map_reduce, so that planning, reading
+    and masking windows is done the same way for every stage."""
+
+    def __init__(self, grid, sources):
+        self.grid = grid
+        self.sources = [tuple(s) + (None,) * (3 - len(s)) for s in sources]
+        self._bands = None
+        self._datasets = {}
+
+    def __getstate__(self):
+        # The block cache budget goes with the stack, so that worker
+        # processes use the same budget as the process that sent it
+        return {'grid': self.grid, 'sources': self.sources,
+                'block_cache_mb': get_block_cache().max_bytes / (1024. * 1024)}
+
+    def __setstate__(self, state):
+        self.__init__(state['grid'], state['sources'])
+        if 'block_cache_mb' in state:
+            get_block_cache().resize(state['block_cache_mb'])
+
+    def _open_source(self, path):
+        if path not in self._datasets:
+            self._datasets[path] = gdal.Open(path)
+        return self._datasets[path]
+
+    def _get_bands_of(self, path):
+        return sorted(set(band_n for p, band_n, nodata in self.sources
+                          if p == path))
+
+    def __repr__(self):
+        return 'RasterStack({!r}, {!r})'.format(self.grid, self.sources)
+
+    def key(self):
+        """Returns a JSON serializable description of the stack"""
+        return [self.grid.key(), [list(s) for s in self.sources]]
+
+    @classmethod
+    def from_file(cls, path, bands=None):
+        """Returns a stack of bands (numbered from 1, or all of them by
+        default) of a raster, on its own grid"""
+        ds = gdal.Open(path)
+        if bands is None:
+            bands = range(1, ds.RasterCount + 1)
+        return cls(GridSpec.from_dataset(ds), [(path, n) for n in bands])
+
+    def window(self, window):
+        """Returns a stack of the same bands on a window of the grid"""
+        return RasterStack(self.grid.subgrid(window), self.sources)
+
+    def select(self, bands):
+        """Returns a view of some of the bands (numbered from 1) of the stack
+
+        The view shares the bands of this stack, with their open datasets and
+        buffers, rather than opening them again."""
+        view = RasterStack(self.grid, [self.sources[n - 1] for n in bands])
+        view._bands = [self.GetRasterBand(n) for n in bands]
+        return view
+
+    def windows(self, work_bytes=0, n_workers=1, memory_mb=None):
+        """Plans the windows to read the stack in (see get_stage_windows)"""
+        return get_stage_windows(self, work_bytes, n_workers, memory_mb)
+
+    def read_window(self, window):
+        """Reads every band of the stack for a window
+
+        Returns a list of (rows, cols) arrays, one per band, each in the type
+        of its band (so compact bands such as Byte are not widened). The
+        arrays are views of buffers that are reused by the next read, so
+        should be copied if they need to be kept."""
+        x, y, cols, rows = window
+        return [band.ReadAsArray(x, y, cols, rows,
+                                 buf_obj=band.buffer(rows, cols))
+                for band in self._get_bands()]
+
+    def iter_windows(self, windows=None):
+        """Yields (window, bands) for each window (all of the windows of the
+        stack by default - see windows), with the bands from read_window"""
+        if windows is None:
+            windows = self.windows()
+        for window in windows:
+            yield window, self.read_window(window)
+
+    def map_reduce(self, func, reduce, initial, tasks=None, mask_file=None,
+                   init=None, init_args=(), n_workers=1, callback=None):
+        """Applies a function to windows of the stack, and combines the
+        results
+
+        func(window, bands, mask) is called for each task, in n_workers
+        worker processes, with the bands from read_window. mask is the mask
+        for the window from mask_file (a 0/1 raster on the same grid) as a
+        bool array, or None if there is no mask_file or the window needs no
+        per-pixel masking. tasks is a list of (window, edge) pairs, where
+        edge is True if the window needs masking (every window of the stack,
+        unmasked, by default). init(*init_args) is called once in each
+        worker before any tasks, to set up any state that func needs. func,
+        init and reduce must be module level functions (see
+        tiles.run_tiles).
+
+        The results are combined in this process, in the order they finish,
+        as value = reduce(value, result) starting from initial. Returns the
+        final value, or None if cancelled through the (GDAL-style)
+        callback."""
+        if tasks is None:
+            tasks = [(window, False) for window in self.windows(n_workers=n_workers)]
+        value = initial
+        done = 0
+        tiles = run_tiles(_map_tile,
+                          [(func, window, edge) for window, edge in tasks],
+                          _init_map, (self, mask_file, init, init_args),
+                          n_workers, callback)
+        cache = get_block_cache()
+        try:
+            for result, counts in tiles:
+                cache.add_counts(counts)
+                value = reduce(value, result)
+                done += 1
+        finally:
+            tiles.close()
+            _map_state.clear()
+        if done < len(tasks):
+            return None
+        return value
+
+    def _get_bands(self):
+        if self._bands is None:
+            self._bands = [StackBand(self, i) for i in range(len(self.sources))]
+        return self._bands
+
+    @property
+    def RasterXSize(self):
+        return self.grid.xsize
+
+    @property
+    def RasterYSize(self):
+        return self.grid.ysize
+
+    @property
+    def RasterCount(self):
+        return len(self.sources)
+
+    def GetGeoTransform(self):
+        return self.grid.gt
+
+    def GetProjectionRef(self):
+        return self.grid.srs_wkt
+
+    def GetRasterBand(self, n):
+        return self._get_bands()[n - 1]
+
+    def ReadAsArray(self, x=0, y=0, cols=None, rows=None, buf_obj=None):
+        if cols is None:
+            cols = self.RasterXSize - x
+        if rows is None:
+            rows = self.RasterYSize - y
+        if buf_obj is None:
+            band = self.GetRasterBand(1)
+            band._open()
+            buf_obj = np.empty((self.RasterCount, rows, cols), dtype=band.dtype)
+        for n in range(self.RasterCount):
+            self.GetRasterBand(n + 1).ReadAsArray(x, y, cols, rows,
+                                                  buf_obj=buf_obj[n])
+        return buf_obj
+
+
+def open_raster(raster):
+    """Opens a raster given as a path, or returns a RasterStack unchanged"""
+    if isinstance(raster, RasterStack):
+        return raster
+    return gdal.Open(raster)
+
+
+def as_stack(raster):
+    """Returns a RasterStack of every band of a raster given as a path, or
+    returns a RasterStack unchanged"""
+    if isinstance(raster, RasterStack):
+        return raster
+    return RasterStack.from_file(raster)
+
+
+# State for map_reduce in each worker process
+_map_state = {}
+
+
+def _init_map(stack, mask_file, init, init_args):
+    _map_state.clear()
+    # Workers forked from this process inherit the stack with any datasets
+    # already opened by the parent (for example while planning windows), and
+    # reading through shared file handles from several processes returns the
+    # wrong bytes - so rebuild the stack to open its own datasets
+    _map_state['stack'] = RasterStack(stack.grid, stack.sources)
+    if mask_file:
+        _map_state['mask_ds'] = gdal.Open(mask_file)
+    if init:
+        init(*init_args)
+
+
+def _read_mask(window):
+    x, y, cols, rows = window
+    n = cols * rows
+    buf = _map_state.get('mask')
+    if buf is None or buf.size < n:
+        buf = np.empty(n, dtype=np.uint8)
+        _map_state['mask'] = buf
+    mask = buf[:n].reshape(rows, cols)
+    _map_state['mask_ds'].GetRasterBand(1).ReadAsArray(x, y, cols, rows,
+                                                      buf_obj=mask)
+    # The mask is stored as 0/1, so can be viewed as bool without a copy
+    return mask.view(bool)
+
+
+def _map_tile(task):
+    func, window, edge = task
+    if edge and 'mask_ds' in _map_state:
+        mask = _read_mask(window)
+    else:
+        mask = None
+    result = func(window, _map_state['stack'].read_window(window), mask)
+    # Block cache counters go back with each result, so they can be totalled
+    # in the parent process
+    return result, get_block_cache().take_counts()
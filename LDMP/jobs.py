@@ -13,12 +13,12 @@
 """
 
 import os
+import re
 import json
 
 import datetime
 from math import floor, log10
 
-import numpy as np
 from osgeo import gdal
 
 from PyQt4 import QtGui
@@ -36,8 +36,11 @@ from LDMP.gui.DlgJobsDetails import Ui_DlgJobsDetails
 from LDMP.plot import DlgPlotTimeries
 
 from LDMP import log
+from LDMP.grids import get_percentiles
+from LDMP.profiles import optimise_task
 from LDMP.download import Download, check_hash_against_etag
 from LDMP.api import get_script, get_user_email, get_execution
+from LDMP.worker import AbstractWorker, StartWorker
 
 
 def json_serial(obj):
@@ -295,6 +298,41 @@ class JobsTableModel(QAbstractTableModel):
         return QAbstractTableModel.headerData(self, section, orientation, role)
 
 
+class OptimiseWorker(AbstractWorker):
+    def __init__(self, in_file, profile):
+        AbstractWorker.__init__(self)
+        self.in_file = in_file
+        self.profile = profile
+
+    def work(self):
+        self.toggle_show_progress.emit(True)
+        self.toggle_show_cancel.emit(True)
+
+        out_file, error = optimise_task(self.in_file, self.profile,
+                                        callback=self.progress_callback)
+
+        if error:
+            log("Failed to optimise {}:\n{}".format(self.in_file, error), 2)
+            return None
+        elif self.killed or not out_file:
+            log("Optimising {} killed by user.".format(self.in_file))
+            return None
+        else:
+            log("Optimised copy of {} saved to {}".format(self.in_file, out_file))
+            self.progress.emit(100)
+            return out_file
+
+
+def optimise_download(outfile):
+    """Writes an optimised copy of a downloaded result
+
+    Runs on a worker thread (with a progress bar, and can be cancelled) - 
+    later reporting runs use the copy once it is complete."""
+    profile = QSettings().value("LDMP/optimise_downloads_profile", 'tiled')
+    StartWorker(OptimiseWorker, 'optimising {}'.format(os.path.basename(outfile)),
+                outfile, profile)
+
+
 def download_result(url, outfile, job):
     log("Downloading {}".format(url))
     worker = Download(url, outfile)
@@ -306,22 +344,60 @@ def download_result(url, outfile, job):
         return None
 
 
+def mosaic_tiles(tiles, job):
+    """Mosaics the tiles of a dataset exported in pieces into one VRT
+
+    The VRT is saved alongside the tiles (named after the part of the tile 
+    names they have in common) with its own JSON sidecar, so it can be 
+    styled and used for reporting as a single layer."""
+    # Earth Engine adds the offset of each tile to its name, as -<row>-<column>
+    names = [re.sub(r'[-_]\d+-\d+$', '', os.path.splitext(os.path.basename(f))[0])
+             for f in tiles]
+    prefix = os.path.commonprefix(names).rstrip('-_')
+    if not prefix:
+        prefix = names[0]
+    outfile = os.path.join(os.path.dirname(tiles[0]), prefix + '.vrt')
+    log("Mosaicking {} tiles into {}".format(len(tiles), outfile))
+    gdal.BuildVRT(outfile, tiles)
+    create_json_metadata(job, outfile)
+    return outfile
+
+
+def download_dataset(job, dataset, download_dir):
+    """Downloads all of the files of a dataset
+
+    Returns the file to use for the dataset - the downloaded file, or a 
+    mosaic of them if the dataset was exported in several tiles - or None if 
+    a download failed."""
+    tiles = []
+    for url in dataset.get('urls'):
+        outfile = os.path.join(download_dir, url['url'].rsplit('/', 1)[-1])
+        if not download_result(url['url'], outfile, job):
+            return None
+        tiles.append(outfile)
+    if len(tiles) == 1:
+        outfile = tiles[0]
+    else:
+        outfile = mosaic_tiles(tiles, job)
+    if QSettings().value("LDMP/optimise_downloads", False, type=bool):
+        optimise_download(outfile)
+    return outfile
+
+
 def download_land_cover(job, download_dir):
     log("downloading land_cover results...")
     for dataset in job['results'].get('datasets'):
-        for url in dataset.get('urls'):
-            outfile = os.path.join(download_dir, url['url'].rsplit('/', 1)[-1])
-            resp = download_result(url['url'], outfile, job)
-            if not resp:
+        if dataset['dataset'] == 'land_cover':
+            outfile = download_dataset(job, dataset, download_dir)
+            if not outfile:
                 return
-            if dataset['dataset'] == 'land_cover':
-                style_land_cover(outfile, 1, 'Land cover (baseline)')
-                style_land_cover(outfile, 2, 'Land cover (target)')
-                # TODO: Fix color coding of transition layer.
-                #style_land_cover_transition(outfile)
-                style_land_cover_land_deg(outfile)
-            else:
-                raise ValueError("Unrecognized dataset type in download results: {}".format(dataset['dataset']))
+            style_land_cover(outfile, 1, 'Land cover (baseline)')
+            style_land_cover(outfile, 2, 'Land cover (target)')
+            # TODO: Fix color coding of transition layer.
+            #style_land_cover_transition(outfile)
+            style_land_cover_land_deg(outfile)
+        else:
+            raise ValueError("Unrecognized dataset type in download results: {}".format(dataset['dataset']))
 
 
 def style_land_cover(outfile, band, title):
@@ -425,17 +501,15 @@ def style_land_cover_land_deg(outfile):
 def download_prod_traj(job, download_dir):
     log("Downloading productivity_trajectory results...")
     for dataset in job['results'].get('datasets'):
-        for url in dataset.get('urls'):
-            if dataset['dataset'] in ['ndvi_trend', 'ue', 'p_restrend']:
-                #TODO style layer and set layer name based on the info in the dataset json file
-                outfile = os.path.join(download_dir, url['url'].rsplit('/', 1)[-1])
-                resp = download_result(url['url'], outfile, job)
-                if not resp:
-                    return
-                style_prod_traj_trend(outfile)
-                style_prod_traj_signif(outfile)
-            else:
-                raise ValueError("Unrecognized dataset type in download results: {}".format(dataset['dataset']))
+        if dataset['dataset'] in ['ndvi_trend', 'ue', 'p_restrend']:
+            #TODO style layer and set layer name based on the info in the dataset json file
+            outfile = download_dataset(job, dataset, download_dir)
+            if not outfile:
+                return
+            style_prod_traj_trend(outfile)
+            style_prod_traj_signif(outfile)
+        else:
+            raise ValueError("Unrecognized dataset type in download results: {}".format(dataset['dataset']))
 
 
 def style_prod_traj_trend(outfile):
@@ -449,10 +523,11 @@ def style_prod_traj_trend(outfile):
     # Set a colormap centred on zero, going to the extreme value significant to
     # three figures (after a 2 percent stretch)
     ds = gdal.Open(outfile)
-    band1 = np.array(ds.GetRasterBand(1).ReadAsArray()).astype(np.float)
-    band1[band1 == 9999] = np.nan
+    cutoffs = get_percentiles(ds.GetRasterBand(1), [2, 98])
     ds = None
-    cutoffs = np.nanpercentile(band1, [2, 98])
+    if cutoffs is None:
+        log('No data in {} - not styling the trend'.format(outfile))
+        return None
     log('Cutoffs for 2 percent stretch: {}'.format(cutoffs))
     extreme = get_extreme(cutoffs[0], cutoffs[1])
 
@@ -499,16 +574,14 @@ def style_prod_traj_signif(outfile):
 def download_prod_state(job, download_dir):
     log("downloading productivity_state results...")
     for dataset in job['results'].get('datasets'):
-        for url in dataset.get('urls'):
+        if dataset['dataset'] == 'prod_state':
             #TODO style layer and set layer name based on the info in the dataset json file
-            outfile = os.path.join(download_dir, url['url'].rsplit('/', 1)[-1])
-            resp = download_result(url['url'], outfile, job)
-            if not resp:
+            outfile = download_dataset(job, dataset, download_dir)
+            if not outfile:
                 return
-            if dataset['dataset'] == 'prod_state':
-                style_prod_state(outfile)
-            else:
-                raise ValueError("Unrecognized dataset type in download results: {}".format(dataset['dataset']))
+            style_prod_state(outfile)
+        else:
+            raise ValueError("Unrecognized dataset type in download results: {}".format(dataset['dataset']))
 
 
 def style_prod_state(outfile):
@@ -534,16 +607,14 @@ def style_prod_state(outfile):
 def download_prod_perf(job, download_dir):
     log("downloading productivity_perf results...")
     for dataset in job['results'].get('datasets'):
-        for url in dataset.get('urls'):
-            if dataset['dataset'] == 'prod_performance':
-                #TODO style layer and set layer name based on the info in the dataset json file
-                outfile = os.path.join(download_dir, url['url'].rsplit('/', 1)[-1])
-                resp = download_result(url['url'], outfile, job)
-                if not resp:
-                    return
-                style_prod_perf(outfile)
-            else:
-                raise ValueError("Unrecognized dataset type in download results: {}".format(dataset['dataset']))
+        if dataset['dataset'] == 'prod_performance':
+            #TODO style layer and set layer name based on the info in the dataset json file
+            outfile = download_dataset(job, dataset, download_dir)
+            if not outfile:
+                return
+            style_prod_perf(outfile)
+        else:
+            raise ValueError("Unrecognized dataset type in download results: {}".format(dataset['dataset']))
 
 
 def style_prod_perf(outfile):
@@ -0,0 +1,259 @@
+# -*- coding: utf-8 -*-
+"""
+/***************************************************************************
+ LDMP - A QGIS plugin
+ This plugin supports monitoring and reporting of land degradation to the UNCCD
+ and in support of the SDG Land Degradation Neutrality (LDN) target.
+                              -------------------
+        begin                : 2017-05-23
+        git sha              : $Format:%H$
+        copyright            : (C) 2017 by Conservation International
+        email                : GEF-LDMP@conservation.org
+ ***************************************************************************/
+"""
+
+# Output raster profiles (layout, compression and overviews) for the rasters
+# written by the plugin. Nothing in this module depends on QGIS or Qt.
+
+import os
+import json
+import traceback
+
+from osgeo import gdal
+
+from LDMP.cache import replace_file
+
+# Profiles that can be chosen with the LDMP/output_profile setting:
+#   lzw   - stripped GeoTIFF with LZW compression (as written by earlier
+#           versions)
+#   tiled - tiled GeoTIFF, DEFLATE compression with a predictor, and
+#           overviews
+#   zstd  - as tiled, but ZSTD compressed (if GDAL supports it)
+#   cog   - Cloud Optimized GeoTIFF (tiled, DEFLATE with a predictor, and
+#           overviews laid out ahead of the full resolution data)
+PROFILES = ['lzw', 'tiled', 'zstd', 'cog']
+DEFAULT_PROFILE = 'lzw'
+
+BLOCK_SIZE = 256
+
+# Key in the JSON sidecar of an optimised copy of a downloaded result that 
+# names the result it was copied from (see optimise_task)
+OPTIMISED_FROM_KEY = 'optimised_from'
+
+
+def _has_compression(method):
+    options = gdal.GetDriverByName('GTiff').GetMetadataItem('DMD_CREATIONOPTIONLIST')
+    return method in (options or '')
+
+
+def _get_compression(profile):
+    if not profile or profile == 'lzw':
+        return 'LZW'
+    if profile not in PROFILES:
+        raise ValueError("unknown output profile {}".format(profile))
+    if profile == 'zstd' and _has_compression('ZSTD'):
+        return 'ZSTD'
+    else:
+        return 'DEFLATE'
+
+
+def _get_predictor(data_type):
+    # Horizontal differencing suits integers - floating point data (such as 
+    # trends) needs the floating point predictor
+    if data_type in (gdal.GDT_Float32, gdal.GDT_Float64):
+        return '3'
+    else:
+        return '2'
+
+
+def get_creation_options(profile=None, data_type=gdal.GDT_Int16):
+    """Returns the GeoTIFF creation options for an output profile, for a 
+    raster of type data_type"""
+    compress = _get_compression(profile)
+    if compress == 'LZW':
+        return ['COMPRESS=LZW']
+    # Compression makes the final size hard to predict, so let GDAL switch to
+    # BigTIFF whenever the uncompressed data might need it
+    return ['TILED=YES',
+            'BLOCKXSIZE={}'.format(BLOCK_SIZE),
+            'BLOCKYSIZE={}'.format(BLOCK_SIZE),
+            'COMPRESS={}'.format(compress),
+            'PREDICTOR={}'.format(_get_predictor(data_type)),
+            'BIGTIFF=IF_SAFER']
+
+
+def get_overview_levels(xsize, ysize, min_size=BLOCK_SIZE):
+    """Returns the overview factors needed to reduce a raster to one block"""
+    levels = []
+    factor = 2
+    while max(xsize, ysize) // (factor // 2) > min_size:
+        levels.append(factor)
+        factor *= 2
+    return levels
+
+
+def _temp_path(out_file):
+    root, ext = os.path.splitext(out_file)
+    return '{}.{}.tmp{}'.format(root, os.getpid(), ext)
+
+
+def create_output(out_file, xsize, ysize, n_bands, data_type, profile=None):
+    """Creates a GeoTIFF for writing an output raster with a profile
+
+    Returns the dataset, which should be closed and passed (by name) to
+    finish_output once written. For the cog profile, the data are first
+    written to a temporary file alongside out_file, since a COG can only be
+    written by copying a complete raster."""
+    driver = gdal.GetDriverByName("GTiff")
+    if profile == 'cog':
+        path = _temp_path(out_file)
+    else:
+        path = out_file
+    return driver.Create(path, xsize, ysize, n_bands, data_type,
+                         get_creation_options(profile, data_type))
+
+
+def finish_output(out_file, profile=None, resampling='NEAREST'):
+    """Adds overviews to a raster created by create_output (once it has been
+    written and closed), and for the cog profile converts it to out_file
+
+    resampling is the method used for the overviews - the default (nearest
+    neighbour) keeps the values of class rasters valid."""
+    if not profile or profile == 'lzw':
+        return out_file
+    if profile == 'cog':
+        path = _temp_path(out_file)
+    else:
+        path = out_file
+    ds = gdal.Open(path, gdal.GA_Update)
+    data_type = ds.GetRasterBand(1).DataType
+    levels = get_overview_levels(ds.RasterXSize, ds.RasterYSize)
+    if profile != 'cog' or gdal.GetDriverByName('COG') is None:
+        # Compress the overviews the same way as the full resolution data
+        gdal.SetConfigOption('COMPRESS_OVERVIEW', _get_compression(profile))
+        gdal.SetConfigOption('PREDICTOR_OVERVIEW', _get_predictor(data_type))
+        try:
+            if levels:
+                ds.BuildOverviews(resampling, levels)
+        finally:
+            gdal.SetConfigOption('COMPRESS_OVERVIEW', None)
+            gdal.SetConfigOption('PREDICTOR_OVERVIEW', None)
+    ds = None
+    if profile != 'cog':
+        return out_file
+
+    try:
+        if gdal.GetDriverByName('COG') is not None:
+            # The COG driver (GDAL 3.1 and later) builds its own overviews
+            gdal.Translate(out_file, path, format='COG',
+                           creationOptions=['COMPRESS=DEFLATE', 'PREDICTOR=YES',
+                                            'BIGTIFF=IF_SAFER',
+                                            'BLOCKSIZE={}'.format(BLOCK_SIZE),
+                                            'RESAMPLING={}'.format(resampling)])
+        else:
+            # Older GDAL writes the same layout when copying a tiled file
+            # with its overviews
+            gdal.Translate(out_file, path, format='GTiff',
+                           creationOptions=get_creation_options(profile, data_type) +
+                           ['COPY_SRC_OVERVIEWS=YES'])
+    finally:
+        gdal.GetDriverByName('GTiff').Delete(path)
+    return out_file
+
+
+def discard_output(out_file, profile=None):
+    """Deletes a raster created by create_output that won't be finished"""
+    if profile == 'cog':
+        path = _temp_path(out_file)
+    else:
+        path = out_file
+    if gdal.VSIStatL(path) is not None:
+        gdal.GetDriverByName('GTiff').Delete(path)
+
+
+def get_optimised_path(in_file):
+    """Returns the path for the optimised copy of a downloaded result
+
+    The copy is always a GeoTIFF, even if the result is a VRT (such as a 
+    mosaic of several tiles)."""
+    return '{}_optimised.tif'.format(os.path.splitext(in_file)[0])
+
+
+def optimise_raster(in_file, out_file, profile='tiled', callback=None):
+    """Writes a copy of a raster retiled and recompressed with a profile
+
+    The copy is tiled, compressed with a predictor and has internal overviews 
+    (the lzw profile, which has none of these, is treated as tiled). callback 
+    is a GDAL progress callback - returns None (and deletes the partial copy) 
+    if it cancels the copy."""
+    if not profile or profile == 'lzw':
+        profile = 'tiled'
+    if profile == 'cog':
+        path = _temp_path(out_file)
+    else:
+        path = out_file
+    data_type = gdal.Open(in_file).GetRasterBand(1).DataType
+    ds = gdal.Translate(path, in_file, format='GTiff',
+                        creationOptions=get_creation_options(profile, data_type),
+                        callback=callback)
+    if ds is None:
+        discard_output(out_file, profile)
+        return None
+    ds = None
+    return finish_output(out_file, profile)
+
+
+def optimise_task(in_file, profile='tiled', callback=None):
+    """Writes an optimised copy of a downloaded result
+
+    The copy is written next to in_file (see get_optimised_path), and its own 
+    JSON sidecar - a copy of the sidecar of in_file, naming in_file - is 
+    written once the copy is complete, and marks it as ready to use. The 
+    sidecar of in_file is left as it is. Returns (out_file, error) - out_file 
+    is None if callback cancelled the copy, and error is None on success 
+    (errors are returned rather than raised, so they can be logged by the 
+    caller)."""
+    out_file = get_optimised_path(in_file)
+    out_json_file = os.path.splitext(out_file)[0] + '.json'
+    try:
+        # An earlier copy is no longer ready once it starts being replaced
+        if os.path.exists(out_json_file):
+            os.remove(out_json_file)
+        if not optimise_raster(in_file, out_file, profile, callback):
+            return None, None
+        json_file = os.path.splitext(in_file)[0] + '.json'
+        if os.path.exists(json_file):
+            with open(json_file) as f:
+                metadata = json.load(f)
+        else:
+            metadata = {}
+        metadata[OPTIMISED_FROM_KEY] = os.path.basename(in_file)
+        # Written under another name and renamed, so a sidecar that exists 
+        # is never half written
+        temp_file = '{}.{}.tmp'.format(out_json_file, os.getpid())
+        with open(temp_file, 'w') as f:
+            json.dump(metadata, f, sort_keys=True, indent=4,
+                      separators=(',', ': '))
+        replace_file(temp_file, out_json_file)
+        return out_file, None
+    except Exception:
+        return out_file, traceback.format_exc()
+
+
+def get_optimised_file(in_file):
+    """Returns the optimised copy of a downloaded result if there is a 
+    complete one (with a sidecar naming in_file, written since in_file was 
+    last changed), or otherwise in_file"""
+    out_file = get_optimised_path(in_file)
+    out_json_file = os.path.splitext(out_file)[0] + '.json'
+    try:
+        with open(out_json_file) as f:
+            name = json.load(f).get(OPTIMISED_FROM_KEY)
+        ready = (name == os.path.basename(in_file) and
+                 os.path.exists(out_file) and
+                 os.path.getmtime(out_json_file) >= os.path.getmtime(in_file))
+    except (IOError, OSError, ValueError, AttributeError):
+        return in_file
+    if ready:
+        return out_file
+    return in_file
@@ -0,0 +1,329 @@
+# -*- coding: utf-8 -*-
+"""
+/***************************************************************************
+ LDMP - A QGIS plugin
+ This plugin supports monitoring and reporting of land degradation to the UNCCD
+ and in support of the SDG Land Degradation Neutrality (LDN) target.
+                              -------------------
+        begin                : 2017-05-23
+        git sha              : $Format:%H$
+        copyright            : (C) 2017 by Conservation International
+        email                : GEF-LDMP@conservation.org
+ ***************************************************************************/
+"""
+
+# Batch SDG 15.3.1 reporting for many regions (for example every admin1 region
+# of one or more countries), run without QGIS:
+#
+#   python -m LDMP.reporting_batch traj.tif perf.tif state.tif lc.tif \
+#       output_folder --admin Kenya --admin Uganda
+#
+#   python -m LDMP.reporting_batch traj.tif perf.tif state.tif lc.tif \
+#       output_folder --regions regions.shp --name-field NAME --zonal
+
+import os
+import re
+import sys
+import csv
+import gzip
+import json
+import argparse
+import traceback
+
+import requests
+
+from osgeo import gdal, ogr, osr
+
+from LDMP.reporting_core import aoi_from_geojson, build_sdg_bands, \
+    calculate_sdg, calculate_zonal, union_aois, MEMMAP_MB
+from LDMP.grids import RasterStack, BLOCK_CACHE_MB, get_block_cache
+from LDMP.reporting_table import get_deg_summary, make_reporting_table
+from LDMP.scratch import ScratchSpace, DEFAULT_MAX_MEM_SIZE
+from LDMP.tiles import get_n_workers, run_tiles, MEMORY_MB
+from LDMP.profiles import PROFILES, DEFAULT_PROFILE
+
+DATA_DIR = os.path.join(os.path.dirname(__file__), 'data')
+DATA_URL = 'https://s3.amazonaws.com/trends.earth/sharing/{}'
+
+SUMMARY_FIELDS = ['region', 'status', 'Area Degraded', 'Area Stable',
+                  'Area Improved', 'No Data', 'error']
+
+
+def read_data_json(file):
+    """Reads a gzipped JSON file from the plugin data folder
+
+    The file is downloaded first if it is not already in the data folder."""
+    filename = os.path.join(DATA_DIR, file)
+    if not os.path.exists(filename):
+        resp = requests.get(DATA_URL.format(file), stream=True)
+        resp.raise_for_status()
+        with open(filename + '.part', 'wb') as f:
+            for chunk in resp.iter_content(chunk_size=8192):
+                f.write(chunk)
+        os.rename(filename + '.part', filename)
+    with gzip.GzipFile(filename, 'r') as fin:
+        return json.loads(fin.read().decode('utf-8'))
+
+
+def get_admin_regions(country):
+    """Returns a list of (name, aoi_wkt) for the admin1 regions of a country
+
+    country is a name from the admin boundary key (see
+    download.get_admin_bounds)."""
+    admin_bounds_key = read_data_json('admin_bounds_key.json.gz')
+    if country not in admin_bounds_key:
+        raise ValueError("unknown country: {}".format(country))
+    country_key = admin_bounds_key[country]
+    admin_polys = read_data_json('admin_bounds_polys_{}.json.gz'.format(country_key['code']))
+    regions = []
+    for name in sorted(country_key['admin1'].keys()):
+        code = country_key['admin1'][name]['code']
+        regions.append((u'{} - {}'.format(country, name),
+                        aoi_from_geojson(admin_polys['admin1'][code]['geojson'])))
+    return regions
+
+
+def get_file_regions(vector_file, name_field=None):
+    """Returns a list of (name, aoi_wkt) for the polygons in a vector file
+
+    Regions are named from name_field if it is given, or numbered by feature
+    otherwise. Polygons are transformed to EPSG:4326."""
+    ds = ogr.Open(vector_file)
+    if ds is None:
+        raise IOError("unable to open {}".format(vector_file))
+    layer = ds.GetLayer(0)
+    dst_srs = osr.SpatialReference()
+    dst_srs.ImportFromEPSG(4326)
+    src_srs = layer.GetSpatialRef()
+    if src_srs and not src_srs.IsSame(dst_srs):
+        transform = osr.CoordinateTransformation(src_srs, dst_srs)
+    else:
+        transform = None
+    regions = []
+    for feature in layer:
+        geom = feature.GetGeometryRef()
+        if geom is None:
+            continue
+        geom = geom.Clone()
+        if transform:
+            geom.Transform(transform)
+        if name_field:
+            name = u'{}'.format(feature.GetField(name_field))
+        else:
+            name = u'region_{}'.format(feature.GetFID())
+        regions.append((name, geom.ExportToWkt()))
+    return regions
+
+
+def get_region_folder(output_folder, name):
+    """Returns the folder to save the results for a region in"""
+    return os.path.join(output_folder, re.sub(r'[^\w\-]+', '_', name, flags=re.UNICODE))
+
+
+def region_task(task):
+    """Runs the SDG 15.3.1 pipeline for one region of a batch
+
+    Returns (name, deg_summary, error), where error is None on success. Errors
+    are returned rather than raised, so that one region failing does not stop
+    the others."""
+    name, aoi_wkt, stack, out_folder, memory_mb, compact, profile, scratch = task
+    try:
+        if not os.path.exists(out_folder):
+            os.makedirs(out_folder)
+        # Each region reads a window of the stack shared by the batch, so its
+        # pixels are aligned with every other region
+        minx, maxx, miny, maxy = ogr.CreateGeometryFromWkt(aoi_wkt).GetEnvelope()
+        window = stack.grid.window_for_bounds(minx, miny, maxx, maxy)
+        if window is None:
+            raise ValueError("Region is outside of the input layers")
+        deg_out_file = os.path.join(out_folder, 'sdg_15_3_degradation.tif')
+        # Intermediate files (such as the AOI mask) are deleted as soon as 
+        # the region is done
+        with scratch:
+            tables = calculate_sdg(stack.window(window), deg_out_file,
+                                   aoi_wkt, memory_mb=memory_mb,
+                                   compact=compact, profile=profile,
+                                   scratch=scratch)
+        base_areas, target_areas, soc_totals, trans_lpd_xtab = tables
+        make_reporting_table(base_areas, target_areas, soc_totals,
+                             trans_lpd_xtab,
+                             os.path.join(out_folder, 'reporting_table.xlsx'))
+        return name, get_deg_summary(trans_lpd_xtab), None
+    except Exception:
+        return name, None, traceback.format_exc()
+
+
+def _build_batch_stack(scratch, traj_file, perf_file, state_file, lc_file,
+                       regions):
+    """Aligns the input bands on a grid covering all of the regions"""
+    all_regions = union_aois([aoi_wkt for name, aoi_wkt in regions])
+    indic_bands, lc_bands, grid = build_sdg_bands(scratch, traj_file,
+                                                  perf_file, state_file,
+                                                  lc_file, all_regions)
+    return RasterStack(grid, indic_bands + lc_bands)
+
+
+def write_summary(output_folder, results):
+    """Writes a list of (name, deg_summary, error) to summary.csv"""
+    with open(os.path.join(output_folder, 'summary.csv'), 'wb') as f:
+        writer = csv.writer(f)
+        writer.writerow(SUMMARY_FIELDS)
+        for name, deg, error in sorted(results, key=lambda r: r[0]):
+            if error:
+                row = [name, 'failed', '', '', '', '', error.strip().splitlines()[-1]]
+            else:
+                row = [name, 'ok'] + [deg[key] for key in SUMMARY_FIELDS[2:6]] + ['']
+            writer.writerow([u'{}'.format(v).encode('utf-8') for v in row])
+
+
+def sdg_batch(scratch, traj_file, perf_file, state_file, lc_file, regions,
+              output_folder, n_workers=1, callback=None, memory_mb=None,
+              compact=False, profile=None):
+    """Runs SDG 15.3.1 reporting for a list of (name, aoi_wkt) regions
+
+    The input bands are aligned once, on a grid covering all of the regions,
+    and the regions are then processed in parallel (one region per worker
+    process). The results for each region are saved to a subfolder of
+    output_folder, and a summary of all regions to summary.csv. Returns a
+    list of (name, deg_summary, error) in the order the regions finished, or
+    None if cancelled."""
+    stack = _build_batch_stack(scratch, traj_file, perf_file, state_file,
+                                 lc_file, regions)
+    # The memory budget is shared between the regions being processed at once
+    region_memory_mb = (memory_mb or MEMORY_MB) // max(1, n_workers)
+    tasks = [(name, aoi_wkt, stack, get_region_folder(output_folder, name),
+              region_memory_mb, compact, profile, scratch.subspace())
+             for name, aoi_wkt in regions]
+    results = list(run_tiles(region_task, tasks, n_workers=n_workers,
+                             callback=callback))
+    if len(results) < len(tasks):
+        return None
+    write_summary(output_folder, results)
+    return results
+
+
+def sdg_zonal_batch(scratch, traj_file, perf_file, state_file, lc_file,
+                    regions, output_folder, n_workers=1, callback=None,
+                    memory_mb=None, compact=False, profile=None,
+                    memmap_mb=None):
+    """Runs SDG 15.3.1 reporting for a list of regions in a single pass
+
+    Like sdg_batch, but the regions are treated as zones of one raster pass 
+    (see calculate_zonal), so the inputs are read once however many regions 
+    there are. Only the reporting tables are saved for each region (no 
+    degradation layers, so profile is unused). Regions should not 
+    overlap. memmap_mb is passed to calculate_zonal."""
+    stack = _build_batch_stack(scratch, traj_file, perf_file, state_file,
+                                 lc_file, regions)
+    zones = [(n + 1, aoi_wkt) for n, (name, aoi_wkt) in enumerate(regions)]
+    zone_tables = calculate_zonal(scratch, stack, zones, n_workers, callback,
+                                  memory_mb, compact, memmap_mb)
+    if zone_tables is None:
+        return None
+
+    results = []
+    for n, (name, aoi_wkt) in enumerate(regions):
+        try:
+            out_folder = get_region_folder(output_folder, name)
+            if not os.path.exists(out_folder):
+                os.makedirs(out_folder)
+            base_areas, target_areas, soc_totals, trans_lpd_xtab = zone_tables[n + 1]
+            make_reporting_table(base_areas, target_areas, soc_totals,
+                                 trans_lpd_xtab,
+                                 os.path.join(out_folder, 'reporting_table.xlsx'))
+            results.append((name, get_deg_summary(trans_lpd_xtab), None))
+        except Exception:
+            results.append((name, None, traceback.format_exc()))
+    write_summary(output_folder, results)
+    return results
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(description="Calculate the SDG 15.3.1 indicator for many regions")
+    parser.add_argument('traj', help="productivity trajectory layer")
+    parser.add_argument('perf', help="productivity performance layer")
+    parser.add_argument('state', help="productivity state layer")
+    parser.add_argument('lc', help="land cover layer")
+    parser.add_argument('output_folder', help="folder to save the results in (one subfolder per region)")
+    parser.add_argument('--admin', action='append', default=[],
+                        help="report on each admin1 region of this country (can be repeated)")
+    parser.add_argument('--regions', action='append', default=[],
+                        help="vector file with one polygon per region (can be repeated)")
+    parser.add_argument('--name-field', default=None,
+                        help="field in the vector files to name regions by")
+    parser.add_argument('--zonal', action='store_true',
+                        help="calculate the tables for all regions in one pass, without saving degradation layers")
+    parser.add_argument('--workers', type=int, default=0,
+                        help="number of worker processes (default: one per CPU)")
+    parser.add_argument('--memory-mb', type=int, default=MEMORY_MB,
+                        help="memory budget for the raster windows being processed, in MB")
+    parser.add_argument('--block-cache-mb', type=int, default=BLOCK_CACHE_MB,
+                        help="memory for caching decoded blocks of the inputs in each process, in MB")
+    parser.add_argument('--memmap-mb', type=int, default=MEMMAP_MB,
+                        help="with --zonal, keep tables larger than this (in MB) in memory-mapped scratch files")
+    parser.add_argument('--compact', action='store_true',
+                        help="write compact (Byte) degradation layers and use Float32 area weights")
+    parser.add_argument('--output-profile', choices=PROFILES,
+                        default=DEFAULT_PROFILE,
+                        help="layout and compression of the degradation layers (cog for Cloud Optimized GeoTIFFs)")
+    parser.add_argument('--scratch-dir', default=None,
+                        help="folder for intermediate files too large to keep in memory")
+    parser.add_argument('--scratch-max-mem-mb', type=int,
+                        default=DEFAULT_MAX_MEM_SIZE // (1024 * 1024),
+                        help="largest intermediate file to keep in memory, in MB")
+    parser.add_argument('--quiet', action='store_true',
+                        help="do not show progress")
+    return parser
+
+
+def main(argv=None):
+    parser = get_parser()
+    args = parser.parse_args(argv)
+    if not args.admin and not args.regions:
+        parser.error("give at least one --admin or --regions")
+
+    regions = []
+    for country in args.admin:
+        regions.extend(get_admin_regions(country))
+    for vector_file in args.regions:
+        regions.extend(get_file_regions(vector_file, args.name_field))
+    if not os.path.exists(args.output_folder):
+        os.makedirs(args.output_folder)
+
+    if args.quiet:
+        callback = None
+    else:
+        callback = gdal.TermProgress_nocb
+
+    get_block_cache().resize(args.block_cache_mb)
+    with ScratchSpace(args.scratch_dir, args.scratch_max_mem_mb * 1024 * 1024) as scratch:
+        kwargs = {}
+        if args.zonal:
+            batch = sdg_zonal_batch
+            kwargs['memmap_mb'] = args.memmap_mb
+        else:
+            batch = sdg_batch
+        results = batch(scratch, args.traj, args.perf, args.state, args.lc,
+                        regions, args.output_folder,
+                        n_workers=get_n_workers(args.workers),
+                        callback=callback, memory_mb=args.memory_mb,
+                        compact=args.compact, profile=args.output_profile,
+                        **kwargs)
+    if results is None:
+        sys.stderr.write("Processing cancelled\n")
+        return 1
+
+    failed = [(name, error) for name, deg, error in results if error]
+    for name, error in failed:
+        sys.stderr.write(u'Region {} failed:\n{}\n'.format(name, error).encode('utf-8'))
+    print('{} of {} regions succeeded - summary saved to {}'.format(len(results) - len(failed),
+                                                                      len(results),
+                                                                      os.path.join(args.output_folder, 'summary.csv')))
+    if failed:
+        return 1
+    else:
+        return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
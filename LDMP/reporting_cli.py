@@ -0,0 +1,119 @@
+# -*- coding: utf-8 -*-
+"""
+/***************************************************************************
+ LDMP - A QGIS plugin
+ This plugin supports monitoring and reporting of land degradation to the UNCCD
+ and in support of the SDG Land Degradation Neutrality (LDN) target.
+                              -------------------
+        begin                : 2017-05-23
+        git sha              : $Format:%H$
+        copyright            : (C) 2017 by Conservation International
+        email                : GEF-LDMP@conservation.org
+ ***************************************************************************/
+"""
+
+# Command line tool to run SDG 15.3.1 reporting without QGIS, for example:
+#
+#   python -m LDMP.reporting_cli traj.tif perf.tif state.tif lc.tif \
+#       aoi.geojson output_folder
+
+import os
+import sys
+import json
+import argparse
+
+from osgeo import gdal
+
+from LDMP.reporting_core import aoi_from_geojson, sdg_report
+from LDMP.reporting_table import get_deg_summary, make_reporting_table
+from LDMP.scratch import ScratchSpace, DEFAULT_MAX_MEM_SIZE
+from LDMP.cache import StageCache, DEFAULT_CACHE_DIR, DEFAULT_MAX_SIZE
+from LDMP.tiles import get_n_workers, MEMORY_MB
+from LDMP.profiles import PROFILES, DEFAULT_PROFILE
+from LDMP.grids import BLOCK_CACHE_MB, get_block_cache
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(description="Calculate the SDG 15.3.1 indicator for an area of interest")
+    parser.add_argument('traj', help="productivity trajectory layer")
+    parser.add_argument('perf', help="productivity performance layer")
+    parser.add_argument('state', help="productivity state layer")
+    parser.add_argument('lc', help="land cover layer")
+    parser.add_argument('aoi', help="GeoJSON file with the area of interest (in EPSG:4326)")
+    parser.add_argument('output_folder', help="folder to save the degradation layer and reporting table in")
+    parser.add_argument('--workers', type=int, default=0,
+                        help="number of worker processes (default: one per CPU)")
+    parser.add_argument('--memory-mb', type=int, default=MEMORY_MB,
+                        help="memory budget for the raster windows being processed, in MB")
+    parser.add_argument('--block-cache-mb', type=int, default=BLOCK_CACHE_MB,
+                        help="memory for caching decoded blocks of the inputs in each process, in MB")
+    parser.add_argument('--compact', action='store_true',
+                        help="write a compact (Byte) degradation layer and use Float32 area weights")
+    parser.add_argument('--output-profile', choices=PROFILES,
+                        default=DEFAULT_PROFILE,
+                        help="layout and compression of the degradation layer (cog for a Cloud Optimized GeoTIFF)")
+    parser.add_argument('--scratch-dir', default=None,
+                        help="folder for intermediate files too large to keep in memory")
+    parser.add_argument('--scratch-max-mem-mb', type=int,
+                        default=DEFAULT_MAX_MEM_SIZE // (1024 * 1024),
+                        help="largest intermediate file to keep in memory, in MB")
+    parser.add_argument('--cache-dir', default=DEFAULT_CACHE_DIR,
+                        help="folder to cache results in, to reuse when rerun on the same inputs")
+    parser.add_argument('--cache-max-size-mb', type=int,
+                        default=DEFAULT_MAX_SIZE // (1024 * 1024),
+                        help="size limit for the cache, in MB")
+    parser.add_argument('--no-cache', action='store_true',
+                        help="do not use or update the cache")
+    parser.add_argument('--quiet', action='store_true',
+                        help="do not show progress")
+    return parser
+
+
+def main(argv=None):
+    args = get_parser().parse_args(argv)
+
+    with open(args.aoi) as f:
+        aoi_wkt = aoi_from_geojson(json.load(f))
+    if not os.path.exists(args.output_folder):
+        os.makedirs(args.output_folder)
+    deg_out_file = os.path.join(args.output_folder, 'sdg_15_3_degradation.tif')
+
+    if args.quiet:
+        callback = None
+    else:
+        callback = gdal.TermProgress_nocb
+
+    if args.no_cache:
+        cache = None
+    else:
+        cache = StageCache(args.cache_dir, args.cache_max_size_mb * 1024 * 1024)
+
+    get_block_cache().resize(args.block_cache_mb)
+    with ScratchSpace(args.scratch_dir, args.scratch_max_mem_mb * 1024 * 1024) as scratch:
+        tables = sdg_report(scratch, args.traj, args.perf, args.state, args.lc,
+                            aoi_wkt, deg_out_file,
+                            n_workers=get_n_workers(args.workers),
+                            callback=callback, cache=cache,
+                            memory_mb=args.memory_mb,
+                            compact=args.compact,
+                            profile=args.output_profile)
+    if not tables:
+        sys.stderr.write("Processing cancelled\n")
+        return 1
+    base_areas, target_areas, soc_totals, trans_lpd_xtab = tables
+
+    for name, area in sorted(get_deg_summary(trans_lpd_xtab).items()):
+        print('{}: {:.1f} sq km'.format(name, area))
+
+    table_file = os.path.join(args.output_folder, 'reporting_table.xlsx')
+    make_reporting_table(base_areas, target_areas, soc_totals, trans_lpd_xtab,
+                         table_file)
+    print('Degradation layer saved to {}'.format(deg_out_file))
+    print('Indicator table saved to {}'.format(table_file))
+    if not args.quiet:
+        print('Block cache: {}'.format(get_block_cache().summary()))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,1248 @@
+# -*- coding: utf-8 -*-
+"""
+/***************************************************************************
+ LDMP - A QGIS plugin
+ This plugin supports monitoring and reporting of land degradation to the UNCCD
+ and in support of the SDG Land Degradation Neutrality (LDN) target.
+                              -------------------
+        begin                : 2017-05-23
+        git sha              : $Format:%H$
+        copyright            : (C) 2017 by Conservation International
+        email                : GEF-LDMP@conservation.org
+ ***************************************************************************/
+"""
+
+# Raster computations for the reporting tool. Nothing in this module depends on
+# QGIS or Qt, so that the functions here can be run in worker processes.
+
+import os
+import json
+import shutil
+import hashlib
+from fractions import gcd
+
+import numpy as np
+
+from osgeo import gdal, gdal_array, ogr, osr
+
+from LDMP.accumulators import Crosstab, DEG_CODES, LC_CODES, TRANS_CODES, \
+    get_buffer
+from LDMP.cache import cache_key, file_fingerprint, touch, \
+    replace_file
+from LDMP.tiles import run_tiles, get_windows, BlockWriter
+from LDMP.scratch import ScratchSpace, raster_size
+from LDMP.resample import majority_resample
+from LDMP.grids import GridSpec, RasterStack, open_raster, as_stack, \
+    get_stage_windows, get_source_block_size, read_block_digests, \
+    is_compact, set_compact, encode_compact, get_compact_lut, COMPACT_NODATA
+from LDMP.profiles import create_output, finish_output, discard_output, \
+    get_optimised_file
+
+# Nodata value of the Int16 rasters written by the reporting stages (compact
+# rasters have their own - see grids.COMPACT_NODATA)
+NODATA = -9999
+
+
+#  Calculate the area of a slice of the globe from the equator to the parallel
+#  at latitude f (on WGS84 ellipsoid). Based on:
+# https://gis.stackexchange.com/questions/127165/more-accurate-way-to-calculate-area-of-rasters
+def _slice_area(f):
+    a = 6378137 # in meters
+    b =  6356752.3142 # in meters,
+    e = np.sqrt(1 - np.square(b / a))
+    zp = 1 + e * np.sin(f)
+    zm = 1 - e * np.sin(f)
+    return np.pi * np.square(b) * ((2*np.arctanh(e * np.sin(f))) / (2 * e) + np.sin(f) / (zp * zm))
+
+
+# Formula to calculate area of a raster cell, following
+# https://gis.stackexchange.com/questions/127165/more-accurate-way-to-calculate-area-of-rasters
+def calc_cell_area(ymin, ymax, x_width):
+    'Calculate cell area on WGS84 ellipsoid'
+    # Works on scalars or on arrays of latitudes (one value per row)
+    ymin, ymax = np.minimum(ymin, ymax), np.maximum(ymin, ymax)
+    # ymin: minimum latitude
+    # ymax: maximum latitude
+    # x_width: width of cell in degrees
+    return (_slice_area(np.deg2rad(ymax)) - _slice_area(np.deg2rad(ymin))) * (x_width / 360.)
+
+
+def calc_cell_areas(gt, ysize):
+    """Calculate the cell area of every row of a raster from its geotransform
+
+    Returns a vector of length ysize (in sq m) that can be broadcast across
+    any block of rows with cell_areas[y:y + rows, np.newaxis]."""
+    # Latitude of the top edge of each row, plus the bottom edge of the last
+    lats = gt[3] + gt[5] * np.arange(ysize + 1)
+    return calc_cell_area(lats[:-1], lats[1:], gt[1])
+
+
+def make_deg_lut():
+    """Precomputes the SDG 15.3.1 degradation rule as a lookup table
+
+    The table is indexed by ((traj + 32768) * 8 + perf_deg * 4 + state_deg * 2
+    + lc_deg), where traj is the (Int16) trajectory significance code, and
+    perf_deg, state_deg and lc_deg are 1 where the performance, state and land
+    cover degradation layers are -1 (degraded) and 0 otherwise. Trajectory
+    codes other than -3 to 3 (such as nodata) are passed through unchanged
+    unless overridden by one of the other layers."""
+    traj = np.arange(-32768, 32768, dtype=np.int32)
+    deg = traj.copy()
+    # Capture trends that are at least 95% significant
+    deg[(traj == -1) | (traj == 1)] = 0 # not signif at 95%
+    deg[(traj >= -3) & (traj <= -2)] = -1
+    deg[(traj >= 2) & (traj <= 3)] = 1
+    lut = np.repeat(deg, 8).reshape(traj.size, 8)
+    # Land cover degradation (lowest bit set)
+    lut[:, 1::2] = -1
+    # Both state and performance degradation (two middle bits set)
+    lut[:, 6:8] = -1
+    return lut.astype(np.int16).ravel()
+
+
+def apply_deg_lut(lut, bands, out, ind, flag):
+    """Calculates degradation for a block of (traj, perf, state, lc) bands
+
+    Works entirely in the preallocated out (Int16), ind (Int32) and flag
+    (bool) arrays, which must be the same shape as each band. The bands can
+    be any integer type."""
+    np.add(bands[0], 32768, out=ind, dtype=np.int32, casting='unsafe')
+    for band in bands[1:]:
+        np.left_shift(ind, 1, out=ind)
+        np.equal(band, -1, out=flag)
+        np.add(ind, flag, out=ind)
+    np.take(lut, ind, out=out)
+    return out
+
+
+def _buffer_view(buf, shape):
+    """Returns a contiguous view of the first elements of a flat buffer"""
+    return buf[:int(np.prod(shape))].reshape(shape)
+
+
+def get_class_type(compact=False, src_ds=None):
+    """Returns the (GDAL data type, nodata value) for a class raster, such as 
+    the degradation layer, written by the reporting stages
+
+    Class rasters are Int16, unless compact is True, when they are written as 
+    compact (Byte) class rasters (see grids.is_compact), which halves their 
+    size on disk and in memory. If src_ds (a raster being clipped) is given, 
+    the compact type is only used if it is already a compact class raster."""
+    if compact and (src_ds is None or is_compact(src_ds)):
+        return gdal.GDT_Byte, COMPACT_NODATA
+    return gdal.GDT_Int16, NODATA
+
+
+def set_class_type(ds, data_type, nodata):
+    """Sets the nodata value of every band of a class raster being written, 
+    and flags it if it is compact"""
+    for n in range(ds.RasterCount):
+        ds.GetRasterBand(n + 1).SetNoDataValue(nodata)
+    if data_type == gdal.GDT_Byte:
+        set_compact(ds)
+
+
+def to_class_type(data, data_type, flag):
+    """Returns a copy of an Int16 class array, for writing as data_type
+
+    Compact arrays are encoded with grids.encode_compact. flag is a 
+    preallocated bool array the same shape as data."""
+    if data_type == gdal.GDT_Int16:
+        return data.copy()
+    return encode_compact(data, flag)
+
+
+def get_zone_type(zone_ids):
+    """Returns the smallest GDAL data type that can hold a list of zone IDs"""
+    max_id = max(zone_ids or [0])
+    if max_id <= 255:
+        return gdal.GDT_Byte
+    elif max_id <= 65535:
+        return gdal.GDT_UInt16
+    else:
+        return gdal.GDT_Int32
+
+
+# Approximate working memory (in bytes per pixel of a window) used by each 
+# stage, in addition to the bands it reads - for the degradation lookup 
+# (index, flags and output), the AOI mask, and the crosstab accumulation 
+# (cell areas, indices and weights)
+DEG_WORK_BYTES = 8
+CLIP_WORK_BYTES = 2
+AREA_WORK_BYTES = 48
+
+# Number of pixels in each window of the SDG stage when its outputs are 
+# cached (see calculate_sdg)
+SDG_WINDOW_PIXELS = 2**18
+
+# Zonal tables larger than this (in MB) are memory-mapped to scratch files
+MEMMAP_MB = 256
+
+
+# State for the tile functions below. Each worker process opens its own
+# datasets (GDAL handles can't be shared across processes) and keeps its own
+# buffers.
+_tile_state = {}
+
+
+def _init_tiles(in_file, mask_file=None, compact=False):
+    _tile_state.clear()
+    _tile_state['ds'] = open_raster(in_file)
+    _tile_state['compact'] = compact
+    if mask_file:
+        _tile_state['mask_ds'] = gdal.Open(mask_file)
+
+
+def _close_tiles():
+    _tile_state.clear()
+
+
+def _weight_dtype():
+    # Float32 is precise enough for per pixel weights, which are summed as 
+    # Float64 in the accumulators
+    if _tile_state.get('compact'):
+        return np.float32
+    else:
+        return np.float64
+
+
+def _cell_area(window):
+    """Returns the area (in sq m) of each pixel in a window
+
+    Pixel area varies by latitude (so by row), so the area of the cells in
+    each row is broadcast across the window."""
+    x, y, cols, rows = window
+    cell_area = _buffer_view(get_buffer('cell_area', cols * rows, _weight_dtype()),
+                             (rows, cols))
+    cell_area[...] = _tile_state['cell_areas'][y:y + rows, np.newaxis]
+    return cell_area
+
+
+def _read_mask(window, edge=True):
+    """Returns the AOI mask for a window as a bool array
+
+    Returns None if there is no mask, or if the window is not on the edge of
+    the AOI (so needs no per-pixel masking)."""
+    mask_ds = _tile_state.get('mask_ds')
+    if mask_ds is None or not edge:
+        return None
+    x, y, cols, rows = window
+    mask = _buffer_view(get_buffer('mask', cols * rows, np.uint8), (rows, cols))
+    mask_ds.GetRasterBand(1).ReadAsArray(x, y, cols, rows, buf_obj=mask)
+    # The mask is stored as 0/1, so can be viewed as bool without a copy
+    return mask.view(bool)
+
+
+def _init_deg_tiles(compact=False):
+    _tile_state.clear()
+    _tile_state['lut'] = make_deg_lut()
+    _tile_state['deg_type'] = get_class_type(compact)[0]
+
+
+def deg_tile(window, bands, mask):
+    """Calculates degradation for one window of the indicator stack
+
+    mask is unused - the degradation layer is masked by a later clip. Returns
+    the window and the degradation array for it"""
+    x, y, cols, rows = window
+    n = cols * rows
+    flag = _buffer_view(get_buffer('flag', n, bool), (rows, cols))
+    deg = _buffer_view(get_buffer('deg', n, np.int16), (rows, cols))
+    apply_deg_lut(_tile_state['lut'], bands, deg,
+                  _buffer_view(get_buffer('ind', n, np.int32), (rows, cols)),
+                  flag)
+    return window, to_class_type(deg, _tile_state['deg_type'], flag)
+
+
+def _write_tile(writer, tile):
+    window, data = tile
+    writer.write(data, window[0], window[1])
+    return writer
+
+
+def calculate_degradation(in_file, out_file, aoi_wkt=None, n_workers=1,
+                          callback=None, memory_mb=None, compact=False,
+                          profile=None):
+    """Calculates the SDG 15.3.1 degradation layer
+
+    in_file (a raster or a RasterStack) has four bands (trajectory, 
+    performance, state and land cover degradation). If aoi_wkt (a polygon 
+    in EPSG:4326) is given, blocks that are entirely outside of it are 
+    skipped and left as nodata (-9999, or grids.COMPACT_NODATA for a compact 
+    layer - see get_class_type). The layer is written with the given output 
+    profile (see profiles.PROFILES). Returns True on 
+    success, or None if cancelled through the (GDAL-style) callback."""
+    stack = as_stack(in_file)
+    windows = stack.windows(DEG_WORK_BYTES, n_workers, memory_mb)
+    if aoi_wkt:
+        tasks = get_aoi_tasks(aoi_wkt, stack, windows)
+    else:
+        tasks = [(window, False) for window in windows]
+
+    data_type, nodata = get_class_type(compact)
+    dst_ds = create_output(out_file, stack.RasterXSize, stack.RasterYSize, 1,
+                           data_type, profile)
+    dst_ds.SetGeoTransform(stack.GetGeoTransform())
+    dst_srs = osr.SpatialReference()
+    dst_srs.ImportFromWkt(stack.GetProjectionRef())
+    dst_ds.SetProjection(dst_srs.ExportToWkt())
+    # Skipped blocks are filled with the nodata value when the file is closed
+    set_class_type(dst_ds, data_type, nodata)
+
+    # Blocks are written in the parent process as they finish, on a 
+    # background thread
+    writer = BlockWriter(dst_ds)
+    try:
+        result = stack.map_reduce(deg_tile, _write_tile, writer, tasks,
+                                  init=_init_deg_tiles, init_args=(compact,),
+                                  n_workers=n_workers, callback=callback)
+    finally:
+        _close_tiles()
+        writer.close()
+    dst_ds = None
+
+    if result is None:
+        discard_output(out_file, profile)
+        return None
+    else:
+        finish_output(out_file, profile)
+        return True
+
+
+def _init_area_map(gt, ysize, compact=False):
+    _tile_state.clear()
+    _tile_state['compact'] = compact
+    _tile_state['cell_areas'] = calc_cell_areas(gt, ysize)
+
+
+def _new_area_tables(zone_ids=None, scratch=None):
+    """Returns empty (base areas, target areas, SOC totals, degradation by
+    transition) Crosstabs
+
+    If zone_ids is given, each table has an extra first dimension for the
+    zone. If scratch (a ScratchSpace) is given, the totals are 
+    memory-mapped to files in it rather than kept in memory."""
+    if zone_ids is None:
+        zone_dim = ()
+    else:
+        zone_dim = (zone_ids,)
+
+    def new(*domains):
+        if scratch is None:
+            return Crosstab(*domains)
+        shape = tuple(np.unique(d).size for d in domains)
+        return Crosstab(*domains, values=scratch.array(shape))
+
+    return (new(*(zone_dim + (LC_CODES,))),
+            new(*(zone_dim + (LC_CODES,))),
+            new(*(zone_dim + (TRANS_CODES,))),
+            new(*(zone_dim + (DEG_CODES, TRANS_CODES))))
+
+
+def _area_tables_size(n_zones):
+    """Returns the size in bytes of the tables from _new_area_tables for 
+    n_zones zones"""
+    n_lc = len(LC_CODES)
+    n_trans = len(TRANS_CODES)
+    return n_zones * (2 * n_lc + n_trans + len(DEG_CODES) * n_trans) * 8
+
+
+def _add_area_tables(tables, a_deg, a_base, a_target, a_trans, a_soc,
+                     cell_area, mask=None, zones=None):
+    """Adds one block of the deg/lc bands to a tuple of area tables
+
+    zones is the zone ID band for the block, for tables from 
+    _new_area_tables(zone_ids)."""
+    area_table_base, area_table_target, soc_totals_table, trans_xtab = tables
+
+    def add(table, cols, weights, mask):
+        if zones is not None:
+            cols = (zones,) + cols
+        table.add(*cols, weights=weights, mask=mask)
+
+    ################################
+    # Calculate transition crosstabs
+    add(trans_xtab, (a_deg, a_trans), cell_area, mask)
+
+    #################################
+    # Calculate base and target areas
+    add(area_table_base, (a_base,), cell_area, mask)
+    add(area_table_target, (a_target,), cell_area, mask)
+
+    #################################
+    # Calculate SOC totals (converting soilgrids data from per ha to per m).
+    # Only sum values where soc has a valid value (negative values are missing
+    # data flags). Note final units of soc_totals_table are tons C (summed
+    # over the total area of each class)
+    n = a_soc.size
+    soc_valid = _buffer_view(get_buffer('soc_valid', n, bool), a_soc.shape)
+    np.greater(a_soc, 0, out=soc_valid)
+    if mask is not None:
+        np.logical_and(soc_valid, mask, out=soc_valid)
+    soc = _buffer_view(get_buffer('soc', n, _weight_dtype()), a_soc.shape)
+    np.multiply(a_soc, 1e-4, out=soc)
+    np.multiply(soc, cell_area, out=soc)
+    add(soc_totals_table, (a_trans,), soc, soc_valid)
+
+
+def _merge_area_tables(tables, tile_tables):
+    if tables is None:
+        return tile_tables
+    for table, tile_table in zip(tables, tile_tables):
+        table.merge(tile_table)
+    return tables
+
+
+def _finish_area_tables(tables):
+    area_table_base, area_table_target, soc_totals_table, trans_xtab = tables
+    # Convert all area tables from meters into square kilometers
+    area_table_base.scale(1e-6)
+    area_table_target.scale(1e-6)
+    trans_xtab.scale(1e-6)
+    return list((area_table_base, area_table_target, soc_totals_table,
+                 trans_xtab))
+
+
+def area_tile(window, bands, mask):
+    """Calculates partial area tables for one window of the deg/lc stack
+
+    mask is the AOI mask for the window, or None if the window is entirely 
+    within the AOI. Returns a tuple of Crosstabs (base areas, target areas,
+    SOC totals, degradation by transition crosstab) in sq m (and tons C for
+    SOC)."""
+    tables = _new_area_tables()
+    _add_area_tables(tables, bands[0], bands[1], bands[2], bands[3], bands[4],
+                     _cell_area(window), mask)
+    return tables
+
+
+def calculate_areas(in_file, aoi_wkt=None, n_workers=1, callback=None,
+                    memory_mb=None, compact=False, cache=None, scratch=None):
+    """Calculates area tables and the transition crosstab for a deg/lc stack
+
+    in_file (a raster or a RasterStack) has five bands (degradation, base 
+    land cover, target land cover, land cover transitions and soil organic 
+    carbon). If aoi_wkt (a polygon in EPSG:4326) is given, only pixels 
+    within it are counted. Returns a list of Crosstabs (base areas, target 
+    areas, SOC totals, degradation by transition crosstab) with areas in sq 
+    km, or None if cancelled through the (GDAL-style) callback. If compact is True, per pixel weights are 
+    calculated as Float32. The AOI mask is kept in cache or scratch (see 
+    get_aoi_mask), or in a scratch space of its own if neither is given."""
+    if aoi_wkt and cache is None and scratch is None:
+        with ScratchSpace() as scratch:
+            return calculate_areas(in_file, aoi_wkt, n_workers, callback,
+                                   memory_mb, compact, scratch=scratch)
+    stack = as_stack(in_file)
+    windows = stack.windows(AREA_WORK_BYTES, n_workers, memory_mb)
+    if aoi_wkt:
+        mask_file = get_aoi_mask(aoi_wkt, stack, cache, scratch)
+        tasks = get_aoi_tasks(aoi_wkt, stack, windows)
+    else:
+        mask_file = None
+        tasks = [(window, False) for window in windows]
+
+    # Partial tables from each window are merged here, in the parent (into 
+    # empty tables, in case the AOI doesn't overlap any of the raster)
+    try:
+        tables = stack.map_reduce(area_tile, _merge_area_tables,
+                                  _new_area_tables(), tasks, mask_file,
+                                  _init_area_map,
+                                  (stack.GetGeoTransform(), stack.RasterYSize,
+                                   compact),
+                                  n_workers, callback)
+    finally:
+        _close_tiles()
+
+    if tables is None:
+        return None
+    else:
+        return _finish_area_tables(tables)
+
+
+def union_aois(aoi_wkts):
+    """Returns the union of several AOIs (polygons in EPSG:4326) as WKT
+
+    The union is a Polygon or MultiPolygon, rather than a GeometryCollection 
+    (which GEOS before 3.13 rejects in many operations, such as Boundary - 
+    see get_block_coverage)."""
+    polygons = ogr.Geometry(ogr.wkbMultiPolygon)
+    for aoi_wkt in aoi_wkts:
+        aoi = ogr.CreateGeometryFromWkt(aoi_wkt)
+        if ogr.GT_Flatten(aoi.GetGeometryType()) == ogr.wkbMultiPolygon:
+            for n in range(aoi.GetGeometryCount()):
+                polygons.AddGeometry(aoi.GetGeometryRef(n))
+        else:
+            polygons.AddGeometry(aoi)
+    return polygons.UnionCascaded().ExportToWkt()
+
+
+def aoi_geometry(aoi_wkt, srs_wkt):
+    """Returns an AOI (WKT in EPSG:4326) as an OGR geometry in another CRS"""
+    aoi = ogr.CreateGeometryFromWkt(aoi_wkt)
+    srs = osr.SpatialReference()
+    srs.ImportFromWkt(srs_wkt)
+    aoi_srs = osr.SpatialReference()
+    aoi_srs.ImportFromEPSG(4326)
+    if not srs.IsSame(aoi_srs):
+        aoi.Transform(osr.CoordinateTransformation(aoi_srs, srs))
+    return aoi
+
+
+def aoi_layer(aoi_wkt, srs_wkt):
+    """Returns an in-memory OGR datasource and layer holding an AOI polygon
+
+    aoi_wkt is in EPSG:4326, and is transformed to the CRS given by srs_wkt"""
+    aoi = aoi_geometry(aoi_wkt, srs_wkt)
+    srs = osr.SpatialReference()
+    srs.ImportFromWkt(srs_wkt)
+    mem_ds = ogr.GetDriverByName('Memory').CreateDataSource('aoi')
+    layer = mem_ds.CreateLayer('aoi', srs, ogr.wkbUnknown)
+    feature = ogr.Feature(layer.GetLayerDefn())
+    feature.SetGeometry(aoi)
+    layer.CreateFeature(feature)
+    feature = None
+    # The datasource must be kept alive as long as the layer is in use
+    return mem_ds, layer
+
+
+def get_aoi_mask(aoi_wkt, ds, cache=None, scratch=None):
+    """Returns the path to a raster mask of an AOI on the grid of a dataset
+
+    The AOI (a polygon in EPSG:4326) is rasterized once onto the pixel grid of
+    ds, as a 1-bit GeoTIFF. If cache (a StageCache) is given, the mask is 
+    saved in it (keyed by a hash of the geometry and the grid, and counting 
+    towards its size limit) so later stages working on the same grid (and 
+    later runs on the same AOI) reuse it. Otherwise it is written to scratch 
+    (a ScratchSpace). Pixels are inside the mask if their centre is inside 
+    the AOI (the same rule gdal.Warp uses for cutlines)."""
+    gt = ds.GetGeoTransform()
+    srs_wkt = ds.GetProjectionRef()
+    if cache is None:
+        mask_file = scratch.path('.tif', shared=True)
+        _write_aoi_mask(aoi_wkt, ds, mask_file)
+        return mask_file
+
+    key = hashlib.md5(json.dumps([aoi_wkt, gt, srs_wkt,
+                                  ds.RasterXSize, ds.RasterYSize]).encode('utf-8')).hexdigest()
+    mask_dir = os.path.join(cache.cache_dir, 'masks')
+    mask_file = os.path.join(mask_dir, 'aoi_mask_{}.tif'.format(key))
+    if os.path.exists(mask_file):
+        touch(mask_file)
+        return mask_file
+
+    if not os.path.exists(mask_dir):
+        os.makedirs(mask_dir)
+    # Write to a temporary name and rename when done so a partially written 
+    # mask is never used
+    temp_file = mask_file + '.{}.tmp'.format(os.getpid())
+    _write_aoi_mask(aoi_wkt, ds, temp_file)
+    replace_file(temp_file, mask_file)
+    cache.evict()
+    return mask_file
+
+
+def _write_aoi_mask(aoi_wkt, ds, mask_file):
+    srs_wkt = ds.GetProjectionRef()
+    driver = gdal.GetDriverByName("GTiff")
+    mask_ds = driver.Create(mask_file, ds.RasterXSize, ds.RasterYSize, 1,
+                            gdal.GDT_Byte,
+                            ['NBITS=1', 'COMPRESS=DEFLATE', 'TILED=YES'])
+    mask_ds.SetGeoTransform(ds.GetGeoTransform())
+    mask_ds.SetProjection(srs_wkt)
+    aoi_ds, layer = aoi_layer(aoi_wkt, srs_wkt)
+    gdal.RasterizeLayer(mask_ds, [1], layer, burn_values=[1])
+    mask_ds = None
+    aoi_ds = None
+
+
+# Coverage of a window by the AOI
+OUTSIDE = 0
+INSIDE = 1
+EDGE = 2
+
+
+def _cell_size(starts, ends, size):
+    """Returns the largest cell size that the edges of every window are a 
+    multiple of (other than edges at the end of the raster)"""
+    step = 0
+    for edge in starts + [end for end in ends if end < size]:
+        step = gcd(step, edge)
+    return step or size
+
+
+def get_block_coverage(aoi_wkt, ds, windows):
+    """Classifies each window of a dataset as OUTSIDE, INSIDE or on the EDGE
+    of an AOI (a polygon in EPSG:4326)
+
+    The AOI, and then its boundary, are rasterized onto a coarse grid of 
+    cells that the windows are made up of (one cell per window, for windows 
+    on a regular grid), burning every cell they touch - so the cost is one 
+    pass over the vertices of the AOI, not one per window. The test uses the 
+    full extent of each cell, so is conservative: a window is only INSIDE if 
+    every pixel in it is within the AOI, and only OUTSIDE if none of its 
+    pixels can be."""
+    if not windows:
+        return []
+    cell_x = _cell_size([x for x, y, cols, rows in windows],
+                        [x + cols for x, y, cols, rows in windows],
+                        ds.RasterXSize)
+    cell_y = _cell_size([y for x, y, cols, rows in windows],
+                        [y + rows for x, y, cols, rows in windows],
+                        ds.RasterYSize)
+    gt = ds.GetGeoTransform()
+    srs_wkt = ds.GetProjectionRef()
+    cells_ds = gdal.GetDriverByName('MEM').Create('', -(-ds.RasterXSize // cell_x),
+                                                  -(-ds.RasterYSize // cell_y),
+                                                  1, gdal.GDT_Byte)
+    cells_ds.SetGeoTransform((gt[0], gt[1] * cell_x, 0,
+                              gt[3], 0, gt[5] * cell_y))
+    cells_ds.SetProjection(srs_wkt)
+    aoi_ds, layer = aoi_layer(aoi_wkt, srs_wkt)
+    gdal.RasterizeLayer(cells_ds, [1], layer, burn_values=[INSIDE],
+                        options=['ALL_TOUCHED=TRUE'])
+    # Cells the boundary passes through are only partly inside
+    feature = layer.GetNextFeature()
+    feature.SetGeometry(feature.GetGeometryRef().Boundary())
+    layer.SetFeature(feature)
+    gdal.RasterizeLayer(cells_ds, [1], layer, burn_values=[EDGE],
+                        options=['ALL_TOUCHED=TRUE'])
+    cells = cells_ds.ReadAsArray()
+    feature = None
+    aoi_ds = None
+    cells_ds = None
+
+    coverage = []
+    for x, y, cols, rows in windows:
+        window_cells = cells[y // cell_y:-(-(y + rows) // cell_y),
+                             x // cell_x:-(-(x + cols) // cell_x)]
+        if (window_cells == OUTSIDE).all():
+            coverage.append(OUTSIDE)
+        elif (window_cells == INSIDE).all():
+            coverage.append(INSIDE)
+        else:
+            coverage.append(EDGE)
+    return coverage
+
+
+def get_aoi_tasks(aoi_wkt, ds, windows):
+    """Returns (window, edge) tasks for the windows that overlap an AOI
+
+    Windows outside the AOI are dropped (so are never read), and edge is True
+    only for windows that need per-pixel masking."""
+    coverage = get_block_coverage(aoi_wkt, ds, windows)
+    return [(window, cov == EDGE) for window, cov in zip(windows, coverage)
+            if cov != OUTSIDE]
+
+
+def _init_clip_tiles(in_file, mask_file, data_type=gdal.GDT_Int16,
+                     nodata=NODATA):
+    _init_tiles(in_file, mask_file)
+    _tile_state['dtype'] = gdal_array.GDALTypeCodeToNumericTypeCode(data_type)
+    _tile_state['nodata'] = nodata
+    if data_type != gdal.GDT_Byte and is_compact(_tile_state['ds']):
+        # Compact input clipped to Int16
+        _tile_state['decode'] = get_compact_lut()
+
+
+def clip_tile(task):
+    """Masks one window of a raster to the AOI
+
+    task is a (window, edge) pair. Returns the window and the masked bands
+    (with the nodata value outside the AOI)"""
+    window, edge = task
+    x, y, cols, rows = window
+    ds = _tile_state['ds']
+    decode = _tile_state.get('decode')
+    if decode is None:
+        bands = np.empty((ds.RasterCount, rows, cols), dtype=_tile_state['dtype'])
+        ds.ReadAsArray(x, y, cols, rows, buf_obj=bands)
+    else:
+        bands = np.take(decode, ds.ReadAsArray(x, y, cols, rows))
+    if edge:
+        outside = _buffer_view(get_buffer('flag', cols * rows, bool), (rows, cols))
+        np.logical_not(_read_mask(window), out=outside)
+        bands[:, outside] = _tile_state['nodata']
+    return window, bands
+
+
+def clip_raster(in_file, out_file, aoi_wkt, n_workers=1, callback=None,
+                memory_mb=None, compact=False, profile=None, cache=None,
+                scratch=None):
+    """Masks a raster to an AOI, writing an Int16 GeoTIFF on the same grid
+
+    aoi_wkt is a polygon in EPSG:4326. Pixels outside the AOI are set to
+    -9999. If compact is True, compact class rasters (such as compact 
+    degradation layers) are kept compact, with grids.COMPACT_NODATA outside 
+    the AOI (otherwise they are decoded to Int16). The output is 
+    written with the given output profile (see profiles.PROFILES). The AOI 
+    mask is kept in cache or scratch (see calculate_areas). Returns True on 
+    success, or None if cancelled through the (GDAL-style) callback."""
+    if cache is None and scratch is None:
+        with ScratchSpace() as scratch:
+            return clip_raster(in_file, out_file, aoi_wkt, n_workers,
+                               callback, memory_mb, compact, profile,
+                               scratch=scratch)
+    src_ds = open_raster(in_file)
+    xsize = src_ds.RasterXSize
+    ysize = src_ds.RasterYSize
+    n_bands = src_ds.RasterCount
+    mask_file = get_aoi_mask(aoi_wkt, src_ds, cache, scratch)
+    tasks = get_aoi_tasks(aoi_wkt, src_ds,
+                          get_stage_windows(src_ds, CLIP_WORK_BYTES, n_workers,
+                                            memory_mb))
+
+    # Blocks outside the AOI are never written - GDAL fills them with the 
+    # nodata value when the file is closed
+    data_type, nodata = get_class_type(compact, src_ds)
+    dst_ds = create_output(out_file, xsize, ysize, n_bands, data_type, profile)
+    dst_ds.SetGeoTransform(src_ds.GetGeoTransform())
+    dst_ds.SetProjection(src_ds.GetProjectionRef())
+    set_class_type(dst_ds, data_type, nodata)
+    src_ds = None
+
+    done = 0
+    tiles = run_tiles(clip_tile, tasks, _init_clip_tiles,
+                      (in_file, mask_file, data_type, nodata), n_workers,
+                      callback)
+    writer = BlockWriter(dst_ds)
+    try:
+        for window, bands in tiles:
+            writer.write(bands, window[0], window[1])
+            done += 1
+    finally:
+        tiles.close()
+        _close_tiles()
+        writer.close()
+    dst_ds = None
+
+    if done < len(tasks):
+        discard_output(out_file, profile)
+        return None
+    else:
+        finish_output(out_file, profile)
+        return True
+
+
+def _init_sdg_tiles(gt, ysize, compact=False):
+    _init_area_map(gt, ysize, compact)
+    _tile_state['lut'] = make_deg_lut()
+    _tile_state['deg_type'] = get_class_type(compact)[0]
+
+
+def sdg_tile(window, bands, mask):
+    """Calculates degradation and area tables for one window
+
+    Applies the degradation rule to the bands of the full stack for the 
+    window and (for windows on the edge of the AOI) the AOI mask, and 
+    accumulates the area tables. Returns the window, the (masked) 
+    degradation array and a tuple of area tables for the window."""
+    x, y, cols, rows = window
+    n = cols * rows
+    flag = _buffer_view(get_buffer('flag', n, bool), (rows, cols))
+    deg = _buffer_view(get_buffer('deg', n, np.int16), (rows, cols))
+    apply_deg_lut(_tile_state['lut'], bands[0:4], deg,
+                  _buffer_view(get_buffer('ind', n, np.int32), (rows, cols)),
+                  flag)
+
+    if mask is not None:
+        np.logical_not(mask, out=flag)
+        deg[flag] = NODATA
+
+    tables = _new_area_tables()
+    _add_area_tables(tables, deg, bands[4], bands[5], bands[6], bands[7],
+                     _cell_area(window), mask)
+    return window, to_class_type(deg, _tile_state['deg_type'], flag), tables
+
+
+def get_block_digests(cache, path, band_n):
+    """Returns digests of the stored blocks of a band (see 
+    grids.read_block_digests)
+
+    The digests of a file on disk are saved in cache, keyed by its 
+    fingerprint, so an unchanged file isn't read again. Returns None if the 
+    blocks of the band can't be hashed."""
+    try:
+        key = cache_key('block_digests', file_fingerprint(path), band_n)
+    except OSError:
+        # Not a file on disk (such as an intermediate file in memory)
+        key = None
+    if key:
+        arrays = cache.get_arrays(key)
+        if arrays is not None:
+            return arrays['digests']
+    digests = read_block_digests(path, band_n)
+    if key and digests is not None:
+        cache.put_arrays(key, '.npz', {'digests': digests})
+    return digests
+
+
+def get_window_fingerprints(cache, stack, windows):
+    """Returns a fingerprint of the inputs of each window of a stack
+
+    A fingerprint is a hash of the stored blocks (see get_block_digests) of 
+    every band that the window reads, so windows are compared without reading 
+    or decoding them, and a block that is the same as in an earlier run (even 
+    in a file that has been downloaded again) has the same fingerprint. For 
+    bands whose blocks can't be hashed, the fingerprint of the whole file is 
+    used instead."""
+    fingerprints = dict((window, hashlib.md5()) for window in windows)
+    for n in range(stack.RasterCount):
+        band = stack.GetRasterBand(n + 1)
+        x_block_size, y_block_size = band.GetBlockSize()
+        digests = get_block_digests(cache, band.path, band.band_n)
+        if digests is None:
+            try:
+                file_key = json.dumps(file_fingerprint(band.path))
+            except OSError:
+                file_key = band.path
+        for window, fingerprint in fingerprints.items():
+            src_window = band.source_window(window)
+            fingerprint.update(json.dumps([n, band.band_n, src_window]).encode('utf-8'))
+            if src_window is None:
+                continue
+            if digests is None:
+                fingerprint.update(file_key.encode('utf-8'))
+                continue
+            x, y, cols, rows = src_window
+            fingerprint.update(digests[y // y_block_size:(y + rows - 1) // y_block_size + 1,
+                                       x // x_block_size:(x + cols - 1) // x_block_size + 1].tobytes())
+    return dict((window, fingerprint.hexdigest())
+                for window, fingerprint in fingerprints.items())
+
+
+def _load_sdg_blocks(cache, key):
+    """Returns the per-window fingerprints and area tables, and the path to 
+    the degradation layer, saved by the previous run on the same grid and 
+    AOI, or None if there isn't one"""
+    arrays = cache.get_arrays(key, '.blocks.npz')
+    deg_file = cache.get_file(key, '.blocks.tif')
+    if arrays is None or deg_file is None:
+        return None
+    fingerprints = {}
+    block_tables = {}
+    for n, window in enumerate(arrays['windows']):
+        window = tuple(int(v) for v in window)
+        fingerprints[window] = str(arrays['fingerprints'][n])
+        block_tables[window] = [arrays['values_{}'.format(i)][n] for i in
+                                range(int(arrays['n_tables']))]
+    return fingerprints, block_tables, deg_file
+
+
+def _save_sdg_blocks(cache, key, windows, fingerprints, block_tables,
+                     deg_file):
+    arrays = {'windows': np.array(windows, dtype=np.int64).reshape(-1, 4),
+              'fingerprints': np.array(fingerprints),
+              'n_tables': len(_new_area_tables())}
+    for i, empty in enumerate(_new_area_tables()):
+        values = [tables[i] for tables in block_tables]
+        arrays['values_{}'.format(i)] = np.array(values).reshape((-1,) + empty.shape)
+    cache.put_file(key, '.blocks.tif', deg_file)
+    cache.put_arrays(key, '.blocks.npz', arrays)
+
+
+def calculate_sdg(in_file, out_file, aoi_wkt, n_workers=1, callback=None,
+                  cache=None, memory_mb=None, compact=False, profile=None,
+                  scratch=None):
+    """Calculates SDG 15.3.1 degradation and area tables in a single pass
+
+    in_file is a RasterStack (or raster) of eight aligned bands (trajectory 
+    significance, performance, state, land cover degradation, base land 
+    cover, target land cover, land cover transitions and soil organic 
+    carbon). The degradation
+    layer, masked to the AOI (a polygon in EPSG:4326), is written to
+    out_file (see get_class_type for compact), with the given output profile 
+    (see profiles.PROFILES). Returns the same list of tables as 
+    calculate_areas, or None if cancelled through the (GDAL-style) callback.
+
+    If cache (a StageCache) is given, the stack is processed in a fixed grid 
+    of windows, and a fingerprint of the inputs (see 
+    get_window_fingerprints) and the outputs for each window are saved to 
+    it. A later run on the same grid and AOI only recalculates the windows 
+    whose inputs have changed, and reuses the saved outputs for the rest. 
+    The AOI mask is kept in cache or scratch (see calculate_areas)."""
+    if cache is None and scratch is None:
+        with ScratchSpace() as scratch:
+            return calculate_sdg(in_file, out_file, aoi_wkt, n_workers,
+                                 callback, cache, memory_mb, compact, profile,
+                                 scratch)
+    stack = as_stack(in_file)
+    xsize = stack.RasterXSize
+    ysize = stack.RasterYSize
+    mask_file = get_aoi_mask(aoi_wkt, stack, cache, scratch)
+    if cache:
+        # The windows don't depend on the number of workers or the memory 
+        # budget, so that the outputs saved for them can always be reused
+        x_block_size, y_block_size = get_source_block_size(stack)
+        windows = get_windows(xsize, ysize, x_block_size, y_block_size,
+                              SDG_WINDOW_PIXELS, SDG_WINDOW_PIXELS)
+    else:
+        windows = stack.windows(DEG_WORK_BYTES + AREA_WORK_BYTES, n_workers,
+                                memory_mb)
+    tasks = get_aoi_tasks(aoi_wkt, stack, windows)
+
+    data_type, nodata = get_class_type(compact)
+    prev = None
+    if cache:
+        key = cache_key('sdg_blocks', aoi_wkt, stack.GetGeoTransform(),
+                        stack.GetProjectionRef(), xsize, ysize, data_type,
+                        profile or 'lzw')
+        fingerprints = get_window_fingerprints(cache, stack,
+                                               [window for window, edge in tasks])
+        prev = _load_sdg_blocks(cache, key)
+    if prev:
+        prev_fingerprints, prev_tables, prev_deg_file = prev
+        unchanged = [window for window, edge in tasks
+                     if prev_fingerprints.get(window) == fingerprints[window]]
+        tasks = [(window, edge) for window, edge in tasks
+                 if prev_fingerprints.get(window) != fingerprints[window]]
+        if not tasks and len(unchanged) == len(prev_fingerprints):
+            # Nothing has changed since the previous run
+            shutil.copyfile(prev_deg_file, out_file)
+            tables = _new_area_tables()
+            for window in unchanged:
+                for table, values in zip(tables, prev_tables[window]):
+                    table.values += values
+            return _finish_area_tables(tables)
+    else:
+        unchanged = []
+
+    # Blocks outside the AOI are never written - GDAL fills them with the 
+    # nodata value when the file is closed
+    dst_ds = create_output(out_file, xsize, ysize, 1, data_type, profile)
+    dst_ds.SetGeoTransform(stack.GetGeoTransform())
+    dst_ds.SetProjection(stack.GetProjectionRef())
+    set_class_type(dst_ds, data_type, nodata)
+
+    saved_windows = []
+    block_tables = []
+    writer = BlockWriter(dst_ds)
+
+    def add_tile(tables, tile):
+        window, deg, tile_tables = tile
+        if cache:
+            saved_windows.append(window)
+            block_tables.append([table.values.copy() for table in tile_tables])
+        writer.write(deg, window[0], window[1])
+        return _merge_area_tables(tables, tile_tables)
+
+    try:
+        # Windows that are unchanged since the previous run are copied from 
+        # its outputs
+        tables = _new_area_tables()
+        if unchanged:
+            prev_deg_band = gdal.Open(prev_deg_file).GetRasterBand(1)
+            for window in unchanged:
+                tile_tables = _new_area_tables()
+                for table, values in zip(tile_tables, prev_tables[window]):
+                    table.values[...] = values
+                tables = add_tile(tables, (window,
+                                           prev_deg_band.ReadAsArray(*window),
+                                           tile_tables))
+            prev_deg_band = None
+        tables = stack.map_reduce(sdg_tile, add_tile, tables, tasks,
+                                  mask_file, _init_sdg_tiles,
+                                  (stack.GetGeoTransform(), ysize, compact),
+                                  n_workers, callback)
+    finally:
+        _close_tiles()
+        writer.close()
+    dst_ds = None
+
+    if tables is None:
+        discard_output(out_file, profile)
+        return None
+    finish_output(out_file, profile)
+    if cache:
+        # The degradation layer is kept only here (not also with the tables 
+        # of the whole run - see put_cached_sdg)
+        _save_sdg_blocks(cache, key, saved_windows,
+                         [fingerprints[window] for window in saved_windows],
+                         block_tables, out_file)
+    return _finish_area_tables(tables)
+
+
+def get_zone_raster(zones, ds, out_file):
+    """Rasterizes zones onto the pixel grid of a dataset
+
+    zones is a list of (zone_id, aoi_wkt) pairs, with positive integer IDs and
+    polygons in EPSG:4326. Writes a raster of zone IDs (0 outside of every 
+    zone, in the smallest type that holds the IDs) to out_file. Zones should not overlap - where they do, each
+    pixel is assigned to only one of them."""
+    srs_wkt = ds.GetProjectionRef()
+    srs = osr.SpatialReference()
+    srs.ImportFromWkt(srs_wkt)
+    mem_ds = ogr.GetDriverByName('Memory').CreateDataSource('zones')
+    layer = mem_ds.CreateLayer('zones', srs, ogr.wkbUnknown)
+    layer.CreateField(ogr.FieldDefn('zone', ogr.OFTInteger))
+    for zone_id, aoi_wkt in zones:
+        feature = ogr.Feature(layer.GetLayerDefn())
+        feature.SetField('zone', int(zone_id))
+        feature.SetGeometry(aoi_geometry(aoi_wkt, srs_wkt))
+        layer.CreateFeature(feature)
+        feature = None
+
+    driver = gdal.GetDriverByName("GTiff")
+    zone_ds = driver.Create(out_file, ds.RasterXSize, ds.RasterYSize, 1,
+                            get_zone_type([zone_id for zone_id, aoi_wkt in zones]),
+                            ['COMPRESS=DEFLATE', 'TILED=YES'])
+    zone_ds.SetGeoTransform(ds.GetGeoTransform())
+    zone_ds.SetProjection(srs_wkt)
+    gdal.RasterizeLayer(zone_ds, [1], layer, options=['ATTRIBUTE=zone'])
+    zone_ds = None
+    mem_ds = None
+    return out_file
+
+
+def _init_zone_tiles(gt, ysize, zone_ids, compact=False):
+    _init_sdg_tiles(gt, ysize, compact=compact)
+    _tile_state['zone_ids'] = np.asarray(zone_ids)
+
+
+def zone_tile(window, bands, mask):
+    """Calculates degradation and per-zone area tables for one window
+
+    bands are the eight bands of the stack followed by the zone ID band. 
+    mask is unused - pixels outside of every zone have a zone ID of 0, which 
+    is not in the domain of the tables. Returns a tuple of area tables with 
+    a leading dimension for the zones in the window (so the tables for a 
+    window stay small however many zones there are), or None if the window 
+    has none of the zones."""
+    x, y, cols, rows = window
+    n = cols * rows
+    zones = bands[8]
+    zone_ids = np.intersect1d(zones, _tile_state['zone_ids'])
+    if zone_ids.size == 0:
+        return None
+    deg = _buffer_view(get_buffer('deg', n, np.int16), (rows, cols))
+    apply_deg_lut(_tile_state['lut'], bands[0:4], deg,
+                  _buffer_view(get_buffer('ind', n, np.int32), (rows, cols)),
+                  _buffer_view(get_buffer('flag', n, bool), (rows, cols)))
+
+    tables = _new_area_tables(zone_ids)
+    _add_area_tables(tables, deg, bands[4], bands[5], bands[6], bands[7],
+                     _cell_area(window), zones=zones)
+    return tables
+
+
+def _merge_zone_tables(tables, tile_tables):
+    if tile_tables is not None:
+        for table, tile_table in zip(tables, tile_tables):
+            table.merge_subset(tile_table)
+    return tables
+
+
+class ZoneTables(object):
+    """The tables for each zone from calculate_zonal, as a read-only 
+    mapping from zone ID to a list of tables
+
+    The tables for a zone are only extracted when it is looked up, so 
+    large (memory-mapped) tables are never all in memory at once."""
+
+    def __init__(self, tables, zone_ids):
+        self.tables = tables
+        self.zone_ids = list(zone_ids)
+
+    def __getitem__(self, zone_id):
+        if zone_id not in self.zone_ids:
+            raise KeyError(zone_id)
+        return [table.subset(zone_id) for table in self.tables]
+
+    def __contains__(self, zone_id):
+        return zone_id in self.zone_ids
+
+    def __iter__(self):
+        return iter(self.zone_ids)
+
+    def __len__(self):
+        return len(self.zone_ids)
+
+    def keys(self):
+        return list(self.zone_ids)
+
+    def items(self):
+        return ((zone_id, self[zone_id]) for zone_id in self.zone_ids)
+
+
+def calculate_zonal(scratch, in_file, zones, n_workers=1, callback=None,
+                    memory_mb=None, compact=False, memmap_mb=None):
+    """Calculates SDG 15.3.1 area tables for many zones in a single pass
+
+    in_file is the same eight band stack as for calculate_sdg, and zones is a
+    list of (zone_id, aoi_wkt) pairs (see get_zone_raster). The zones are 
+    rasterized (into scratch, a ScratchSpace) to a zone ID band aligned with 
+    the stack, and the tables for every zone are accumulated together, so the 
+    stack is only read once however many zones there are. If the tables for 
+    all of the zones are larger than memmap_mb (MEMMAP_MB by default), they 
+    are memory-mapped to files in scratch rather than kept in memory. 
+    Returns a ZoneTables mapping each zone ID to a list of tables (as 
+    returned by calculate_sdg), which should be used before scratch is 
+    cleaned up, or None if cancelled through the (GDAL-style) callback."""
+    zone_ids = [zone_id for zone_id, aoi_wkt in zones]
+    zone_type = get_zone_type(zone_ids)
+    stack = as_stack(in_file)
+    zone_file = get_zone_raster(zones, stack,
+                                scratch.path('.tif', shared=True,
+                                             size=raster_size(stack.RasterXSize,
+                                                              stack.RasterYSize,
+                                                              data_type=zone_type)))
+    # The zone ID band is on the same grid, so is read with the stack (and 
+    # counted in the working memory)
+    stack = RasterStack(stack.grid, stack.sources + [(zone_file, 1)])
+    # Only read windows that overlap at least one zone
+    tasks = get_aoi_tasks(union_aois([aoi_wkt for zone_id, aoi_wkt in zones]),
+                          stack,
+                          stack.windows(DEG_WORK_BYTES + AREA_WORK_BYTES,
+                                        n_workers, memory_mb))
+
+    if memmap_mb is None:
+        memmap_mb = MEMMAP_MB
+    if _area_tables_size(len(zone_ids)) > memmap_mb * 1024 * 1024:
+        tables = _new_area_tables(zone_ids, scratch)
+    else:
+        tables = _new_area_tables(zone_ids)
+    try:
+        tables = stack.map_reduce(zone_tile, _merge_zone_tables, tables,
+                                  tasks, None, _init_zone_tiles,
+                                  (stack.GetGeoTransform(), stack.RasterYSize,
+                                   zone_ids, compact),
+                                  n_workers, callback)
+    finally:
+        _close_tiles()
+
+    if tables is None:
+        return None
+    return ZoneTables(_finish_area_tables(tables), zone_ids)
+
+
+def aoi_from_geojson(geojson):
+    """Returns the WKT of an AOI given as (parsed) GeoJSON in EPSG:4326
+
+    geojson can be a geometry, a Feature or a FeatureCollection, in which case 
+    the union of all of the features is used."""
+    if geojson['type'] == 'FeatureCollection':
+        geometries = [f['geometry'] for f in geojson['features']]
+    elif geojson['type'] == 'Feature':
+        geometries = [geojson['geometry']]
+    else:
+        geometries = [geojson]
+    aoi = None
+    for geometry in geometries:
+        geom = ogr.CreateGeometryFromJson(json.dumps(geometry))
+        if aoi is None:
+            aoi = geom
+        else:
+            aoi = aoi.Union(geom)
+    if aoi is None:
+        raise ValueError("AOI does not contain any geometries")
+    return aoi.ExportToWkt()
+
+
+def reproject(scratch, in_file, epsg):
+    """Returns in_file, or a VRT in scratch reprojecting it to EPSG:epsg"""
+    src_srs = osr.SpatialReference()
+    src_srs.ImportFromWkt(gdal.Open(in_file).GetProjectionRef())
+    dst_srs = osr.SpatialReference()
+    dst_srs.ImportFromEPSG(epsg)
+    if src_srs.IsSame(dst_srs):
+        return in_file
+    out_file = scratch.path('.vrt', shared=True)
+    gdal.Warp(out_file, in_file, format='VRT',
+              dstSRS="epsg:{}".format(epsg),
+              resampleAlg=gdal.GRA_NearestNeighbour)
+    return out_file
+
+
+def build_sdg_bands(scratch, traj_file, perf_file, state_file, lc_file,
+                    aoi_wkt):
+    """Selects and aligns the input bands for SDG 15.3.1 reporting
+
+    Returns (indic_bands, lc_bands, grid): the indicator bands (trajectory, 
+    performance, state and land cover degradation) and the land cover bands 
+    (baseline, target, transition and soil organic carbon), as RasterStack 
+    source references, and the GridSpec they are read on - the trajectory 
+    grid, snapped to cover the AOI. Optimised copies of the inputs (see 
+    profiles.optimise_task) are used where they exist."""
+    traj_file, perf_file, state_file, lc_file = [get_optimised_file(f) for f in
+                                                 (traj_file, perf_file,
+                                                  state_file, lc_file)]
+    lc_grid = GridSpec.from_file(lc_file)
+    traj_grid = GridSpec.from_file(traj_file)
+
+    # Snap the bounding box of the AOI outwards to the trajectory pixels. Use 
+    # this instead of croptocutline in gdal.Warp in order to keep the pixels 
+    # aligned.
+    minx, maxx, miny, maxy = ogr.CreateGeometryFromWkt(aoi_wkt).GetEnvelope()
+    grid = traj_grid.snap(minx, miny, maxx, maxy)
+
+    if lc_grid.res[0] < grid.res[0]:
+        # If the land cover is finer than the trajectory res, match the lc to 
+        # the lower res productivity data using the mode. This is calculated 
+        # once, onto the productivity grid covering the AOI, rather than on 
+        # every read.
+        n_bands = gdal.Open(lc_file).RasterCount
+        lc_file = majority_resample(lc_file,
+                                    scratch.path('.tif', shared=True,
+                                                 size=raster_size(grid.xsize,
+                                                                  grid.ysize,
+                                                                  n_bands)),
+                                    grid, [None] * 4 + [-32768] * (n_bands - 4))
+    # Otherwise the land cover is read with nearest neighbour resampling 
+    # onto the productivity grid
+
+    # Signif is band 2 of the trajectory layer
+    # TODO: Fix these to refer to the proper bands in the lc file
+    indic_bands = [(traj_file, 2),
+                   (perf_file, 1),
+                   (state_file, 1),
+                   (lc_file, 4)]
+    lc_bands = [(lc_file, 1),
+                (lc_file, 2),
+                (lc_file, 3),
+                (lc_file, 5, -32768)]
+    return indic_bands, lc_bands, grid
+
+
+def sdg_cache_key(traj_file, perf_file, state_file, lc_file, aoi_wkt,
+                  grid, compact=False, profile=None):
+    """Returns the stage cache key for the SDG 15.3.1 outputs of an AOI"""
+    return cache_key('sdg', [file_fingerprint(f) for f in
+                             (traj_file, perf_file, state_file, lc_file)],
+                     aoi_wkt, grid.key(), get_class_type(compact)[0],
+                     profile or 'lzw')
+
+
+def get_cached_sdg(cache, key, deg_out_file):
+    """Returns cached SDG 15.3.1 tables, copying the cached degradation layer 
+    to deg_out_file, or returns None if they are not cached"""
+    tables = cache.get_tables(key)
+    deg_file = cache.get_file(key, '.tif')
+    if tables is None or deg_file is None:
+        return None
+    shutil.copyfile(deg_file, deg_out_file)
+    return tables
+
+
+def put_cached_sdg(cache, key, deg_out_file, tables):
+    """Saves SDG 15.3.1 tables and the degradation layer to the cache
+
+    Used for the staged stages - calculate_sdg saves its own outputs."""
+    cache.put_file(key, '.tif', deg_out_file)
+    cache.put_tables(key, tables)
+
+
+def sdg_report(scratch, traj_file, perf_file, state_file, lc_file, aoi_wkt,
+               deg_out_file, n_workers=1, callback=None, cache=None,
+               memory_mb=None, compact=False, profile=None):
+    """Runs the SDG 15.3.1 pipeline for an AOI in a single pass
+
+    Writes the degradation layer (masked to the AOI) to deg_out_file, and 
+    returns the tables from calculate_sdg, or None if cancelled. If cache (a 
+    StageCache) is given, the outputs for each window are reused from it 
+    when its inputs are unchanged since an earlier run on the same AOI (see 
+    calculate_sdg)."""
+    indic_bands, lc_bands, grid = build_sdg_bands(scratch, traj_file,
+                                                  perf_file, state_file,
+                                                  lc_file, aoi_wkt)
+    stack = RasterStack(grid, indic_bands + lc_bands)
+    return calculate_sdg(stack, deg_out_file, aoi_wkt, n_workers, callback,
+                         cache, memory_mb, compact, profile, scratch)
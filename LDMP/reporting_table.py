@@ -0,0 +1,325 @@
+# -*- coding: utf-8 -*-
+"""
+/***************************************************************************
+ LDMP - A QGIS plugin
+ This plugin supports monitoring and reporting of land degradation to the UNCCD
+ and in support of the SDG Land Degradation Neutrality (LDN) target.
+                              -------------------
+        begin                : 2017-05-23
+        git sha              : $Format:%H$
+        copyright            : (C) 2017 by Conservation International
+        email                : GEF-LDMP@conservation.org
+ ***************************************************************************/
+"""
+
+# Summary tables for the reporting tool. Nothing in this module depends on QGIS
+# or Qt.
+
+import xlsxwriter
+
+
+# Returns value from crosstab table for particular deg/lc class combination
+def get_xtab_area(table, deg_class=None, lc_class=None):
+    return table.get(deg_class, lc_class)
+
+
+def get_deg_summary(trans_lpd_xtab):
+    """Returns the area (in sq km) in each SDG 15.3.1 degradation class"""
+    return {"Area Degraded": get_xtab_area(trans_lpd_xtab, -1, None),
+            "Area Stable": get_xtab_area(trans_lpd_xtab, 0, None),
+            "Area Improved": get_xtab_area(trans_lpd_xtab, 1, None),
+            "No Data": get_xtab_area(trans_lpd_xtab, 9999, None)}
+
+
+def get_lc_area(table, code):
+    return table.get(code)
+
+
+def get_lpd_row(table, transition):
+    return [get_xtab_area(table, -1, transition),
+            get_xtab_area(table, 0, transition),
+            get_xtab_area(table, 1, transition)]
+
+
+def get_soc_per_ha(soc_table, xtab_areas, transition):
+    # The "None" value below is used to return total area across all classes of 
+    # degradation - this is just using the trans_lpd_xtab table as a shortcut 
+    # to get the area of each transition class.
+    area = get_xtab_area(xtab_areas, None, transition)
+    if area == 0:
+        return 0
+    else:
+        # The 1e2 is convert area from sq km to ha
+        return soc_table.get(transition) / (area * 1e2)
+
+
+def make_reporting_table(base_areas, target_areas, soc_totals, trans_lpd_xtab, 
+                         out_file, tr=None):
+    """Writes the SDG 15.3.1 reporting table to an Excel file
+
+    tr is an optional function used to translate the labels in the table."""
+    if tr is None:
+        tr = lambda s: s
+
+    workbook = xlsxwriter.Workbook(out_file, {'nan_inf_to_errors': True})
+    worksheet = workbook.add_worksheet()
+
+    ########
+    # Formats
+    
+    title_format = workbook.add_format({'bold': 1,
+                                        'font_size': 18,
+                                        'font_color': '#2F75B5'})
+    subtitle_format = workbook.add_format({'bold': 1,
+                                           'font_size': 16})
+    warning_format = workbook.add_format({'bold': 1,
+                                          'font_color': 'red',
+                                          'font_size': 16})
+    header_format = workbook.add_format({'bold': 1,
+                                         'border': 1,
+                                         'align': 'center',
+                                         'valign': 'vcenter',
+                                         'fg_color': 'F2F2F2',
+                                         'text_wrap': 1})
+    note_format = workbook.add_format({'italic': 1,
+                                       'text_wrap': 1})
+    total_header_format = workbook.add_format({'bold': 1, 'align': 'right'})
+    total_number_format = workbook.add_format({'bold': 1, 'align': 'right', 'num_format': '0.0'})
+    total_percent_format = workbook.add_format({'bold': 1, 'align': 'right', 'num_format': '0.0%'})
+    num_format = workbook.add_format({'num_format': '0.0'})
+    num_format_rb = workbook.add_format({'num_format': '0.0', 'right': 1})
+    num_format_bb = workbook.add_format({'num_format': '0.0', 'bottom': 1})
+    num_format_bb_rb = workbook.add_format({'num_format': '0.0', 'bottom': 1, 'right': 1})
+
+    ########
+    # Header
+    worksheet.write('A1', tr("trends.earth reporting table"), title_format)
+    worksheet.write('A2',"DRAFT - DATA UNDER REVIEW - DO NOT QUOTE", warning_format)
+    #worksheet.write('A1', "LDN Target Setting Programme", title_format)
+    #worksheet.write('A2',"Table 1 - Presentation of national basic data using the LDN indicators framework", subtitle_format)
+
+    ##########
+    # LC Table
+    worksheet.merge_range('A4:A5', tr('Land Use/Cover Category'), header_format)
+    worksheet.merge_range('E4:H4', tr('Net land productivity dynamics** (sq km)'),
+                          header_format)
+    worksheet.write_row('B4', [tr('Area (2000)'),
+                               tr('Area (2015)'),
+                               tr('Net area change (2000-2015)')],
+                               header_format)
+    worksheet.write_row('B5', [tr('sq km*'),
+                               tr('sq km'),
+                               tr('sq km'),
+                               tr('Declining'),
+                               tr('Stable'),
+                               tr('Increasing'),
+                               tr('No Data***'),
+                               tr('ton/ha')],
+                               header_format)
+    worksheet.write('I4', tr('Soil organic carbon (2000)**'), header_format)
+
+    worksheet.write_row('A6', [tr('Forest'), get_lc_area(base_areas, 1), get_lc_area(target_areas, 1)], num_format)
+    worksheet.write_row('A7', [tr('Grasslands'), get_lc_area(base_areas, 2), get_lc_area(target_areas, 2)], num_format)
+    worksheet.write_row('A8', [tr('Croplands'), get_lc_area(base_areas, 3), get_lc_area(target_areas, 3)], num_format)
+    worksheet.write_row('A9', [tr('Wetlands'), get_lc_area(base_areas, 4), get_lc_area(target_areas, 4)], num_format)
+    worksheet.write_row('A10', [tr('Artificial areas'), get_lc_area(base_areas, 5), get_lc_area(target_areas, 5)], num_format)
+    worksheet.write_row('A11', [tr('Bare lands'), get_lc_area(base_areas, 6), get_lc_area(target_areas, 6)], num_format)
+    worksheet.write_row('A12', [tr('Water bodies'), get_lc_area(base_areas, 7), get_lc_area(target_areas, 7)], num_format_bb)
+
+    worksheet.write('D6', '=B6-C6', num_format)
+    worksheet.write('D7', '=B7-C7', num_format)
+    worksheet.write('D8', '=B8-C8', num_format)
+    worksheet.write('D9', '=B9-C9', num_format)
+    worksheet.write('D10', '=B10-C10', num_format)
+    worksheet.write('D11', '=B11-C11', num_format)
+    worksheet.write('D12', '=B12-C12', num_format_bb)
+
+    worksheet.write_row('E6', get_lpd_row(trans_lpd_xtab, 11), num_format)
+    worksheet.write_row('E7', get_lpd_row(trans_lpd_xtab, 22), num_format)
+    worksheet.write_row('E8', get_lpd_row(trans_lpd_xtab, 33), num_format)
+    worksheet.write_row('E9', get_lpd_row(trans_lpd_xtab, 44), num_format)
+    worksheet.write_row('E10', get_lpd_row(trans_lpd_xtab, 55), num_format)
+    worksheet.write_row('E11', get_lpd_row(trans_lpd_xtab, 66), num_format)
+    worksheet.write_row('E12', ['', '', ''], num_format_bb)
+
+    worksheet.write('H6', '=B6-SUM(E6:G6)', num_format)
+    worksheet.write('H7', '=B7-SUM(E7:G7)', num_format)
+    worksheet.write('H8', '=B8-SUM(E8:G8)', num_format)
+    worksheet.write('H9', '=B9-SUM(E9:G9)', num_format)
+    worksheet.write('H10', '=B10-SUM(E10:G10)', num_format)
+    worksheet.write('H11', '=B11-SUM(E11:G11)', num_format)
+    worksheet.write('H12', '', num_format_bb)
+
+    worksheet.write('I6', get_soc_per_ha(soc_totals, trans_lpd_xtab, 11), num_format_rb)
+    worksheet.write('I7', get_soc_per_ha(soc_totals, trans_lpd_xtab, 22), num_format_rb)
+    worksheet.write('I8', get_soc_per_ha(soc_totals, trans_lpd_xtab, 33), num_format_rb)
+    worksheet.write('I9', get_soc_per_ha(soc_totals, trans_lpd_xtab, 44), num_format_rb)
+    worksheet.write('I10', get_soc_per_ha(soc_totals, trans_lpd_xtab, 55), num_format_rb)
+    worksheet.write('I11', get_soc_per_ha(soc_totals, trans_lpd_xtab, 66), num_format_rb)
+    worksheet.write('I12', '', num_format_bb_rb)
+
+    worksheet.write('A13', tr('SOC average (ton/ha)'), total_header_format)
+    worksheet.write('A14', tr('Percent of total land area'), total_header_format)
+    worksheet.write('A15', tr('Total (sq km)*****'), total_header_format)
+    worksheet.write('A15', tr('Total (sq km)*****'), total_header_format)
+
+    worksheet.write('B15', '=SUM(B6:B12)', total_number_format)
+    worksheet.write('C15', '=SUM(C6:C12)', total_number_format)
+    worksheet.write('D15', '=SUM(D6:D12)', total_number_format)
+    worksheet.write('E15', '=SUM(E6:E12)', total_number_format)
+    worksheet.write('F15', '=SUM(F6:F12)', total_number_format)
+    worksheet.write('G15', '=SUM(G6:G12)', total_number_format)
+    worksheet.write('H15', '=SUM(H6:H12)', total_number_format)
+
+    worksheet.write('I13', '=(B6*I6 + B7*I7 + B8*I8 + B9*I9 + B10*I10 + B11*I11 + B12*I12) / B15', total_number_format)
+    worksheet.write('E14', '=E15/C15', total_percent_format)
+    worksheet.write('F14', '=F15/C15', total_percent_format)
+    worksheet.write('G14', '=G15/C15', total_percent_format)
+    worksheet.write('H14', '=H15/C15', total_percent_format)
+
+    ###########
+    # LPD Table
+    worksheet.merge_range('A18:A19', tr('Changing Land Use/Cover Category'), header_format)
+    worksheet.merge_range('B18:E18', tr('Net land productivity dynamics trend (sq km)'), header_format)
+    worksheet.write_row('B19', [tr('Declining'), tr('Stable'), tr('Increasing'), tr('Total^')], header_format)
+    worksheet.write_row('A20', [tr('Bare lands >> Artificial areas')] + get_lpd_row(trans_lpd_xtab, 65), num_format)
+    worksheet.write_row('A21', [tr('Cropland >> Artificial areas')] + get_lpd_row(trans_lpd_xtab, 35), num_format)
+    worksheet.write_row('A22', [tr('Forest >> Artificial areas')] + get_lpd_row(trans_lpd_xtab, 15), num_format)
+    worksheet.write_row('A23', [tr('Forest >> Bare lands')] + get_lpd_row(trans_lpd_xtab, 16), num_format)
+    worksheet.write_row('A24', [tr('Forest >> Cropland')] + get_lpd_row(trans_lpd_xtab, 13), num_format)
+    worksheet.write_row('A25', [tr('Forest >> Grasslands')] + get_lpd_row(trans_lpd_xtab, 12), num_format)
+    worksheet.write_row('A26', [tr('Grasslands >> Artificial areas')] + get_lpd_row(trans_lpd_xtab, 25), num_format)
+    worksheet.write_row('A27', [tr('Grasslands >> Cropland')] + get_lpd_row(trans_lpd_xtab, 23), num_format)
+    worksheet.write_row('A28', [tr('Grasslands >> Forest')] + get_lpd_row(trans_lpd_xtab, 21), num_format)
+    worksheet.write_row('A29', [tr('Wetlands >> Artificial areas')] + get_lpd_row(trans_lpd_xtab, 45), num_format)
+    worksheet.write_row('A30', [tr('Wetlands >> Cropland')] + get_lpd_row(trans_lpd_xtab, 43), num_format_bb)
+
+    worksheet.write('E20', '=sum(B20:D20)', num_format_rb)
+    worksheet.write('E21', '=sum(B21:D21)', num_format_rb)
+    worksheet.write('E22', '=sum(B22:D22)', num_format_rb)
+    worksheet.write('E23', '=sum(B23:D23)', num_format_rb)
+    worksheet.write('E24', '=sum(B24:D24)', num_format_rb)
+    worksheet.write('E25', '=sum(B25:D25)', num_format_rb)
+    worksheet.write('E26', '=sum(B26:D26)', num_format_rb)
+    worksheet.write('E27', '=sum(B27:D27)', num_format_rb)
+    worksheet.write('E28', '=sum(B28:D28)', num_format_rb)
+    worksheet.write('E29', '=sum(B29:D29)', num_format_rb)
+    worksheet.write('E30', '=sum(B30:D30)', num_format_bb_rb)
+
+    ############
+    # SOC Table
+    worksheet.merge_range('A33:A34', tr('Changing Land Use/Cover Category'), header_format)
+    worksheet.merge_range('C33:G33', tr('Soil organic carbon 0 - 30 cm (2000-2015)'), header_format)
+    worksheet.write('B33', tr('Net area change^ (2000-2015)'), header_format)
+    worksheet.write_row('B34', [tr('sq km'),
+                                tr('2000 ton/ha'),
+                                tr('2015 ton/ha'),
+                                tr('2000 total (ton)'),
+                                tr('2015 total (ton)****'),
+                                tr('2000-2015 loss (ton)')], header_format)
+    # The "None" values below are used to return total areas across all classes 
+    # of degradation - this is just using the trans_lpd_xtab table as a 
+    # shortcut to get the areas of each transition class.
+    worksheet.write_row('A35', [tr('Bare lands >> Artificial areas'), get_xtab_area(trans_lpd_xtab, None, 65)], num_format)
+    worksheet.write_row('A36', [tr('Cropland >> Artificial areas'), get_xtab_area(trans_lpd_xtab, None, 35)], num_format)
+    worksheet.write_row('A37', [tr('Forest >> Artificial areas'), get_xtab_area(trans_lpd_xtab, None, 15)], num_format)
+    worksheet.write_row('A38', [tr('Forest >> Bare lands'), get_xtab_area(trans_lpd_xtab, None, 16)], num_format)
+    worksheet.write_row('A39', [tr('Forest >> Cropland'), get_xtab_area(trans_lpd_xtab, None, 13)], num_format)
+    worksheet.write_row('A40', [tr('Forest >> Grasslands'), get_xtab_area(trans_lpd_xtab, None, 12)], num_format)
+    worksheet.write_row('A41', [tr('Grasslands >> Artificial areas'), get_xtab_area(trans_lpd_xtab, None, 25)], num_format)
+    worksheet.write_row('A42', [tr('Grasslands >> Cropland'), get_xtab_area(trans_lpd_xtab, None, 23)], num_format)
+    worksheet.write_row('A43', [tr('Grasslands >> Forest'), get_xtab_area(trans_lpd_xtab, None, 21)], num_format)
+    worksheet.write_row('A44', [tr('Wetlands >> Artificial areas'), get_xtab_area(trans_lpd_xtab, None, 45)], num_format)
+    worksheet.write_row('A45', [tr('Wetlands >> Cropland'), get_xtab_area(trans_lpd_xtab, None, 43)], num_format_bb)
+    worksheet.write('A46', tr('Total'), total_header_format)
+    worksheet.write('A47', tr('Percent change total SOC stock (country)'), total_header_format)
+
+    worksheet.write('C35', get_soc_per_ha(soc_totals, trans_lpd_xtab, 65), num_format)
+    worksheet.write('C36', get_soc_per_ha(soc_totals, trans_lpd_xtab, 35), num_format)
+    worksheet.write('C37', get_soc_per_ha(soc_totals, trans_lpd_xtab, 15), num_format)
+    worksheet.write('C38', get_soc_per_ha(soc_totals, trans_lpd_xtab, 16), num_format)
+    worksheet.write('C39', get_soc_per_ha(soc_totals, trans_lpd_xtab, 13), num_format)
+    worksheet.write('C40', get_soc_per_ha(soc_totals, trans_lpd_xtab, 12), num_format)
+    worksheet.write('C41', get_soc_per_ha(soc_totals, trans_lpd_xtab, 25), num_format)
+    worksheet.write('C42', get_soc_per_ha(soc_totals, trans_lpd_xtab, 23), num_format)
+    worksheet.write('C43', get_soc_per_ha(soc_totals, trans_lpd_xtab, 21), num_format)
+    worksheet.write('C44', get_soc_per_ha(soc_totals, trans_lpd_xtab, 45), num_format)
+    worksheet.write('C45', get_soc_per_ha(soc_totals, trans_lpd_xtab, 43), num_format_bb)
+
+    worksheet.write('D35', '=C35', num_format)
+    worksheet.write('D36', '=C36-((((C36-(0.1*C36))/20)*7.5))', num_format)
+    worksheet.write('D37', '=C37-((((C37-(0.1*C37))/20)*7.5))', num_format)
+    worksheet.write('D38', '=C38-((((C38-(0.1*C38))/20)*7.5))', num_format)
+    worksheet.write('D39', '=C39-((((C39-(0.57*C39))/20)*7.5)+(((C39-(0.91*C39))/20)*7.5))', num_format)
+    worksheet.write('D40', '=C40', num_format)
+    worksheet.write('D41', '=C41-((((C41-(0.1*C41))/20)*7.5))', num_format)
+    worksheet.write('D42', '=C42-((((C42-(0.57*C42))/20)*7.5)+(((C42-(0.91*C42))/20)*7.5))', num_format)
+    worksheet.write('D43', '=C43', num_format)
+    worksheet.write('D44', '=C44-((((C44-(0.1*C44))/20)*7.5))', num_format)
+    worksheet.write('D45', '=C45-((((C45-(0.1*C45))/20)*7.5))', num_format_bb)
+
+    worksheet.write('E35', '=B35*100*C35', num_format)
+    worksheet.write('E36', '=B36*100*C36', num_format)
+    worksheet.write('E37', '=B37*100*C37', num_format)
+    worksheet.write('E38', '=B38*100*C38', num_format)
+    worksheet.write('E39', '=B39*100*C39', num_format)
+    worksheet.write('E40', '=B40*100*C40', num_format)
+    worksheet.write('E41', '=B41*100*C41', num_format)
+    worksheet.write('E42', '=B42*100*C42', num_format)
+    worksheet.write('E43', '=B43*100*C43', num_format)
+    worksheet.write('E44', '=B44*100*C44', num_format)
+    worksheet.write('E45', '=B45*100*C45', num_format_bb)
+
+    worksheet.write('F35', '=B35*100*D35', num_format)
+    worksheet.write('F36', '=B36*100*D36', num_format)
+    worksheet.write('F37', '=B37*100*D37', num_format)
+    worksheet.write('F38', '=B38*100*D38', num_format)
+    worksheet.write('F39', '=B39*100*D39', num_format)
+    worksheet.write('F40', '=B40*100*D40', num_format)
+    worksheet.write('F41', '=B41*100*D41', num_format)
+    worksheet.write('F42', '=B42*100*D42', num_format)
+    worksheet.write('F43', '=B43*100*D43', num_format)
+    worksheet.write('F44', '=B44*100*D44', num_format)
+    worksheet.write('F45', '=B45*100*D45', num_format_bb)
+
+    worksheet.write('G35', '=F35-E35', num_format_rb)
+    worksheet.write('G36', '=F36-E36', num_format_rb)
+    worksheet.write('G37', '=F37-E37', num_format_rb)
+    worksheet.write('G38', '=F38-E38', num_format_rb)
+    worksheet.write('G39', '=F39-E39', num_format_rb)
+    worksheet.write('G40', '=F40-E40', num_format_rb)
+    worksheet.write('G41', '=F41-E41', num_format_rb)
+    worksheet.write('G42', '=F42-E42', num_format_rb)
+    worksheet.write('G43', '=F43-E43', num_format_rb)
+    worksheet.write('G44', '=F44-E44', num_format_rb)
+    worksheet.write('G45', '=F45-E45', num_format_bb_rb)
+
+    worksheet.write('B46', '=SUM(B35:B45)', total_number_format)
+    worksheet.write('E46', '=SUM(E35:E45)', total_number_format)
+    worksheet.write('F46', '=SUM(F35:F45)', total_number_format)
+    worksheet.write('G46', '=SUM(G35:G45)', total_number_format)
+    worksheet.write('G47', '=G46/(I13*B15*100)', total_percent_format)
+
+    worksheet.merge_range('A50:G50', tr("The boundaries, names, and designations used in this report do not imply official endorsement or acceptance by Conservation International Foundation, or its partner organizations and contributors.  This report is available under the terms of Creative Commons Attribution 4.0 International License (CC BY 4.0)."), note_format)
+
+
+    ################################
+    # Set col widths and row heights
+    worksheet.set_column('A:A', 40)
+    worksheet.set_column('B:I', 17)
+    worksheet.set_row(3, 72)
+    worksheet.set_row(4, 30)
+    worksheet.set_row(17, 72)
+    worksheet.set_row(18, 30)
+    worksheet.set_row(32, 72)
+    worksheet.set_row(33, 30)
+    worksheet.set_row(49, 30)
+
+    # Raises IOError if the file cannot be written (for example if it is open 
+    # in another program)
+    workbook.close()
+
+    # with open(out_file, 'wb') as fh:
+    #     writer = csv.writer(fh, delimiter=',')
+    #     for row in rows:
+    #         writer.writerow(row)
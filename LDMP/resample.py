@@ -0,0 +1,259 @@
+# -*- coding: utf-8 -*-
+"""
+/***************************************************************************
+ LDMP - A QGIS plugin
+ This plugin supports monitoring and reporting of land degradation to the UNCCD
+ and in support of the SDG Land Degradation Neutrality (LDN) target.
+                              -------------------
+        begin                : 2017-05-23
+        git sha              : $Format:%H$
+        copyright            : (C) 2017 by Conservation International
+        email                : GEF-LDMP@conservation.org
+ ***************************************************************************/
+"""
+
+# Majority (mode) resampling of categorical rasters, such as land cover, to a
+# coarser grid. Nothing in this module depends on QGIS or Qt.
+
+import numpy as np
+
+from osgeo import gdal, gdal_array
+
+from LDMP.tiles import WINDOW_PIXELS
+
+# Nodata value written for target pixels with no valid source pixels, for
+# bands that have no nodata value of their own (if it fits in the type of the
+# band - see _get_fill)
+NODATA = -9999
+
+# Most (target pixel, code) pairs counted at once by _block_majority - blocks
+# with codes spread over a wider range are counted by _majority instead
+MAX_COUNTS = 2**22
+
+
+def _integer_factor(dst_res, src_res):
+    """Returns dst_res / src_res if it is (very nearly) an integer, or None"""
+    factor = dst_res / src_res
+    if factor >= 1 and abs(factor - round(factor)) < 1e-6:
+        return int(round(factor))
+    return None
+
+
+def _get_fill(nodata, dtype):
+    """Returns the value to write for target pixels with no valid source
+    pixels: nodata, if it fits in dtype, or otherwise NODATA or (if that 
+    doesn't fit either) the closest value that does"""
+    if not np.issubdtype(dtype, np.integer):
+        return NODATA if nodata is None else nodata
+    info = np.iinfo(dtype)
+    for value in (nodata, NODATA):
+        if value is not None and info.min <= value <= info.max:
+            return value
+    return int(info.min) if info.min < 0 else int(info.max)
+
+
+def _majority(codes, target, n_targets, nodata, fill):
+    """Returns the most common code for each of n_targets target pixels
+
+    codes is a flat array of source pixels, and target the (flat) index of
+    the target pixel each one falls in (or -1 for pixels outside the grid).
+    Pixels equal to nodata are not counted, and target pixels with no valid
+    source pixels are set to fill. Ties go to the lowest code."""
+    valid = target >= 0
+    if nodata is not None:
+        valid &= codes != nodata
+    classes, inverse = np.unique(codes[valid], return_inverse=True)
+    out = np.empty(n_targets, dtype=codes.dtype)
+    out.fill(fill)
+    if classes.size == 0:
+        return out
+    # Count each (target pixel, class) pair that occurs - only the pairs that
+    # occur are counted, so this works for layers with many classes (such as
+    # soil carbon) as well as for land cover
+    pairs, counts = np.unique(target[valid] * classes.size + inverse,
+                              return_counts=True)
+    pair_target = pairs // classes.size
+    pair_class = pairs % classes.size
+    # Sort by target pixel, then by count (most common first), then by class,
+    # and take the first pair for each target pixel
+    order = np.lexsort((pair_class, -counts, pair_target))
+    pair_target = pair_target[order]
+    first = np.ones(order.size, dtype=bool)
+    first[1:] = pair_target[1:] != pair_target[:-1]
+    out[pair_target[first]] = classes[pair_class[order][first]]
+    return out
+
+
+def _block_majority(codes, factor, nodata, fill):
+    """Returns the most common code in each factor x factor cell of a block
+    of source pixels that is aligned with the target grid
+
+    codes is a (rows * factor, cols * factor) array. The cells are found by
+    reshaping it to (rows, factor, cols, factor), and the codes in every cell
+    are counted with a single bincount of (cell, code) pairs. Pixels equal to
+    nodata are not counted, and cells with no valid pixels are set to fill.
+    Ties go to the lowest code. Returns a flat array of rows * cols codes, or
+    None if the codes span too wide a range to count this way."""
+    rows, cols = codes.shape[0] // factor, codes.shape[1] // factor
+    n_cells = rows * cols
+    if nodata is None:
+        valid = None
+        valid_codes = codes
+    else:
+        valid = codes != nodata
+        valid_codes = codes[valid]
+    if valid_codes.size == 0:
+        out = np.empty(n_cells, dtype=codes.dtype)
+        out.fill(fill)
+        return out
+    low = int(valid_codes.min())
+    n_codes = int(valid_codes.max()) - low + 1
+    if n_cells * n_codes > MAX_COUNTS:
+        return None
+    cells = np.arange(n_cells, dtype=np.int64).reshape(rows, 1, cols, 1)
+    index = cells * n_codes + (codes.reshape(rows, factor, cols, factor).astype(np.int64) - low)
+    if valid is not None:
+        # Nodata pixels are counted in an extra bin, which is dropped
+        index[~valid.reshape(index.shape)] = n_cells * n_codes
+    counts = np.bincount(index.ravel(), minlength=n_cells * n_codes + 1)
+    counts = counts[:n_cells * n_codes].reshape(n_cells, n_codes)
+    most = counts.argmax(axis=1)
+    out = (most + low).astype(codes.dtype)
+    out[counts[np.arange(n_cells), most] == 0] = fill
+    return out
+
+
+def _block_targets(rows, cols, factor):
+    """Returns the target pixel of each pixel in a block of source rows that
+    is aligned with the target grid, for an integer scale factor
+
+    The source block is (rows * factor, cols * factor) pixels, and the target
+    index of each is found by reshaping the block into factor x factor
+    cells rather than from the coordinates of each pixel."""
+    target = np.arange(rows * cols).reshape(rows, 1, cols, 1)
+    return np.broadcast_to(target, (rows, factor, cols, factor)).ravel()
+
+
+def _axis_targets(src_origin, src_res, n_src, dst_origin, dst_res, n_dst):
+    """Returns the target pixel along one axis for each source pixel (by the
+    position of its centre), or -1 for pixels outside the target grid"""
+    centres = src_origin + (np.arange(n_src) + 0.5) * src_res
+    target = np.floor((centres - dst_origin) / dst_res).astype(np.int64)
+    target[(target < 0) | (target >= n_dst)] = -1
+    return target
+
+
+def majority_resample(in_file, out_file, grid, nodata=None):
+    """Resamples every band of a categorical raster to a coarser grid
+
+    Each target pixel is set to the most common value of the source pixels
+    whose centres fall within it, ignoring nodata. The target grid (a 
+    GridSpec) must be in the same CRS as in_file. nodata is
+    an optional list with a nodata value for each band, to override the
+    nodata values set in in_file. The result is written once, to an Int16
+    (or the type of the source) GeoTIFF at out_file, so later stages read
+    it without resampling again.
+
+    When the target pixels are an exact multiple of the source pixels and
+    the grids line up, the pixels of each target cell are found by reshaping
+    blocks of source rows and counted with a bincount (see _block_majority). 
+    Otherwise the target pixel of each source pixel is found from its 
+    coordinates."""
+    src_ds = gdal.Open(in_file)
+    src_gt = src_ds.GetGeoTransform()
+    dst_gt = grid.gt
+    dst_xsize = grid.xsize
+    dst_ysize = grid.ysize
+    n_bands = src_ds.RasterCount
+    if nodata is None:
+        nodata = [None] * n_bands
+    nodata = [src_ds.GetRasterBand(n + 1).GetNoDataValue() if v is None else v
+              for n, v in enumerate(nodata)]
+    nodata = [None if v is None else int(v) for v in nodata]
+
+    data_type = src_ds.GetRasterBand(1).DataType
+    dtype = gdal_array.GDALTypeCodeToNumericTypeCode(data_type)
+    fill = [_get_fill(v, dtype) for v in nodata]
+    driver = gdal.GetDriverByName("GTiff")
+    dst_ds = driver.Create(out_file, dst_xsize, dst_ysize, n_bands, data_type,
+                           ['COMPRESS=DEFLATE', 'TILED=YES', 'BIGTIFF=IF_SAFER'])
+    dst_ds.SetGeoTransform(dst_gt)
+    dst_ds.SetProjection(src_ds.GetProjectionRef())
+    for n in range(n_bands):
+        dst_ds.GetRasterBand(n + 1).SetNoDataValue(fill[n])
+
+    x_factor = _integer_factor(dst_gt[1], src_gt[1])
+    y_factor = _integer_factor(dst_gt[5], src_gt[5])
+    # Offset of the target grid from the source grid, in source pixels
+    x_off = (dst_gt[0] - src_gt[0]) / src_gt[1]
+    y_off = (dst_gt[3] - src_gt[3]) / src_gt[5]
+    aligned = (x_factor is not None and x_factor == y_factor and
+               abs(x_off - round(x_off)) < 1e-6 and
+               abs(y_off - round(y_off)) < 1e-6 and
+               round(x_off) >= 0 and round(y_off) >= 0 and
+               round(x_off) + dst_xsize * x_factor <= src_ds.RasterXSize and
+               round(y_off) + dst_ysize * y_factor <= src_ds.RasterYSize)
+
+    # Source columns covering the target grid, and the target column of each
+    if aligned:
+        factor = x_factor
+        src_x = int(round(x_off))
+        src_cols = dst_xsize * factor
+    else:
+        left = max(0, int(np.floor(x_off)))
+        right = min(src_ds.RasterXSize,
+                    int(np.ceil((dst_gt[0] + dst_xsize * dst_gt[1] - src_gt[0]) / src_gt[1])))
+        src_x = left
+        src_cols = max(0, right - left)
+        col_targets = _axis_targets(src_gt[0] + src_x * src_gt[1], src_gt[1],
+                                    src_cols, dst_gt[0], dst_gt[1], dst_xsize)
+
+    # Process strips of target rows, reading the source rows they cover
+    src_rows_per_row = max(1, int(np.ceil(dst_gt[5] / src_gt[5])))
+    strip_rows = max(1, WINDOW_PIXELS // max(1, src_cols * src_rows_per_row))
+    for y in range(0, dst_ysize, strip_rows):
+        rows = min(strip_rows, dst_ysize - y)
+        if aligned:
+            src_y = int(round(y_off)) + y * factor
+            src_rows = rows * factor
+            # Only needed for bands with codes too spread out to bincount
+            target = None
+        else:
+            top = dst_gt[3] + y * dst_gt[5]
+            bottom = top + rows * dst_gt[5]
+            src_y = max(0, int(np.floor((top - src_gt[3]) / src_gt[5])))
+            src_end = min(src_ds.RasterYSize,
+                          int(np.ceil((bottom - src_gt[3]) / src_gt[5])))
+            src_rows = src_end - src_y
+            if src_rows <= 0 or src_cols <= 0:
+                target = None
+            else:
+                row_targets = _axis_targets(src_gt[3] + src_y * src_gt[5],
+                                            src_gt[5], src_rows, top,
+                                            dst_gt[5], rows)
+                target = row_targets[:, np.newaxis] * dst_xsize + col_targets
+                target[(row_targets[:, np.newaxis] < 0) | (col_targets < 0)] = -1
+                target = target.ravel()
+        for n in range(n_bands):
+            if not aligned and target is None:
+                # None of the source is within this strip
+                out = np.empty(rows * dst_xsize, dtype=dtype)
+                out.fill(fill[n])
+            else:
+                codes = src_ds.GetRasterBand(n + 1).ReadAsArray(src_x, src_y,
+                                                                src_cols,
+                                                                src_rows)
+                codes = codes.astype(dtype, copy=False)
+                out = None
+                if aligned:
+                    out = _block_majority(codes, factor, nodata[n], fill[n])
+                    if out is None and target is None:
+                        target = _block_targets(rows, dst_xsize, factor)
+                if out is None:
+                    out = _majority(codes.ravel(), target, rows * dst_xsize,
+                                    nodata[n], fill[n])
+            dst_ds.GetRasterBand(n + 1).WriteArray(out.reshape(rows, dst_xsize),
+                                                   0, y)
+    dst_ds = None
+    src_ds = None
+    return out_file
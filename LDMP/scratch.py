@@ -0,0 +1,105 @@
+# -*- coding: utf-8 -*-
+"""
+/***************************************************************************
+ LDMP - A QGIS plugin
+ This plugin supports monitoring and reporting of land degradation to the UNCCD
+ and in support of the SDG Land Degradation Neutrality (LDN) target.
+                              -------------------
+        begin                : 2017-05-23
+        git sha              : $Format:%H$
+        copyright            : (C) 2017 by Conservation International
+        email                : GEF-LDMP@conservation.org
+ ***************************************************************************/
+"""
+
+import os
+import uuid
+import shutil
+import tempfile
+
+import numpy as np
+
+from osgeo import gdal
+
+from LDMP.tiles import WORKERS_INHERIT_MEMORY
+
+# Intermediate files larger than this (in bytes) are written to disk rather
+# than kept in memory
+DEFAULT_MAX_MEM_SIZE = 100 * 1024 * 1024
+
+
+def raster_size(xsize, ysize, n_bands=1, data_type=gdal.GDT_Int16):
+    """Returns the uncompressed size in bytes of a raster"""
+    return xsize * ysize * n_bands * gdal.GetDataTypeSize(data_type) // 8
+
+
+class ScratchSpace(object):
+    """Scratch space for the intermediate files of one run
+
+    Small files (VRTs, masks and modest rasters) are kept in memory, in GDAL's
+    /vsimem/ filesystem, so they cost no disk round trips. Files larger than
+    max_mem_size are spilled to a folder in spill_dir (the system temporary
+    folder by default). Everything is deleted by cleanup(), which is also
+    called when the ScratchSpace is used as a context manager.
+
+    Files in /vsimem/ are only visible to GDAL, and only within this process
+    and worker processes forked from it - pass shared=True to path() for files
+    that worker processes will read, so that they are written to disk on
+    platforms where workers do not inherit the memory of this process."""
+
+    def __init__(self, spill_dir=None, max_mem_size=DEFAULT_MAX_MEM_SIZE):
+        name = 'trends_earth_{}'.format(uuid.uuid4().hex)
+        self.mem_dir = '/vsimem/{}'.format(name)
+        if not spill_dir:
+            spill_dir = tempfile.gettempdir()
+        self.spill_dir = os.path.join(spill_dir, name)
+        self.max_mem_size = max_mem_size
+        self.n = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.cleanup()
+
+    def path(self, suffix, size=0, shared=False):
+        """Returns a new path for an intermediate file
+
+        size is the expected size of the file in bytes (see raster_size)."""
+        self.n += 1
+        filename = 'scratch_{}{}'.format(self.n, suffix)
+        if size > self.max_mem_size or (shared and not WORKERS_INHERIT_MEMORY):
+            if not os.path.exists(self.spill_dir):
+                os.makedirs(self.spill_dir)
+            return os.path.join(self.spill_dir, filename)
+        else:
+            return '{}/{}'.format(self.mem_dir, filename)
+
+    def array(self, shape, dtype=np.float64):
+        """Returns a new array of zeros, memory-mapped to a file on disk
+
+        For arrays (such as accumulators) too large to keep in memory - the 
+        operating system pages them in and out as they are used, so only the 
+        parts in use need to fit in memory. The file is always in spill_dir 
+        (never in memory), and is deleted by cleanup."""
+        if not os.path.exists(self.spill_dir):
+            os.makedirs(self.spill_dir)
+        self.n += 1
+        filename = os.path.join(self.spill_dir, 'scratch_{}.dat'.format(self.n))
+        # A new file is filled with zeros
+        return np.memmap(filename, dtype=dtype, mode='w+', shape=shape)
+
+    def subspace(self):
+        """Returns a new ScratchSpace within the spill folder of this one
+
+        For a separate part of a run (such as one region of a batch, in a 
+        worker process) that cleans up after itself - anything it leaves on 
+        disk is deleted along with this scratch space."""
+        return ScratchSpace(self.spill_dir, self.max_mem_size)
+
+    def cleanup(self):
+        """Deletes all of the files in the scratch space"""
+        for filename in gdal.ReadDir(self.mem_dir) or []:
+            gdal.Unlink('{}/{}'.format(self.mem_dir, filename))
+        if os.path.exists(self.spill_dir):
+            shutil.rmtree(self.spill_dir, ignore_errors=True)
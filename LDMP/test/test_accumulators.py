@@ -0,0 +1,66 @@
+# -*- coding: utf-8 -*-
+"""
+/***************************************************************************
+ LDMP - A QGIS plugin
+ This plugin supports monitoring and reporting of land degradation to the UNCCD
+ and in support of the SDG Land Degradation Neutrality (LDN) target.
+                              -------------------
+        begin                : 2017-05-23
+        git sha              : $Format:%H$
+        copyright            : (C) 2017 by Conservation International
+        email                : GEF-LDMP@conservation.org
+ ***************************************************************************/
+"""
+
+from collections import defaultdict
+
+import numpy as np
+
+from LDMP.accumulators import Crosstab, DEG_CODES, TRANS_CODES
+
+
+def naive_crosstab(a, b, weights=None):
+    totals = defaultdict(float)
+    if weights is None:
+        weights = np.ones(a.size)
+    for i, j, w in zip(a.ravel(), b.ravel(), weights.ravel()):
+        totals[(int(i), int(j))] += w
+    return totals
+
+
+def random_codes(rng, codes, shape, other=(-32768, 5, 88)):
+    # Mostly codes from the domain, with a few that are not in it
+    values = np.asarray(list(codes) + list(other))
+    return values[rng.randint(0, values.size, shape)].astype(np.int16)
+
+
+def check_crosstab(xtab, totals):
+    for i in xtab.domains[0]:
+        for j in xtab.domains[1]:
+            assert np.isclose(xtab.get(i, j), totals.get((i, j), 0))
+
+
+def test_crosstab_counts():
+    rng = np.random.RandomState(0)
+    deg = random_codes(rng, DEG_CODES, (40, 50))
+    trans = random_codes(rng, TRANS_CODES, (40, 50))
+    xtab = Crosstab(DEG_CODES, TRANS_CODES)
+    xtab.add(deg, trans)
+    check_crosstab(xtab, naive_crosstab(deg, trans))
+
+
+def test_crosstab_weights_mask_and_merge():
+    rng = np.random.RandomState(1)
+    deg = random_codes(rng, DEG_CODES, (30, 20))
+    trans = random_codes(rng, TRANS_CODES, (30, 20))
+    weights = rng.rand(30, 20)
+    mask = rng.rand(30, 20) > 0.3
+
+    # Add in two blocks, to separate crosstabs, and merge them
+    xtab = Crosstab(DEG_CODES, TRANS_CODES)
+    xtab.add(deg[:10], trans[:10], weights=weights[:10], mask=mask[:10])
+    other = Crosstab(DEG_CODES, TRANS_CODES)
+    other.add(deg[10:], trans[10:], weights=weights[10:], mask=mask[10:])
+    xtab.merge(other)
+
+    check_crosstab(xtab, naive_crosstab(deg[mask], trans[mask], weights[mask]))
@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+"""
+/***************************************************************************
+ LDMP - A QGIS plugin
+ This plugin supports monitoring and reporting of land degradation to the UNCCD
+ and in support of the SDG Land Degradation Neutrality (LDN) target.
+                              -------------------
+        begin                : 2017-05-23
+        git sha              : $Format:%H$
+        copyright            : (C) 2017 by Conservation International
+        email                : GEF-LDMP@conservation.org
+ ***************************************************************************/
+"""
+
+import os
+
+import numpy as np
+
+from LDMP.accumulators import Crosstab
+from LDMP.cache import StageCache, cache_key, file_fingerprint
+
+
+def write_file(path, size):
+    with open(path, 'wb') as f:
+        f.write(b'x' * size)
+    return path
+
+
+def test_stage_cache_lru_eviction(tmpdir):
+    cache = StageCache(str(tmpdir.join('cache')), max_size=250)
+    src = write_file(str(tmpdir.join('src')), 100)
+    a = cache.put_file('a', '.tif', src)
+    b = cache.put_file('b', '.tif', src)
+    # a was used longer ago than b, until it is read again
+    os.utime(a, (1000, 1000))
+    os.utime(b, (2000, 2000))
+    assert cache.get_file('a', '.tif') == a
+    cache.put_file('c', '.tif', src)
+    assert cache.get_file('b', '.tif') is None
+    assert cache.get_file('a', '.tif') == a
+    assert cache.get_file('c', '.tif') is not None
+    assert cache.get_file('d', '.tif') is None
+
+
+def test_stage_cache_tables(tmpdir):
+    cache = StageCache(str(tmpdir))
+    table = Crosstab([-1, 0, 1], [11, 12, 21])
+    table.add(np.array([-1, 0, 0, 1, 5]), np.array([11, 12, 12, 21, 11]))
+    cache.put_tables('k', [table])
+    tables = cache.get_tables('k')
+    assert len(tables) == 1
+    np.testing.assert_array_equal(tables[0].values, table.values)
+    assert tables[0].get(0, 12) == 2
+
+
+def test_cache_key_invalidation(tmpdir):
+    path = write_file(str(tmpdir.join('layer.tif')), 100)
+    key = cache_key('stage', file_fingerprint(path))
+    assert cache_key('stage', file_fingerprint(path)) == key
+    assert cache_key('other stage', file_fingerprint(path)) != key
+    # Rewriting a file changes its key
+    write_file(path, 200)
+    assert cache_key('stage', file_fingerprint(path)) != key
+
+    # Downloaded results are identified by their JSON sidecar, so touching 
+    # them doesn't invalidate the cache, but a new sidecar does
+    with open(str(tmpdir.join('layer.json')), 'w') as f:
+        f.write('{"id": 1}')
+    key = cache_key('stage', file_fingerprint(path))
+    os.utime(path, (1000, 1000))
+    assert cache_key('stage', file_fingerprint(path)) == key
+    with open(str(tmpdir.join('layer.json')), 'w') as f:
+        f.write('{"id": 2}')
+    assert cache_key('stage', file_fingerprint(path)) != key
@@ -0,0 +1,179 @@
+# -*- coding: utf-8 -*-
+"""
+/***************************************************************************
+ LDMP - A QGIS plugin
+ This plugin supports monitoring and reporting of land degradation to the UNCCD
+ and in support of the SDG Land Degradation Neutrality (LDN) target.
+                              -------------------
+        begin                : 2017-05-23
+        git sha              : $Format:%H$
+        copyright            : (C) 2017 by Conservation International
+        email                : GEF-LDMP@conservation.org
+ ***************************************************************************/
+"""
+
+import numpy as np
+
+from osgeo import gdal_array
+
+from LDMP.grids import GridSpec, BlockCache, read_aligned, encode_compact, \
+    get_compact_lut, compact_code, get_percentiles, COMPACT_NO_DATA_CLASS, \
+    COMPACT_NODATA, NODATA
+
+
+class ArrayBand(object):
+    """A numpy array read like a GDAL band"""
+
+    def __init__(self, data, block_size=(16, 8)):
+        self.data = data
+        self.YSize, self.XSize = data.shape
+        self.DataType = gdal_array.NumericTypeCodeToGDALTypeCode(data.dtype)
+        self.block_size = block_size
+
+    def GetBlockSize(self):
+        return list(self.block_size)
+
+    def ReadAsArray(self, x, y, cols, rows, buf_obj=None):
+        assert x >= 0 and y >= 0
+        assert x + cols <= self.data.shape[1] and y + rows <= self.data.shape[0]
+        block = self.data[y:y + rows, x:x + cols]
+        if buf_obj is None:
+            return block.copy()
+        buf_obj[...] = block
+        return buf_obj
+
+
+def naive_read(data, src, dst, window, fill):
+    """Nearest source pixel to the centre of each pixel of a window"""
+    x, y, cols, rows = window
+    out = np.empty((rows, cols), dtype=data.dtype)
+    for row in range(rows):
+        for col in range(cols):
+            cx = dst.gt[0] + (x + col + 0.5) * dst.gt[1]
+            cy = dst.gt[3] + (y + row + 0.5) * dst.gt[5]
+            sx = int(np.floor((cx - src.gt[0]) / src.gt[1]))
+            sy = int(np.floor((cy - src.gt[3]) / src.gt[5]))
+            if 0 <= sx < src.xsize and 0 <= sy < src.ysize:
+                out[row, col] = data[sy, sx]
+            else:
+                out[row, col] = fill
+    return out
+
+
+def test_snap():
+    grid = GridSpec((100., 10., 0., 500., 0., -10.), 50, 40)
+    sub = grid.snap(123., 301., 177., 389.)
+    assert sub.gt == (120., 10., 0., 390., 0., -10.)
+    assert (sub.xsize, sub.ysize) == (6, 9)
+    assert grid.offset(sub) == (2, 11)
+    # Boxes already on pixel edges (to within rounding) are not expanded
+    sub = grid.snap(120. + 1e-9, 300., 180., 390. - 1e-9)
+    assert (sub.xsize, sub.ysize) == (6, 9)
+    assert grid.offset(sub) == (2, 11)
+    # Grids at another resolution don't line up
+    assert grid.offset(GridSpec((100., 5., 0., 500., 0., -5.), 10, 10)) is None
+
+
+def test_read_aligned():
+    data = np.arange(40 * 50, dtype=np.int16).reshape(40, 50)
+    band = ArrayBand(data)
+    src = GridSpec((100., 10., 0., 500., 0., -10.), 50, 40)
+    for dst, window in [
+            # Inside the source, at an offset
+            (src.subgrid((3, 4, 10, 8)), (0, 0, 10, 8)),
+            (src.subgrid((3, 4, 10, 8)), (2, 1, 5, 6)),
+            # Extending beyond the source on every side
+            (src.subgrid((-2, -3, 60, 50)), (0, 0, 60, 50)),
+            # Entirely outside it
+            (src.subgrid((60, 0, 10, 10)), (0, 0, 10, 10)),
+            # At other resolutions (read nearest neighbour)
+            (GridSpec((93., 15., 0., 507., 0., -15.), 40, 30), (0, 0, 40, 30)),
+            (GridSpec((101., 4., 0., 499., 0., -4.), 30, 30), (5, 7, 20, 15))]:
+        x, y, cols, rows = window
+        out = np.empty((rows, cols), dtype=data.dtype)
+        read_aligned(band, src, dst, window, out, -9999)
+        np.testing.assert_array_equal(out, naive_read(data, src, dst, window,
+                                                      -9999))
+
+
+def chunk(value, n=1024):
+    return np.full(n, value, dtype=np.float64)
+
+
+def test_block_cache_hits_and_misses():
+    cache = BlockCache(1)
+    assert cache.get('a') is None
+    cache.put('a', chunk(1))
+    assert 'a' in cache
+    assert (cache.get('a') == 1).all()
+    assert cache.get('b') is None
+    assert cache.take_counts() == (1, 2, 0)
+    # The counts are reset once taken
+    assert cache.take_counts() == (0, 0, 0)
+    # Cached chunks are shared, so are read only
+    assert not cache.get('a').flags.writeable
+
+
+def test_block_cache_eviction():
+    # Room for two chunks
+    cache = BlockCache(2 * chunk(0).nbytes / (1024. * 1024))
+    cache.put('a', chunk(1))
+    cache.put('b', chunk(2))
+    # Using a makes b the least recently used
+    cache.get('a')
+    cache.put('c', chunk(3))
+    assert 'a' in cache and 'c' in cache and 'b' not in cache
+    assert cache.nbytes == 2 * chunk(0).nbytes
+    assert cache.take_counts() == (1, 0, 1)
+    # Chunks larger than the whole cache aren't kept
+    cache.put('d', chunk(4, 4096))
+    assert 'd' not in cache and 'a' in cache
+    # Shrinking the cache evicts down to the new size
+    cache.resize(0)
+    assert cache.nbytes == 0 and 'c' not in cache
+
+
+def test_compact_round_trip():
+    codes = np.array([-128, -32, -1, 0, 1, 3, 77, 125, 9999], dtype=np.int16)
+    # Codes with no compact code of their own are stored as nodata
+    other = np.array([-32768, -9999, -129, 126, 127, 254, 255, 9998, 32767],
+                     dtype=np.int16)
+    data = np.concatenate([codes, other]).reshape(3, 6)
+    encoded = encode_compact(data, np.empty(data.shape, dtype=bool))
+    assert encoded.dtype == np.uint8
+    assert encoded.ravel()[codes.size - 1] == COMPACT_NO_DATA_CLASS
+    assert (encoded.ravel()[codes.size:] == COMPACT_NODATA).all()
+    assert list(encoded.ravel()) == [compact_code(code) for code in data.ravel()]
+
+    decoded = np.take(get_compact_lut(), encoded)
+    assert decoded.dtype == np.int16
+    np.testing.assert_array_equal(decoded.ravel()[:codes.size], codes)
+    assert (decoded.ravel()[codes.size:] == NODATA).all()
+    # Every compact code decodes to a code that encodes back to it
+    lut = get_compact_lut()
+    assert [compact_code(code) for code in lut] == list(range(256))
+
+
+def test_get_percentiles():
+    rng = np.random.RandomState(0)
+    for dtype in (np.uint8, np.int16, np.uint16, np.float32):
+        data = rng.randint(0, 250, (45, 70)).astype(dtype)
+        if dtype != np.uint8:
+            data -= 100
+            data[::4, ::3] = 9999
+        if dtype == np.float32:
+            data *= 0.37
+            data[::4, ::3] = 9999
+            data[5, :7] = np.nan
+        expected = data.astype(np.float64)
+        expected[expected == 9999] = np.nan
+        percentiles = get_percentiles(ArrayBand(data), [2, 50, 98])
+        np.testing.assert_allclose(percentiles,
+                                   np.nanpercentile(expected, [2, 50, 98]))
+
+
+def test_get_percentiles_no_data():
+    data = np.full((10, 10), 9999, dtype=np.int16)
+    assert get_percentiles(ArrayBand(data), [2, 98]) is None
+    data = np.full((10, 10), np.nan, dtype=np.float32)
+    assert get_percentiles(ArrayBand(data), [2, 98]) is None
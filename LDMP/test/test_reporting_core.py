@@ -0,0 +1,197 @@
+# -*- coding: utf-8 -*-
+"""
+/***************************************************************************
+ LDMP - A QGIS plugin
+ This plugin supports monitoring and reporting of land degradation to the UNCCD
+ and in support of the SDG Land Degradation Neutrality (LDN) target.
+                              -------------------
+        begin                : 2017-05-23
+        git sha              : $Format:%H$
+        copyright            : (C) 2017 by Conservation International
+        email                : GEF-LDMP@conservation.org
+ ***************************************************************************/
+"""
+
+import numpy as np
+
+from osgeo import gdal, osr
+
+from LDMP.cache import StageCache
+from LDMP.grids import RasterStack
+from LDMP.scratch import ScratchSpace
+from LDMP.reporting_core import calc_cell_area, calc_cell_areas, make_deg_lut, \
+    apply_deg_lut, calculate_sdg, calculate_zonal
+
+
+def test_calc_cell_areas_rows():
+    # Matches the area of each row calculated one at a time, as the area
+    # stage used to
+    gt = (10., 0.25, 0., 60., 0., -0.25)
+    ysize = 200
+    areas = calc_cell_areas(gt, ysize)
+    assert areas.shape == (ysize,)
+    for y in range(ysize):
+        lat = gt[3] + y * gt[5]
+        assert np.isclose(areas[y], calc_cell_area(lat, lat + gt[5], gt[1]))
+
+
+def test_calc_cell_areas_globe():
+    # One degree rows from pole to pole, 360 cells wide, cover the surface of
+    # the WGS84 ellipsoid
+    areas = calc_cell_areas((-180., 1., 0., 90., 0., -1.), 180)
+    assert np.isclose(areas.sum() * 360, 5.10065622e14, rtol=1e-6)
+    # Symmetric about the equator, and largest there
+    assert np.allclose(areas, areas[::-1])
+    assert areas.argmax() in (89, 90)
+
+
+def naive_deg(traj, perf, state, lc):
+    """The SDG 15.3.1 degradation rule, as originally applied to each block"""
+    deg = traj.copy()
+    deg[deg == -1] = 0
+    deg[deg == 1] = 0
+    deg[np.logical_and(deg >= -3, deg <= -2)] = -1
+    deg[np.logical_and(deg >= 2, deg <= 3)] = 1
+    deg[lc == -1] = -1
+    deg[(state == -1) & (perf == -1)] = -1
+    return deg
+
+
+def test_apply_deg_lut():
+    rng = np.random.RandomState(0)
+    shape = (50, 60)
+    traj = rng.randint(-5, 6, shape).astype(np.int16)
+    traj.flat[::7] = -32768
+    traj.flat[::11] = 32767
+    traj.flat[::13] = 9999
+    traj.flat[::17] = -32768
+    perf, state, lc = [rng.randint(-1, 2, shape).astype(np.int16)
+                       for i in range(3)]
+    lc.flat[::5] = -32768
+
+    out = np.empty(shape, dtype=np.int16)
+    ind = np.empty(shape, dtype=np.int32)
+    flag = np.empty(shape, dtype=bool)
+    apply_deg_lut(make_deg_lut(), (traj, perf, state, lc), out, ind, flag)
+    np.testing.assert_array_equal(out, naive_deg(traj, perf, state, lc))
+
+
+def test_apply_deg_lut_byte_bands():
+    # Indicator bands can be read as any integer type
+    rng = np.random.RandomState(1)
+    shape = (20, 30)
+    traj = rng.randint(-3, 4, shape).astype(np.int8)
+    perf, state, lc = [rng.randint(-1, 2, shape).astype(np.int8)
+                       for i in range(3)]
+
+    out = np.empty(shape, dtype=np.int16)
+    ind = np.empty(shape, dtype=np.int32)
+    flag = np.empty(shape, dtype=bool)
+    apply_deg_lut(make_deg_lut(), (traj, perf, state, lc), out, ind, flag)
+    expected = naive_deg(traj.astype(np.int16), perf, state, lc)
+    np.testing.assert_array_equal(out, expected)
+
+
+def box_wkt(xmin, ymin, xmax, ymax):
+    return 'POLYGON(({0} {1},{2} {1},{2} {3},{0} {3},{0} {1}))'.format(
+        xmin, ymin, xmax, ymax)
+
+
+def write_sdg_stack(path, xsize, ysize, seed=0):
+    """Writes an eight band stack of random (valid) codes for calculate_sdg,
+    on a 0.01 degree grid with its top left corner at 10E 20N"""
+    rng = np.random.RandomState(seed)
+    shape = (ysize, xsize)
+    base = rng.randint(1, 8, shape)
+    target = rng.randint(1, 8, shape)
+    bands = [rng.randint(-3, 4, shape),
+             rng.randint(-1, 2, shape),
+             rng.randint(-1, 2, shape),
+             rng.randint(-1, 2, shape),
+             base,
+             target,
+             base * 10 + target,
+             rng.randint(-1, 100, shape)]
+    ds = gdal.GetDriverByName('GTiff').Create(path, xsize, ysize, len(bands),
+                                              gdal.GDT_Int16,
+                                              ['TILED=YES', 'COMPRESS=DEFLATE'])
+    ds.SetGeoTransform((10., 0.01, 0., 20., 0., -0.01))
+    srs = osr.SpatialReference()
+    srs.ImportFromEPSG(4326)
+    ds.SetProjection(srs.ExportToWkt())
+    for n, band in enumerate(bands):
+        ds.GetRasterBand(n + 1).WriteArray(band.astype(np.int16))
+    ds = None
+    return path
+
+
+def assert_tables_equal(tables, expected):
+    assert len(tables) == len(expected)
+    for table, expected_table in zip(tables, expected):
+        assert np.allclose(table.values, expected_table.values)
+
+
+def test_calculate_zonal_matches_calculate_sdg(tmpdir):
+    # The tables for each zone from one pass over the stack are the same as
+    # from calculating each zone on its own
+    in_file = write_sdg_stack(str(tmpdir.join('stack.tif')), 300, 200)
+    zones = [(1, box_wkt(10., 19., 11., 20.)),
+             (7, box_wkt(11.5, 18.2, 13., 19.5))]
+    with ScratchSpace(str(tmpdir)) as scratch:
+        zone_tables = calculate_zonal(scratch, in_file, zones)
+        assert sorted(zone_tables.keys()) == [1, 7]
+        for zone_id, aoi_wkt in zones:
+            expected = calculate_sdg(in_file,
+                                     str(tmpdir.join('deg_{}.tif'.format(zone_id))),
+                                     aoi_wkt, scratch=scratch)
+            assert expected[0].values.sum() > 0
+            assert_tables_equal(zone_tables[zone_id], expected)
+
+
+def test_calculate_sdg_reuses_unchanged_windows(tmpdir, monkeypatch):
+    calculated = []
+    map_reduce = RasterStack.map_reduce
+
+    def counting_map_reduce(self, func, reduce, initial, tasks=None, *args,
+                            **kwargs):
+        calculated.append(len(tasks))
+        return map_reduce(self, func, reduce, initial, tasks, *args, **kwargs)
+
+    monkeypatch.setattr(RasterStack, 'map_reduce', counting_map_reduce)
+
+    # 256 pixel blocks, so the stack is processed in two windows of four
+    # blocks each
+    xsize, ysize = 1024, 512
+    aoi_wkt = box_wkt(10.5, 15.5, 19., 19.5)
+    cache = StageCache(str(tmpdir.join('cache')))
+    first = write_sdg_stack(str(tmpdir.join('first.tif')), xsize, ysize)
+    calculate_sdg(first, str(tmpdir.join('deg_first.tif')), aoi_wkt,
+                  cache=cache)
+    assert calculated == [2]
+
+    # The same stack downloaded again, with one block changed
+    second = write_sdg_stack(str(tmpdir.join('second.tif')), xsize, ysize)
+    ds = gdal.Open(second, gdal.GA_Update)
+    band = ds.GetRasterBand(1)
+    band.WriteArray(-band.ReadAsArray(100, 300, 50, 50), 100, 300)
+    ds = None
+    out_file = str(tmpdir.join('deg_second.tif'))
+    tables = calculate_sdg(second, out_file, aoi_wkt, cache=cache)
+    assert calculated == [2, 1]
+
+    fresh_file = str(tmpdir.join('deg_fresh.tif'))
+    with ScratchSpace(str(tmpdir)) as scratch:
+        expected = calculate_sdg(second, fresh_file, aoi_wkt,
+                                 scratch=scratch)
+    assert calculated == [2, 1, 2]
+    assert_tables_equal(tables, expected)
+    np.testing.assert_array_equal(gdal.Open(out_file).ReadAsArray(),
+                                  gdal.Open(fresh_file).ReadAsArray())
+
+    # Nothing is recalculated when nothing has changed
+    out_file = str(tmpdir.join('deg_again.tif'))
+    tables = calculate_sdg(second, out_file, aoi_wkt, cache=cache)
+    assert calculated == [2, 1, 2]
+    assert_tables_equal(tables, expected)
+    np.testing.assert_array_equal(gdal.Open(out_file).ReadAsArray(),
+                                  gdal.Open(fresh_file).ReadAsArray())
@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -*-
+"""
+/***************************************************************************
+ LDMP - A QGIS plugin
+ This plugin supports monitoring and reporting of land degradation to the UNCCD
+ and in support of the SDG Land Degradation Neutrality (LDN) target.
+                              -------------------
+        begin                : 2017-05-23
+        git sha              : $Format:%H$
+        copyright            : (C) 2017 by Conservation International
+        email                : GEF-LDMP@conservation.org
+ ***************************************************************************/
+"""
+
+import uuid
+
+import numpy as np
+
+from osgeo import gdal
+
+from LDMP.grids import GridSpec
+from LDMP.resample import majority_resample, _majority, _block_majority, \
+    _block_targets
+
+
+def naive_majority(codes, factor, nodata, fill):
+    """Most common valid code (lowest on ties) in each factor x factor cell"""
+    rows, cols = codes.shape[0] // factor, codes.shape[1] // factor
+    out = np.empty((rows, cols), dtype=codes.dtype)
+    for i in range(rows):
+        for j in range(cols):
+            cell = codes[i * factor:(i + 1) * factor, j * factor:(j + 1) * factor]
+            cell = cell[cell != nodata]
+            if cell.size == 0:
+                out[i, j] = fill
+            else:
+                values, counts = np.unique(cell, return_counts=True)
+                out[i, j] = values[counts.argmax()]
+    return out.ravel()
+
+
+def random_codes(rng, shape, codes, nodata):
+    codes = np.asarray(list(codes) + [nodata])
+    return codes[rng.randint(0, codes.size, shape)].astype(np.int16)
+
+
+def test_block_majority():
+    rng = np.random.RandomState(0)
+    for factor in (1, 2, 3, 5):
+        codes = random_codes(rng, (6 * factor, 7 * factor), range(1, 8), -32768)
+        # A cell with only nodata
+        codes[:factor, :factor] = -32768
+        expected = naive_majority(codes, factor, -32768, -32768)
+        np.testing.assert_array_equal(
+            _block_majority(codes, factor, -32768, -32768), expected)
+        target = _block_targets(6, 7, factor)
+        np.testing.assert_array_equal(
+            _majority(codes.ravel(), target, 6 * 7, -32768, -32768), expected)
+
+
+def test_block_majority_wide_codes():
+    # Codes too spread out to bincount fall back to _majority
+    rng = np.random.RandomState(1)
+    codes = random_codes(rng, (40, 40), [-30000, 0, 30000], -32768)
+    assert _block_majority(codes, 4, -32768, -32768) is None
+    target = _block_targets(10, 10, 4)
+    np.testing.assert_array_equal(
+        _majority(codes.ravel(), target, 100, -32768, -32768),
+        naive_majority(codes, 4, -32768, -32768))
+
+
+def write_raster(path, data, gt, nodata):
+    ds = gdal.GetDriverByName('GTiff').Create(path, data.shape[1],
+                                              data.shape[0], 1, gdal.GDT_Int16)
+    ds.SetGeoTransform(gt)
+    ds.GetRasterBand(1).SetNoDataValue(nodata)
+    ds.GetRasterBand(1).WriteArray(data)
+    ds = None
+
+
+def test_majority_resample():
+    rng = np.random.RandomState(2)
+    codes = random_codes(rng, (60, 90), range(1, 8), -32768)
+    name = '/vsimem/{}'.format(uuid.uuid4().hex)
+    in_file = name + '_in.tif'
+    out_file = name + '_out.tif'
+    write_raster(in_file, codes, (10., 1., 0., 50., 0., -1.), -32768)
+    try:
+        # Aligned with the source grid, at three times its pixel size, and
+        # starting three source pixels in
+        grid = GridSpec((13., 3., 0., 47., 0., -3.), 29, 19)
+        majority_resample(in_file, out_file, grid)
+        out = gdal.Open(out_file).ReadAsArray()
+        expected = naive_majority(codes[3:60, 3:90], 3, -32768, -32768)
+        np.testing.assert_array_equal(out.ravel(), expected)
+    finally:
+        gdal.Unlink(in_file)
+        gdal.Unlink(out_file)
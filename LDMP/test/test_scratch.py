@@ -0,0 +1,59 @@
+# -*- coding: utf-8 -*-
+"""
+/***************************************************************************
+ LDMP - A QGIS plugin
+ This plugin supports monitoring and reporting of land degradation to the UNCCD
+ and in support of the SDG Land Degradation Neutrality (LDN) target.
+                              -------------------
+        begin                : 2017-05-23
+        git sha              : $Format:%H$
+        copyright            : (C) 2017 by Conservation International
+        email                : GEF-LDMP@conservation.org
+ ***************************************************************************/
+"""
+
+import os
+
+from osgeo import gdal
+
+from LDMP.scratch import ScratchSpace
+from LDMP.tiles import WORKERS_INHERIT_MEMORY
+
+
+def test_scratch_space_spills_large_files(tmpdir):
+    with ScratchSpace(str(tmpdir), max_mem_size=1000) as scratch:
+        small = scratch.path('.tif', size=100)
+        large = scratch.path('.tif', size=2000)
+        assert small.startswith('/vsimem/')
+        assert os.path.dirname(large) == scratch.spill_dir
+        assert scratch.spill_dir.startswith(str(tmpdir))
+        assert small != scratch.path('.tif', size=100)
+        # Files worker processes read are on disk unless workers share memory
+        shared = scratch.path('.tif', size=100, shared=True)
+        assert shared.startswith('/vsimem/') == WORKERS_INHERIT_MEMORY
+
+
+def test_scratch_space_cleanup(tmpdir):
+    scratch = ScratchSpace(str(tmpdir), max_mem_size=1000)
+    with scratch:
+        small = scratch.path('.tif', size=100)
+        gdal.FileFromMemBuffer(small, b'x' * 100)
+        large = scratch.path('.tif', size=2000)
+        with open(large, 'wb') as f:
+            f.write(b'x' * 2000)
+        array = scratch.array((10, 10))
+        assert (array == 0).all()
+        array = None
+        # Subspaces clean up after themselves, and are within the spill 
+        # folder, so anything left behind goes with it
+        with scratch.subspace() as sub:
+            sub_file = sub.path('.tif', size=2000)
+            with open(sub_file, 'wb') as f:
+                f.write(b'x')
+        assert not os.path.exists(sub_file)
+        assert gdal.VSIStatL(small) is not None
+        assert os.path.exists(large)
+    assert gdal.VSIStatL(small) is None
+    assert not os.path.exists(large)
+    assert not os.path.exists(scratch.spill_dir)
+    assert os.listdir(str(tmpdir)) == []
@@ -0,0 +1,63 @@
+# -*- coding: utf-8 -*-
+"""
+/***************************************************************************
+ LDMP - A QGIS plugin
+ This plugin supports monitoring and reporting of land degradation to the UNCCD
+ and in support of the SDG Land Degradation Neutrality (LDN) target.
+                              -------------------
+        begin                : 2017-05-23
+        git sha              : $Format:%H$
+        copyright            : (C) 2017 by Conservation International
+        email                : GEF-LDMP@conservation.org
+ ***************************************************************************/
+"""
+
+import numpy as np
+
+from LDMP.tiles import get_windows, plan_windows
+
+
+def check_coverage(windows, xsize, ysize):
+    # Every pixel is in exactly one window
+    covered = np.zeros((ysize, xsize), dtype=np.int32)
+    for x, y, cols, rows in windows:
+        assert cols > 0 and rows > 0
+        covered[y:y + rows, x:x + cols] += 1
+    assert (covered == 1).all()
+
+
+def test_get_windows_cover_grid():
+    for xsize, ysize, x_block, y_block in [(100, 80, 256, 256),
+                                           (1000, 700, 256, 256),
+                                           (1001, 333, 1001, 1),
+                                           (517, 403, 64, 32)]:
+        for min_pixels in (1, 1000, 10**6):
+            windows = get_windows(xsize, ysize, x_block, y_block, min_pixels)
+            check_coverage(windows, xsize, ysize)
+
+
+def test_get_windows_aligned_to_blocks():
+    windows = get_windows(1000, 700, 64, 32, min_pixels=5000)
+    for x, y, cols, rows in windows:
+        assert x % 64 == 0 and y % 32 == 0
+
+
+def test_get_windows_max_pixels():
+    for xsize, ysize, x_block, y_block, max_pixels in [(1000, 700, 256, 256, 10000),
+                                                       (5000, 10, 5000, 1, 1000),
+                                                       (300, 300, 300, 300, 1),
+                                                       (517, 403, 64, 32, 7777)]:
+        windows = get_windows(xsize, ysize, x_block, y_block,
+                              max_pixels=max_pixels)
+        check_coverage(windows, xsize, ysize)
+        assert max(cols * rows for x, y, cols, rows in windows) <= max_pixels
+
+
+def test_plan_windows_memory_budget():
+    bytes_per_pixel = 40
+    n_in_flight = 4
+    windows = plan_windows(4000, 3000, 256, 256, bytes_per_pixel,
+                           memory_mb=8, n_in_flight=n_in_flight)
+    check_coverage(windows, 4000, 3000)
+    largest = max(cols * rows for x, y, cols, rows in windows)
+    assert largest * bytes_per_pixel * n_in_flight <= 8 * 1024 * 1024
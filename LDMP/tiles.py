@@ -0,0 +1,248 @@
+# -*- coding: utf-8 -*-
+"""
+/***************************************************************************
+ LDMP - A QGIS plugin
+ This plugin supports monitoring and reporting of land degradation to the UNCCD
+ and in support of the SDG Land Degradation Neutrality (LDN) target.
+                              -------------------
+        begin                : 2017-05-23
+        git sha              : $Format:%H$
+        copyright            : (C) 2017 by Conservation International
+        email                : GEF-LDMP@conservation.org
+ ***************************************************************************/
+"""
+
+import os
+import sys
+import Queue
+import threading
+import multiprocessing
+
+# Whether worker processes start as a fork of this process (so inherit its
+# memory, including files in GDAL's /vsimem/ filesystem)
+WORKERS_INHERIT_MEMORY = sys.platform != 'win32'
+
+# Number of tiles to calculate ahead of (or queue for writing behind) the
+# thread consuming them
+PREFETCH = 2
+
+# Minimum number of pixels in a window when the native blocks of a raster
+# are small (or are strips only one row high)
+WINDOW_PIXELS = 2**20
+
+# Default memory budget (in MB) for all of the windows being processed at once
+MEMORY_MB = 512
+
+
+def get_n_workers(n_workers=None):
+    """Returns the number of worker processes to use for raster stages
+
+    A value of None or 0 means use one worker per CPU."""
+    if not n_workers:
+        try:
+            n_workers = multiprocessing.cpu_count()
+        except NotImplementedError:
+            n_workers = 1
+    return max(1, int(n_workers))
+
+
+def get_windows(xsize, ysize, x_block_size, y_block_size,
+                min_pixels=WINDOW_PIXELS, max_pixels=None):
+    """Splits a raster grid into a list of (x, y, cols, rows) windows
+
+    Windows are aligned to the native blocks of the raster. If the blocks are
+    smaller than min_pixels, several blocks are grouped together (first along
+    the row, and then down the columns). If max_pixels is given, no window 
+    has more pixels than that - larger blocks are split into fewer rows (and 
+    if a single row is still too large, into fewer columns)."""
+    x_block_size = min(x_block_size, xsize)
+    y_block_size = min(y_block_size, ysize)
+    if max_pixels:
+        max_pixels = max(1, int(max_pixels))
+        min_pixels = min(min_pixels, max_pixels)
+        if x_block_size > max_pixels:
+            x_block_size = max_pixels
+            y_block_size = 1
+        elif x_block_size * y_block_size > max_pixels:
+            y_block_size = max(1, max_pixels // x_block_size)
+    if x_block_size * y_block_size < min_pixels:
+        x_block_size = min(xsize, x_block_size * max(1, min_pixels // (x_block_size * y_block_size)))
+    if x_block_size * y_block_size < min_pixels:
+        y_block_size *= max(1, min_pixels // (x_block_size * y_block_size))
+    windows = []
+    for y in xrange(0, ysize, y_block_size):
+        rows = min(y_block_size, ysize - y)
+        for x in xrange(0, xsize, x_block_size):
+            cols = min(x_block_size, xsize - x)
+            windows.append((x, y, cols, rows))
+    return windows
+
+
+def plan_windows(xsize, ysize, x_block_size, y_block_size, bytes_per_pixel,
+                 memory_mb=None, n_in_flight=1):
+    """Splits a raster grid into windows that fit within a memory budget
+
+    bytes_per_pixel is the memory used per pixel of a window (for all of the 
+    bands read, plus any working arrays), and n_in_flight the number of 
+    windows that can be in memory at once (being read ahead, processed by 
+    each worker or waiting to be written). Windows are aligned to the 
+    (x_block_size, y_block_size) blocks of the underlying data, and sized to 
+    keep the total within memory_mb (MEMORY_MB by default)."""
+    if not memory_mb:
+        memory_mb = MEMORY_MB
+    max_pixels = memory_mb * 1024 * 1024 // (max(1, bytes_per_pixel) * max(1, n_in_flight))
+    return get_windows(xsize, ysize, x_block_size, y_block_size,
+                       max_pixels=max_pixels)
+
+
+def _get_pool(n_workers, initializer, initargs):
+    if sys.platform == 'win32':
+        # Within QGIS sys.executable is the QGIS binary rather than python,
+        # so point multiprocessing at the interpreter that QGIS ships with
+        exe = os.path.join(sys.exec_prefix, 'pythonw.exe')
+        if os.path.exists(exe):
+            multiprocessing.set_executable(exe)
+    return multiprocessing.Pool(n_workers, initializer, initargs)
+
+
+def _put(q, item, stop):
+    """Puts item on a bounded queue, giving up if stop is set"""
+    while not stop.is_set():
+        try:
+            q.put(item, timeout=0.1)
+            return True
+        except Queue.Full:
+            pass
+    return False
+
+
+def _read_ahead(func, tasks, prefetch):
+    """Yields func(task) for each task, in order
+
+    The results are calculated on a background thread, up to prefetch tasks
+    ahead of the consumer, so reading and calculating the next tiles overlaps
+    with whatever the consumer does with the current one (such as writing
+    it). GDAL releases the GIL while reading and writing, as does numpy for
+    most array operations."""
+    results = Queue.Queue(prefetch)
+    stop = threading.Event()
+
+    def produce():
+        try:
+            for task in tasks:
+                if not _put(results, (True, func(task)), stop):
+                    return
+            _put(results, (True, StopIteration), stop)
+        except Exception:
+            _put(results, (False, sys.exc_info()), stop)
+
+    thread = threading.Thread(target=produce)
+    thread.daemon = True
+    thread.start()
+    try:
+        while True:
+            ok, result = results.get()
+            if not ok:
+                raise result[0], result[1], result[2]
+            if result is StopIteration:
+                return
+            yield result
+    finally:
+        stop.set()
+        thread.join()
+
+
+class BlockWriter(object):
+    """Writes blocks to a GDAL dataset on a background thread
+
+    write() queues a block and returns straight away (blocking only if more
+    than max_pending blocks are waiting), so that compressing and writing
+    blocks overlaps with calculating the next ones. The arrays passed to
+    write() must not be modified afterwards. close() must be called (before
+    the dataset is closed) to finish writing, and raises any error from the
+    writer thread."""
+
+    def __init__(self, ds, max_pending=PREFETCH):
+        self.ds = ds
+        self.queue = Queue.Queue(max_pending)
+        self.error = None
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            if self.error:
+                continue
+            data, x, y = item
+            try:
+                if data.ndim == 2:
+                    self.ds.GetRasterBand(1).WriteArray(data, x, y)
+                else:
+                    for n in range(data.shape[0]):
+                        self.ds.GetRasterBand(n + 1).WriteArray(data[n], x, y)
+            except Exception:
+                self.error = sys.exc_info()
+
+    def _raise_error(self):
+        error = self.error
+        raise error[0], error[1], error[2]
+
+    def write(self, data, x, y):
+        """Queues a 2D array (for band 1) or 3D array (for all bands)"""
+        if self.error:
+            self._raise_error()
+        self.queue.put((data, x, y))
+
+    def close(self):
+        if self.thread.is_alive():
+            self.queue.put(None)
+            self.thread.join()
+        if self.error:
+            self._raise_error()
+
+
+def run_tiles(func, windows, initializer=None, initargs=(), n_workers=1,
+              callback=None, prefetch=PREFETCH):
+    """Runs func on each window, yielding the results as they finish
+
+    func and initializer must be module level functions (so that they can be
+    pickled). The initializer is run once in each worker process, and should
+    open any datasets that func reads from, so that each process has its own
+    GDAL handles. If n_workers is 1, the tiles are processed in this process,
+    on a background thread working up to prefetch tiles ahead (or on this
+    thread, if prefetch is 0).
+
+    callback follows the GDAL progress callback convention: it is called as
+    callback(fraction, message, data) after each tile, and processing stops
+    (without yielding further results) if it returns False. Results are
+    yielded in the order they finish, not the order of windows, so func
+    should return enough information (such as the window) to place them."""
+    n_tiles = len(windows)
+    if n_tiles == 0:
+        return
+    if n_workers <= 1:
+        if initializer:
+            initializer(*initargs)
+        if prefetch > 0:
+            results = _read_ahead(func, windows, prefetch)
+        else:
+            results = (func(window) for window in windows)
+        pool = None
+    else:
+        pool = _get_pool(min(n_workers, n_tiles), initializer, initargs)
+        results = pool.imap_unordered(func, windows)
+    try:
+        for n, result in enumerate(results):
+            yield result
+            if callback and callback(float(n + 1) / n_tiles, '', None) == False:
+                return
+    finally:
+        if pool is None:
+            results.close()
+        else:
+            pool.terminate()
+            pool.join()
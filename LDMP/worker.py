@@ -16,8 +16,10 @@ import sys
 import time
 
 from PyQt4 import QtCore
-from PyQt4.QtCore import QThread, Qt
-from PyQt4.QtGui import QProgressBar, QPushButton
+from PyQt4.QtCore import QThread, Qt, QEventLoop
+from PyQt4.QtGui import QProgressBar, QPushButton, QApplication
+
+from qgis.utils import iface
 
 from LDMP import log
 
@@ -60,6 +62,17 @@ class AbstractWorker(QtCore.QObject):
         """
         raise NotImplementedError
 
+    def progress_callback(self, fraction, message, data):
+        """Progress callback following the GDAL convention
+
+        Can be passed as the callback to GDAL functions (and to the raster
+        stages in reporting_core) to report progress and allow cancelling"""
+        if self.killed:
+            return False
+        else:
+            self.progress.emit(100 * fraction)
+            return True
+
     def kill(self):
         self.killed = True
         self.set_message.emit('Aborting...')
@@ -107,6 +120,38 @@ def start_worker(worker, iface, message, with_progress=True):
     return thread, message_bar_item
 
 
+class StartWorker(object):
+    def __init__(self, worker_class, process_name, *args):
+        self.exception = None
+        self.success = None
+
+        self.worker = worker_class(*args)
+
+        pause = QEventLoop()
+        self.worker.finished.connect(pause.quit)
+        self.worker.successfully_finished.connect(self.save_success)
+        self.worker.error.connect(self.save_exception)
+        start_worker(self.worker, iface,
+                     QApplication.translate("LDMP", 'Processing: {}').format(process_name))
+        pause.exec_()
+
+        if self.exception:
+            raise self.exception
+
+    def save_success(self, val=None):
+        self.return_val = val
+        self.success = True
+
+    def get_return(self):
+        return self.return_val
+
+    def save_exception(self, exception):
+        self.exception = exception
+
+    def get_exception(self):
+        return self.exception
+
+
 def worker_finished(result, thread, worker, iface, message_bar_item):
     # remove widget from message bar
     iface.messageBar().popWidget(message_bar_item)